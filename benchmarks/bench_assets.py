@@ -0,0 +1,163 @@
+#--------------------------------------------------------------------------------------
+# Benchmark - a classroom opening the live stream page at once
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_assets
+#   python -m benchmarks.bench_assets --browsers 30 --visits 5
+#   python -m benchmarks.bench_assets --new-connections
+#
+# Every browser loads the page and its scripts, then comes back (reload) with
+# the validators of its first visit like a browser cache does. A browser keeps
+# its connection open for the next request and opens a new one when the server
+# has closed it (--new-connections: one per request). The server runs in this
+# process, the browsers in a second one, so the CPU time of this process is the
+# server's. Bytes are what the browsers received, headers included.
+#--------------------------------------------------------------------------------------
+
+import sys
+import time
+import argparse
+import threading
+import http.client
+import multiprocessing
+
+import numpy as np
+
+PORT  = 14664
+PAGE  = ['/', '/protobuf.min.js', '/broadway/YUVCanvas.js', '/broadway/Decoder.js',
+         '/broadway/Player.js', '/ws_client.js', '/messages.proto']
+
+#--------------------------------------------------------------------------------------
+# Browsers
+#--------------------------------------------------------------------------------------
+class Connection(http.client.HTTPConnection):
+    # Counts the TCP connections it opens
+    opened = 0
+
+    def connect(self):
+        Connection.opened += 1
+        super().connect()
+
+#--------------------------------------------------------------------------------------
+def get(conn, path, headers):
+    # One request, again on a new connection if the server has closed the kept one.
+    # Returns the status, bytes received and validators.
+    for attempt in (0, 1):
+        try:
+            conn.request('GET', path, headers=headers)
+            response = conn.getresponse()
+            body = response.read()
+            break
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            conn.close()
+            if attempt:
+                raise
+    size = len(body) + sum(len(k) + len(v) + 4 for k, v in response.getheaders()) + 17
+    return response.status, size, response.getheader('ETag'), response.getheader('Last-Modified')
+
+#--------------------------------------------------------------------------------------
+def browse(visits, keepAlive, results):
+    cache = {}
+    conn = Connection('127.0.0.1', PORT)
+    for visit in range(visits):
+        start = time.monotonic()
+        size = 0
+        for path in PAGE:
+            headers = {'Accept-Encoding': 'gzip, deflate, br'}
+            if not keepAlive:
+                headers['Connection'] = 'close'
+            etag, modified = cache.get(path, (None, None))
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+            status, received, etag, modified = get(conn, path, headers)
+            if status not in (200, 304):
+                raise RuntimeError('{} {}'.format(path, status))
+            if status == 200:
+                cache[path] = (etag, modified)
+            size += received
+        results.append((visit, time.monotonic() - start, size))
+    conn.close()
+
+#--------------------------------------------------------------------------------------
+def classroom(browsers, visits, keepAlive, conn):
+    # Runs in the browser process, sends the (visit, seconds, bytes) of every page load
+    # and the number of connections opened
+    results = []
+    threads = [threading.Thread(target=browse, args=(visits, keepAlive, results))
+               for i in range(browsers)]
+    start = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    conn.send((results, time.monotonic() - start, Connection.opened))
+
+#--------------------------------------------------------------------------------------
+# Server
+#--------------------------------------------------------------------------------------
+def measure(browsers, visits, keepAlive=True):
+    from helpers.Devices import SimulatedCamera
+    from streaming.server import StreamingServer
+
+    camera = SimulatedCamera()
+    server = StreamingServer(camera, tcp_port=PORT + 1, web_port=PORT, annexb_port=PORT + 2)
+    time.sleep(0.2)
+    try:
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=classroom, args=(browsers, visits, keepAlive, sender))
+        cpu = time.process_time()
+        started = threading.active_count()
+        process.start()
+        threads = started
+        while not receiver.poll(0.005):                  # Peak of the server's threads
+            threads = max(threads, threading.active_count())
+        results, wall, opened = receiver.recv()
+        cpu = time.process_time() - cpu
+        process.join()
+    finally:
+        server.close()
+        camera.close()
+
+    first = np.array([(t, size) for visit, t, size in results if visit == 0])
+    again = np.array([(t, size) for visit, t, size in results if visit > 0])
+    loads = len(results)
+    return {'browsers': browsers,
+            'threads': threads,
+            'connections': opened / loads,
+            'rate': loads / wall,
+            'cpu': 1000 * cpu / loads,
+            'first_p50': 1000 * float(np.median(first[:, 0])),
+            'first_p99': 1000 * float(np.percentile(first[:, 0], 99)),
+            'first_kb': float(first[:, 1].mean()) / 1000,
+            'again_p50': 1000 * float(np.median(again[:, 0])) if len(again) else float('nan'),
+            'again_kb': float(again[:, 1].mean()) / 1000 if len(again) else float('nan')}
+
+#--------------------------------------------------------------------------------------
+def run(counts=(1, 10, 30), visits=5, keepAlive=True):
+    print('{} requests per page, {} visits per browser, {}'.format(
+          len(PAGE), visits, 'keep-alive' if keepAlive else 'new connection per request'))
+    results = []
+    for count in counts:
+        r = measure(count, visits, keepAlive)
+        results.append(r)
+        print('{browsers:4d} browsers  {rate:7.1f} pages/s  server cpu {cpu:6.2f} ms/page  '
+              'threads {threads:3d}  connections/page {connections:5.2f}  '
+              'first visit p50 {first_p50:7.1f} ms  p99 {first_p99:7.1f} ms  {first_kb:7.1f} kB  '
+              'reload p50 {again_p50:7.1f} ms  {again_kb:7.1f} kB'.format(**r))
+
+    return results
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Page loads of the live stream viewer')
+    parser.add_argument('--browsers', type=int, nargs='+', default=[1, 10, 30])
+    parser.add_argument('--visits', type=int, default=5, help='page loads per browser')
+    parser.add_argument('--new-connections', dest='keepAlive', action='store_false',
+                        help='Connection: close on every request')
+    args = parser.parse_args()
+
+    run(args.browsers, args.visits, args.keepAlive)
+    sys.exit(0)
@@ -0,0 +1,213 @@
+#--------------------------------------------------------------------------------------
+# Benchmark - stages of a measurement, from takePicture to the logbook entry
+#
+# Run from the repository root, the notebook must not be running (same ports):
+#   python -m benchmarks.bench_pipeline --output pipeline.json
+#   python -m benchmarks.bench_pipeline --compare pipeline.json
+#
+# A Spectrometer on the simulated devices (helpers/Devices.py) processes a CFL
+# frame at the stream resolution and at full sensor resolution. Files are written
+# to a temporary directory. Timings come from one pass, peak memory (tracemalloc)
+# from a second one, as tracing slows the Python heavy stages down.
+#--------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+
+import numpy as np
+
+RESOLUTIONS = [(648, 486), (2592, 1944)]
+MODES       = ['rgb', 'jpeg']
+STAGES      = ['takePicture', 'crop', 'setLCD', 'adjustBrightness', 'getSpectrum', 'plot',
+               'saveCSV', 'createHTML']
+
+#--------------------------------------------------------------------------------------
+def stages(spec, c, stamp):
+    # One measurement as runProcess does it, split into the timed stages
+    state = {}
+    pix1, pix2 = int(spec.p_pix1.value), int(spec.p_pix2.value)
+
+    def takePicture():
+        spec.raw = spec.takePicture()
+    def crop():
+        state['processed'] = spec.cropFrame(c)
+    def setLCD():
+        spec.setLCD(state['processed'])
+    def adjustBrightness():
+        state['processed'] = spec.adjustBrightness(state['processed'])
+    def getSpectrum():
+        state['wavelength'], state['spectrum'] = spec.getSpectrum(state['processed'], spec.waveL1,
+                                                                  spec.waveL2, pix1, pix2)
+    def plot():
+        spec.renderer.update(state['wavelength'], state['spectrum'])
+        state['plot'] = spec.renderer.render('jpeg')
+    def saveCSV():
+        spec.saveCSV('docs/data/spectrum-' + stamp + '.csv', state['spectrum'], state['wavelength'])
+    def createHTML():
+        spec.p_time.value = stamp
+        spec.createHTML()
+
+    return [('takePicture', takePicture), ('crop', crop), ('setLCD', setLCD),
+            ('adjustBrightness', adjustBrightness), ('getSpectrum', getSpectrum), ('plot', plot),
+            ('saveCSV', saveCSV), ('createHTML', createHTML)]
+
+#--------------------------------------------------------------------------------------
+def configure(spec, resolution, mode):
+    camera = spec.scamera.camera
+    camera.resolution = resolution
+    spec.captureMode = mode
+
+    # Crop around the light band, calibration lines at the wavelengths they have in the scene
+    width, height = resolution
+    low, high = camera.spectrum
+    spec.setCrop([0, int(camera.band[0] * height), width, int(camera.band[1] * height)])
+    spec.p_pix1.value = str(int(round((spec.waveL1 - low) / (high - low) * width)))
+    spec.p_pix2.value = str(int(round((spec.waveL2 - low) / (high - low) * width)))
+
+    return [int(v.value) for v in spec.p_crop]
+
+#--------------------------------------------------------------------------------------
+def measure(spec, resolution, mode, count, warmup=2):
+    c = configure(spec, resolution, mode)
+    times = {name: [] for name in STAGES + ['total']}
+    peaks = {name: 0 for name in STAGES}
+    label = '{}x{} {}'.format(resolution[0], resolution[1], mode)
+
+    for i in range(warmup + count):
+        total = 0.0
+        for name, func in stages(spec, c, 'bench-{}-{:03d}'.format(label.replace(' ', '-'), i)):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            total += elapsed
+            if i >= warmup:
+                times[name].append(elapsed)
+        if i >= warmup:
+            times['total'].append(total)
+
+    tracemalloc.start()
+    for name, func in stages(spec, c, 'bench-{}-memory'.format(label.replace(' ', '-'))):
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        peaks[name] = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    result = {}
+    for name, values in times.items():
+        t = 1000 * np.array(values)
+        result[name] = {'p50_ms': float(np.median(t)),
+                        'p90_ms': float(np.percentile(t, 90)),
+                        'p99_ms': float(np.percentile(t, 99)),
+                        'max_ms': float(t.max()),
+                        'peak_mb': peaks[name] / 1e6 if name in peaks else max(peaks.values()) / 1e6}
+
+    return label, result
+
+#--------------------------------------------------------------------------------------
+def report(label, result):
+    print(label)
+    for name, r in result.items():
+        print('  {:17s} p50 {:8.2f} ms  p90 {:8.2f} ms  p99 {:8.2f} ms  peak memory {:7.1f} MB'.format(
+              name, r['p50_ms'], r['p90_ms'], r['p99_ms'], r['peak_mb']))
+
+#--------------------------------------------------------------------------------------
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+#--------------------------------------------------------------------------------------
+def run(count=20, resolutions=RESOLUTIONS, modes=MODES):
+    root = os.getcwd()
+    work = tempfile.mkdtemp(prefix='bench-pipeline-')
+    results = {'commit': commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'count': count, 'results': {}}
+
+    from helpers.Spectrometer import Spectrometer     # Loads its images relative to the root
+
+    # Everything the Spectrometer writes (logbook, archive, catalog) goes to the temporary directory
+    for name in ('data', 'images'):
+        os.makedirs(os.path.join(work, 'docs', name))
+    for name in ('template.html', 'index-template.html'):
+        shutil.copy(os.path.join(root, 'docs', name), os.path.join(work, 'docs', name))
+    os.chdir(work)
+    spec = None
+    try:
+        spec = Spectrometer(lcd=True, neopixel=False, backend='sim')
+        spec.scamera.camera.noise = 0          # Same frame every shot, encoded by the camera once
+        spec.useDark = False
+        spec.m_name.value = 'Benchmark'
+        spec.m_light.value = 'CFL (simulated)'
+        for resolution in resolutions:
+            for mode in modes:
+                label, result = measure(spec, resolution, mode, count)
+                results['results'][label] = result
+                report(label, result)
+    finally:
+        if spec is not None:
+            spec.close()
+        os.chdir(root)
+        shutil.rmtree(work, ignore_errors=True)
+
+    return results
+
+#--------------------------------------------------------------------------------------
+def compare(old, new, tolerance=0.2, minimum=0.5):
+    # Median of every stage against the baseline. A stage regressed if it is more
+    # than tolerance slower and by at least minimum ms (timer noise on fast stages).
+    regressions = []
+    print('Compared with {} ({})'.format(old.get('commit'), old.get('created')))
+    for label, result in new['results'].items():
+        base = old['results'].get(label)
+        if base is None:
+            continue
+        print(label)
+        for name, r in result.items():
+            if name not in base:
+                continue
+            before, after = base[name]['p50_ms'], r['p50_ms']
+            ratio = after / before if before > 0 else float('inf')
+            flag = ''
+            if ratio > 1 + tolerance and after - before >= minimum:
+                flag = '  REGRESSION'
+                regressions.append((label, name, ratio))
+            print('  {:17s} {:8.2f} -> {:8.2f} ms  {:5.2f}x{}'.format(name, before, after, ratio, flag))
+
+    return regressions
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per stage latency and memory of a measurement')
+    parser.add_argument('--count', type=int, default=20, help='measurements per resolution and mode')
+    parser.add_argument('--modes', nargs='+', default=MODES, choices=['rgb', 'yuv', 'jpeg'])
+    parser.add_argument('--sensor-only', dest='stream', action='store_false',
+                        help='skip the 648x486 stream resolution')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, default 20%%')
+    args = parser.parse_args()
+
+    resolutions = RESOLUTIONS if args.stream else RESOLUTIONS[1:]
+    results = run(args.count, resolutions, args.modes)
+
+    if args.output:
+        with open(args.output, 'wt') as f:
+            json.dump(results, f, indent=1)
+    if args.compare:
+        with open(args.compare, 'rt') as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        sys.exit(1 if regressions else 0)
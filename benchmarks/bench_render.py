@@ -0,0 +1,64 @@
+#--------------------------------------------------------------------------------------
+# Benchmark - reused SpectrumRenderer against a new pyplot figure per spectrum
+#
+# Run from the repository root:  python -m benchmarks.bench_render
+#--------------------------------------------------------------------------------------
+
+import io
+import time
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from helpers.Plot import SpectrumRenderer
+
+#--------------------------------------------------------------------------------------
+def legacyPlot(wavelength, spectrum):
+    # The plot as runProcess made it before the SpectrumRenderer
+    fig, ax = plt.subplots()
+    ax.set_xlabel('Wavelength (nm)')
+    ax.set_xlim(auto=True)
+    ax.set_ylim(auto=True)
+    ax.plot(wavelength, spectrum, color='blue')
+    buf = io.BytesIO()
+    plt.savefig(buf, format='jpeg')
+    plt.close()
+
+    return buf.getvalue()
+
+#--------------------------------------------------------------------------------------
+def measure(name, func, spectra):
+    func(*spectra[0])                     # Warm up font caches etc.
+    tracemalloc.start()
+    times = []
+    for wavelength, spectrum in spectra:
+        start = time.perf_counter()
+        func(wavelength, spectrum)
+        times.append(time.perf_counter() - start)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    times = 1000 * np.array(times)
+    print('{:9s} median {:7.1f} ms  p90 {:7.1f} ms  peak memory {:6.1f} MB'.format(
+          name, np.median(times), np.percentile(times, 90), peak / 1e6))
+
+#--------------------------------------------------------------------------------------
+def run(count=30, width=648):
+    rng = np.random.default_rng(0)
+    wavelength = 400 + 0.5 * np.arange(width)
+    spectra = [(wavelength, rng.random(width) * 100) for i in range(count)]
+
+    renderer = SpectrumRenderer()
+    def reused(wavelength, spectrum):
+        renderer.update(wavelength, spectrum)
+        return renderer.render('jpeg')
+
+    measure('pyplot', legacyPlot, spectra)
+    measure('renderer', reused, spectra)
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,56 @@
+#--------------------------------------------------------------------------------------
+# Micro-benchmark - SpectrumEngine against the original getSpectrum
+#
+# Run from the repository root:  python -m benchmarks.bench_spectrum
+#--------------------------------------------------------------------------------------
+
+import timeit
+import numpy as np
+
+from helpers.Spectrum import SpectrumEngine
+
+#--------------------------------------------------------------------------------------
+def legacySpectrum(processed, wavelength1, wavelength2, pixel1, pixel2):
+    # getSpectrum as it was before the SpectrumEngine
+    spectrum = np.asarray(processed)
+    spectrum = np.average(spectrum, axis=(0,2))
+    spectrum = spectrum-(0.9*min(spectrum))
+
+    if (wavelength1 > wavelength2):
+        temp = wavelength1
+        wavelength1 = wavelength2
+        wavelength2 = temp
+
+    wavelength = np.arange(float(len(spectrum)))
+    factor = (wavelength2 - wavelength1) / (pixel2 - pixel1)
+    wavelength = wavelength1 + (wavelength - pixel1) * factor
+
+    return wavelength, spectrum
+
+#--------------------------------------------------------------------------------------
+def run(number=50):
+    rng = np.random.default_rng(0)
+    engine = SpectrumEngine()
+
+    for width, height in [(648, 486), (2592, 1944)]:
+        frame = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        crops = {'crop': [0, int(0.4*height), width, int(0.6*height)],
+                 'full': [0, 0, width, height]}
+
+        for name, c in crops.items():
+            processed = frame[c[1]:c[3], c[0]:c[2]]
+            cal = (544.0, 611.0, 0.19*width, 0.28*width)
+
+            w0, s0 = legacySpectrum(processed, *cal)
+            w1, s1 = engine.spectrum(frame, *cal, roi=c)
+            assert np.allclose(w0, w1) and np.allclose(s0, s1, rtol=1e-4)
+
+            t0 = min(timeit.repeat(lambda: legacySpectrum(processed, *cal), number=number, repeat=3)) / number
+            t1 = min(timeit.repeat(lambda: engine.spectrum(frame, *cal, roi=c), number=number, repeat=3)) / number
+
+            print('{}x{} {:4s} rows {:4d}: legacy {:8.3f} ms  engine {:8.3f} ms  speedup {:5.1f}x'.format(
+                  width, height, name, c[3]-c[1], 1000*t0, 1000*t1, t0/t1))
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,243 @@
+#--------------------------------------------------------------------------------------
+# Benchmark - streaming server under load, many viewers of the simulated camera
+#
+# Run from the repository root:
+#   python -m benchmarks.bench_streaming
+#   python -m benchmarks.bench_streaming --viewers 1 10 30 --kind web --fps 30
+#   python -m benchmarks.bench_streaming --viewers 10 --slow 3 --slow-rate 300
+#   python -m benchmarks.bench_streaming --viewers 0 --slow 5 --slow-rate 600 --fixed
+#
+# The server runs in this process, the viewers in a second one so that the CPU
+# time of this process is the server's (and the simulated encoder's). Latency is
+# the age of each video message when a viewer has read it, from its timestamp.
+# Slow viewers read at a fixed rate (kbit/s) with a small receive buffer, like a
+# tablet on weak Wi-Fi, and are reported separately. The bitrate of the encoder
+# at the end shows where the adaptive bitrate control went (--fixed turns it off).
+#--------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import base64
+import struct
+import socket
+import argparse
+import selectors
+import threading
+import multiprocessing
+
+import numpy as np
+
+PORTS = {'web': 14664, 'tcp': 14665}
+
+#--------------------------------------------------------------------------------------
+# Viewers
+#--------------------------------------------------------------------------------------
+class Viewer():
+    # One connection, enables the stream and counts the video messages it reads
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, kind, port, rate=None):
+        from streaming.proto import messages_pb2 as pb2
+        self.pb2 = pb2
+        self.kind = kind
+        self.buffer = bytearray()
+        self.upgraded = kind != 'web'
+        self.messages = 0
+        self.bytes = 0
+        self.latencies = []
+        self.rate = rate            # Bytes per second, None reads all there is
+        self.allowance = 0.0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rate:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16384)
+        self.sock.connect(('127.0.0.1', port))
+
+        request = pb2.ServerBound(stream_control=pb2.StreamControl(enabled=True)).SerializeToString()
+        if kind == 'web':
+            key = base64.b64encode(os.urandom(16)).decode('ascii')
+            self.sock.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nConnection: Upgrade\r\n'
+                               'Upgrade: websocket\r\nSec-WebSocket-Key: {}\r\n\r\n'.format(key)).encode('ascii'))
+            mask = os.urandom(4)
+            masked = bytes(b ^ mask[i % 4] for i, b in enumerate(request))
+            self.sock.sendall(bytes([0x82, 0x80 | len(request)]) + mask + masked)
+        else:
+            self.sock.sendall(struct.pack('!I', len(request)) + request)
+        self.sock.setblocking(False)
+
+    #----------------------------------------------------------------------------------
+    def read(self, record, limit=1 << 20):
+        try:
+            data = self.sock.recv(limit)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionError('Server closed the connection')
+        self.buffer.extend(data)
+        self.bytes += len(data)
+
+        if not self.upgraded:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                return
+            del self.buffer[:end + 4]
+            self.upgraded = True
+
+        now = int(time.monotonic() * 1000000)
+        for payload in self.frames():
+            message = self.pb2.ClientBound()
+            message.ParseFromString(payload)
+            if message.WhichOneof('message') == 'video':
+                self.messages += 1
+                if record:
+                    self.latencies.append(now - message.timestamp_us)
+
+    #----------------------------------------------------------------------------------
+    def throttled(self, record, dt):
+        self.allowance = min(self.allowance + self.rate * dt, self.rate)
+        if self.allowance >= 1:
+            before = self.bytes
+            self.read(record, int(self.allowance))
+            self.allowance -= self.bytes - before
+
+    #----------------------------------------------------------------------------------
+    def frames(self):
+        # Complete messages in the buffer, length prefixed (tcp) or WebSocket frames
+        buf, pos = self.buffer, 0
+        while True:
+            if self.kind == 'tcp':
+                if len(buf) - pos < 4:
+                    break
+                start, length = pos + 4, struct.unpack_from('!I', buf, pos)[0]
+            else:
+                if len(buf) - pos < 2:
+                    break
+                start, length = pos + 2, buf[pos + 1] & 0x7F
+                if length == 126:
+                    start, length = pos + 4, struct.unpack_from('!H', buf, pos + 2)[0] if len(buf) - pos >= 4 else None
+                elif length == 127:
+                    start, length = pos + 10, struct.unpack_from('!Q', buf, pos + 2)[0] if len(buf) - pos >= 10 else None
+                if length is None:
+                    break
+            if len(buf) < start + length:
+                break
+            yield bytes(buf[start:start + length])
+            pos = start + length
+        del buf[:pos]
+
+#--------------------------------------------------------------------------------------
+def watch(kind, count, slow, rate, seconds, warmup, conn):
+    # Runs in the viewer process, sends a summary back through conn. Slow viewers
+    # are not in the selector, they read their allowance every few milliseconds.
+    selector = selectors.DefaultSelector()
+    viewers = [Viewer(kind, PORTS[kind]) for i in range(count)]
+    slowViewers = [Viewer(kind, PORTS[kind], rate * 1000 / 8) for i in range(slow)]
+    for v in viewers:
+        selector.register(v.sock, selectors.EVENT_READ, v)
+
+    start = last = time.monotonic()
+    while time.monotonic() - start < warmup + seconds:
+        record = time.monotonic() - start > warmup
+        for key, events in selector.select(0.01 if slowViewers else 0.1):
+            key.data.read(record)
+        now = time.monotonic()
+        for v in slowViewers:
+            v.throttled(record, now - last)
+        last = now
+
+    conn.send({'fast': summary(viewers), 'slow': summary(slowViewers)})
+    for v in viewers + slowViewers:
+        v.sock.close()
+
+#--------------------------------------------------------------------------------------
+def summary(viewers):
+    latencies = [np.array(v.latencies, dtype=np.float64) for v in viewers]
+    return {'messages': [v.messages for v in viewers],
+            'bytes': sum(v.bytes for v in viewers),
+            'latency': np.concatenate(latencies) / 1000 if latencies else np.zeros(0)}
+
+#--------------------------------------------------------------------------------------
+def statistics(result, viewers, seconds):
+    latency = result['latency']
+    messages = np.array(result['messages'])
+    return {'viewers': viewers,
+            'messages': float(messages.mean()) if len(messages) else 0.0,
+            'starved': int((messages == 0).sum()),
+            'p50': float(np.median(latency)) if len(latency) else float('nan'),
+            'p99': float(np.percentile(latency, 99)) if len(latency) else float('nan'),
+            'mbps': 8 * result['bytes'] / seconds / 1e6}
+
+#--------------------------------------------------------------------------------------
+# Server
+#--------------------------------------------------------------------------------------
+def measure(count, kind='tcp', seconds=5.0, warmup=1.0, fps=30, bitrate=1000000, slow=0, rate=300,
+            adaptive=True):
+    from helpers.Devices import SimulatedCamera
+    from streaming.server import StreamingServer
+
+    camera = SimulatedCamera(framerate=fps)
+    server = StreamingServer(camera, bitrate=bitrate, tcp_port=PORTS['tcp'], web_port=PORTS['web'],
+                             annexb_port=PORTS['web'] + 2, adaptive_bitrate=adaptive)
+    time.sleep(0.2)
+    try:
+        context = multiprocessing.get_context('spawn')
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=watch, args=(kind, count, slow, rate, seconds, warmup, sender))
+        process.start()
+
+        time.sleep(warmup + 0.5)                      # Process start up and warm up
+        cpu, wall = time.process_time(), time.monotonic()
+        keyFrames = camera.encoders[1].keyFrames if 1 in camera.encoders else 0
+        threads = threading.active_count()
+        result = receiver.recv()
+        cpu, wall = time.process_time() - cpu, time.monotonic() - wall
+        keyFrames = (camera.encoders[1].keyFrames if 1 in camera.encoders else 0) - keyFrames
+        encoder = camera.encoders.get(1)
+        final = (encoder.bitrate, encoder.quantization) if encoder else (bitrate, 0)
+        process.join()
+    finally:
+        server.close()
+        camera.close()
+
+    fast = statistics(result['fast'], count, warmup + seconds)
+    fast.update(threads=threads, cpu=100 * cpu / wall, keys=keyFrames / wall,
+                bitrate=final[0] / 1e6, quantization=final[1])
+    return fast, statistics(result['slow'], slow, warmup + seconds) if slow else None
+
+#--------------------------------------------------------------------------------------
+def run(counts=(1, 10, 30), kind='tcp', seconds=5.0, fps=30, bitrate=1000000, slow=0, rate=300,
+        adaptive=True):
+    print('{} viewers, {} fps, {:.1f} Mbit/s {}, {:.0f} s'.format(
+          kind, fps, bitrate / 1e6, 'adaptive' if adaptive else 'fixed', seconds))
+    results = []
+    for count in counts:
+        fast, slowest = measure(count, kind, seconds, fps=fps, bitrate=bitrate, slow=slow, rate=rate,
+                                adaptive=adaptive)
+        results.append((fast, slowest))
+        print('{viewers:4d} viewers  threads {threads:4d}  server cpu {cpu:6.1f} %  '
+              'latency p50 {p50:7.2f} ms  p99 {p99:7.2f} ms  '
+              'video msgs/viewer {messages:7.1f}  starved {starved:3d}  {mbps:7.2f} Mbit/s  '
+              'key frames/s {keys:5.2f}  encoder {bitrate:5.2f} Mbit/s q {quantization}'.format(**fast))
+        if slowest:
+            print('{viewers:4d} slow     {pad:27s}  latency p50 {p50:7.0f} ms  p99 {p99:7.0f} ms  '
+                  'video msgs/viewer {messages:7.1f}  starved {starved:3d}  {mbps:7.2f} Mbit/s'.format(
+                  pad='({} kbit/s)'.format(rate), **slowest))
+
+    return results
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming server load test')
+    parser.add_argument('--viewers', type=int, nargs='+', default=[1, 10, 30])
+    parser.add_argument('--kind', choices=sorted(PORTS), default='tcp')
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--fps', type=float, default=30)
+    parser.add_argument('--bitrate', type=int, default=1000000)
+    parser.add_argument('--slow', type=int, default=0, help='slow viewers in addition')
+    parser.add_argument('--slow-rate', type=float, default=300, help='kbit/s of a slow viewer')
+    parser.add_argument('--fixed', dest='adaptive', action='store_false', help='no adaptive bitrate')
+    args = parser.parse_args()
+
+    run(args.viewers, args.kind, args.seconds, args.fps, args.bitrate, args.slow, args.slow_rate,
+        args.adaptive)
+    sys.exit(0)
@@ -0,0 +1,192 @@
+#--------------------------------------------------------------------------------------
+# Benchmark - streaming/websocket.py against the WsPacket of the old server
+#
+# Run from the repository root:  python -m benchmarks.bench_websocket
+#--------------------------------------------------------------------------------------
+
+import os
+import socket
+import struct
+import threading
+import timeit
+
+from itertools import cycle
+
+from streaming import websocket
+
+#--------------------------------------------------------------------------------------
+class LegacyPacket:
+    # WsProtoClient.WsPacket as it was before streaming/websocket.py
+    def __init__(self):
+        self.fin = True
+        self.opcode = 2
+        self.masked = False
+        self.mask = None
+        self.length = 0
+        self.payload = bytearray()
+
+    def append(self, data):
+        if self.masked:
+            data = bytes([c ^ k for c, k in zip(data, cycle(self.mask))])
+        self.payload.extend(data)
+
+    def serialize(self):
+        self.length = len(self.payload)
+        buf = bytearray()
+        b0 = 0
+        b1 = 0
+        if self.fin:
+            b0 |= 0x80
+        b0 |= self.opcode
+        buf.append(b0)
+        if self.length <= 125:
+            b1 |= self.length
+            buf.append(b1)
+        elif self.length >= 126 and self.length <= 65535:
+            b1 |= 126
+            buf.append(b1)
+            buf.extend(struct.pack('!H', self.length))
+        else:
+            b1 |= 127
+            buf.append(b1)
+            buf.extend(struct.pack('!Q', self.length))
+        if self.payload:
+            buf.extend(self.payload)
+        return bytes(buf)
+
+#--------------------------------------------------------------------------------------
+def masked(payload, mask, fin=True, opcode=2):
+    head = bytearray(websocket.header(len(payload), opcode, fin))
+    head[1] |= 0x80
+    return bytes(head) + mask + websocket.unmask(payload, mask)
+
+#--------------------------------------------------------------------------------------
+def rate(func, size, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    return size / seconds / 1e6
+
+#--------------------------------------------------------------------------------------
+def unmasking(sizes=(128, 4096, 65536, 1 << 20)):
+    print('Unmasking received payloads (MB/s)')
+    mask = os.urandom(4)
+    for size in sizes:
+        data = os.urandom(size)
+
+        def legacy():
+            packet = LegacyPacket()
+            packet.masked, packet.mask = True, mask
+            packet.append(data)
+            return bytes(packet.payload)
+
+        assert legacy() == websocket.unmask(data, mask)
+        number = max(1, (1 << 22) // size)
+        r0 = rate(legacy, size, max(1, number // 50))
+        r1 = rate(lambda: websocket.unmask(data, mask), size, number)
+        print('  {:8d} bytes: legacy {:9.1f}  bulk {:9.1f}  speedup {:7.1f}x'.format(size, r0, r1, r1 / r0))
+
+#--------------------------------------------------------------------------------------
+def sending(sizes=(4096, 65536, 1 << 20), total=64 << 20):
+    print('Sending frames over a socket pair (MB/s)')
+    for size in sizes:
+        payload = os.urandom(size)
+        count = total // size
+
+        def legacy(sock):
+            for i in range(count):
+                packet = LegacyPacket()
+                packet.append(payload)
+                sock.sendall(packet.serialize())
+
+        def scattered(sock):
+            for i in range(count):
+                bufs = [memoryview(b) for b in websocket.frame(payload)]
+                while bufs:
+                    sent = sock.sendmsg(bufs)
+                    while bufs and sent >= len(bufs[0]):
+                        sent -= len(bufs.pop(0))
+                    if sent:
+                        bufs[0] = bufs[0][sent:]
+
+        rates = []
+        for send in (legacy, scattered):
+            a, b = socket.socketpair()
+            expected = count * (size + len(websocket.header(size)))
+            reader = threading.Thread(target=drain, args=(b, expected))
+            reader.start()
+            rates.append(timed(send, a, reader, count * size))
+            a.close()
+            b.close()
+        print('  {:8d} bytes: legacy {:9.1f}  sendmsg {:9.1f}  speedup {:7.1f}x'.format(
+              size, rates[0], rates[1], rates[1] / rates[0]))
+
+#--------------------------------------------------------------------------------------
+def drain(sock, expected):
+    received = 0
+    while received < expected:
+        data = sock.recv(1 << 20)
+        if not data:
+            break
+        received += len(data)
+
+#--------------------------------------------------------------------------------------
+def timed(send, sock, reader, size):
+    start = timeit.default_timer()
+    send(sock)
+    reader.join()
+    return size / (timeit.default_timer() - start) / 1e6
+
+#--------------------------------------------------------------------------------------
+def joining(fragments=(4, 64, 1024), size=1 << 20):
+    print('Receiving a fragmented {} byte message (MB/s)'.format(size))
+    mask = os.urandom(4)
+    payload = os.urandom(size)
+    for count in fragments:
+        step = size // count
+        parts = [payload[i:i + step] for i in range(0, size, step)]
+        wire = b''.join(masked(p, mask, fin=i == len(parts) - 1, opcode=0 if i else 2)
+                        for i, p in enumerate(parts))
+
+        def legacy():
+            # Frames parsed as the old server did, payloads joined by extending a bytearray
+            pos, packets = 0, []
+            while True:
+                packet = LegacyPacket()
+                packet.fin, packet.masked = wire[pos] & 0x80 > 0, True
+                length = wire[pos + 1] & 0x7F
+                pos += 2
+                if length == 126:
+                    length = struct.unpack_from('!H', wire, pos)[0]
+                    pos += 2
+                elif length == 127:
+                    length = struct.unpack_from('!Q', wire, pos)[0]
+                    pos += 8
+                packet.mask = wire[pos:pos + 4]
+                packet.append(wire[pos + 4:pos + 4 + length])
+                pos += 4 + length
+                packets.append(packet)
+                if packet.fin:
+                    joined = bytearray()
+                    for p in packets:
+                        joined.extend(p.payload)
+                    return bytes(joined)
+
+        def decoded():
+            decoder = websocket.Decoder(max_message_size=size)
+            decoder.feed(wire)
+            return decoder.next()[1]
+
+        assert legacy() == payload and decoded() == payload
+        r0 = rate(legacy, size, 1)
+        r1 = rate(decoded, size, 20)
+        print('  {:5d} fragments: legacy {:9.1f}  decoder {:9.1f}  speedup {:7.1f}x'.format(
+              count, r0, r1, r1 / r0))
+
+#--------------------------------------------------------------------------------------
+def run():
+    unmasking()
+    sending()
+    joining()
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,171 @@
+#--------------------------------------------------------------------------------------
+# Spectrum archive - float32 spectra in one memory-mappable file per day
+#
+# Build archives from existing CSV files (metadata from the logbook) with
+#   python -m helpers.Archive import docs/data/spectrum-*.csv
+#--------------------------------------------------------------------------------------
+
+import os
+import csv
+import sys
+import json
+import threading
+import numpy as np
+
+from helpers.Logbook import Logbook
+
+#--------------------------------------------------------------------------------------
+# SpectrumArchive class
+#--------------------------------------------------------------------------------------
+class SpectrumArchive():
+    # spectra-<day>.f32 holds the raw float32 values, wavelength followed by
+    # intensity for every spectrum. spectra-<day>.jsonl has one line per
+    # spectrum with its offset, length and metadata. Data is written and synced
+    # before its index line, so a crash never leaves an entry without data.
+    # Reprocessed spectra are appended again, the last entry of a time wins.
+
+    metaKeys = ('time', 'shutter', 'mode', 'frames', 'crop', 'pixels', 'wavelengths', 'calibration',
+                'grid', 'scaleFactor')
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, directory='docs/data/archive'):
+        self.directory = directory
+        self.lock = threading.Lock()
+
+    #----------------------------------------------------------------------------------
+    def paths(self, day):
+        base = os.path.join(self.directory, 'spectra-' + day)
+        return base + '.f32', base + '.jsonl'
+
+    #----------------------------------------------------------------------------------
+    def append(self, meta, wavelength, spectrum):
+        day = meta['time'][:8]
+        data = np.concatenate([np.asarray(wavelength, dtype='<f4'), np.asarray(spectrum, dtype='<f4')])
+        entry = {k: meta.get(k) for k in self.metaKeys}
+
+        with self.lock:
+            os.makedirs(self.directory, exist_ok=True)
+            dpath, ipath = self.paths(day)
+            with open(dpath, 'ab') as f:
+                entry['offset'] = f.tell() // 4
+                entry['length'] = len(spectrum)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(ipath, 'at', encoding='utf-8') as f:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+        return entry
+
+    #----------------------------------------------------------------------------------
+    def days(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name[8:-6] for name in os.listdir(self.directory)
+                      if name.startswith('spectra-') and name.endswith('.jsonl'))
+
+    #----------------------------------------------------------------------------------
+    def entries(self, day):
+        entries = []
+        with open(self.paths(day)[1], 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    pass                         # Torn line from a crash
+        return entries
+
+    #----------------------------------------------------------------------------------
+    def load(self, days=None, latest=True):
+        # All spectra of the given days as 2D arrays (one row per spectrum). Rows
+        # shorter than the longest spectrum are padded with NaN.
+        days = self.days() if days is None else days
+        entries, wavelengths, intensities = [], [], []
+
+        for day in days:
+            found = self.entries(day)
+            if latest:
+                last = {e['time']: i for i, e in enumerate(found)}
+                found = [e for i, e in enumerate(found) if last[e['time']] == i]
+            if not found:
+                continue
+            data = np.memmap(self.paths(day)[0], dtype='<f4', mode='r')
+            offsets = np.array([e['offset'] for e in found])
+            lengths = np.array([e['length'] for e in found])
+            w, i = gather(data, offsets, lengths)
+            entries += found
+            wavelengths.append(w)
+            intensities.append(i)
+
+        if not entries:
+            return [], np.empty((0, 0), np.float32), np.empty((0, 0), np.float32)
+
+        width = max(w.shape[1] for w in wavelengths)
+        return entries, padStack(wavelengths, width), padStack(intensities, width)
+
+    #----------------------------------------------------------------------------------
+    def importCSV(self, fnames, logbook=None):
+        logbook = logbook or Logbook()
+        known = set(e['time'] for day in self.days() for e in self.entries(day))
+
+        count = 0
+        for fname in sorted(fnames):
+            time = os.path.basename(fname)[len('spectrum-'):-len('.csv')]
+            if time in known:
+                continue
+            meta = logbook.get(time) or {'time': time}
+            wavelength, spectrum = readCSV(fname)
+            self.append(meta, wavelength, spectrum)
+            count += 1
+
+        return count
+
+#--------------------------------------------------------------------------------------
+# Helpers
+#--------------------------------------------------------------------------------------
+def gather(data, offsets, lengths):
+    # One fancy index per day, no per spectrum Python loop over the values
+    width = lengths.max()
+    columns = np.arange(width)
+    valid = columns[None,:] < lengths[:,None]
+    index = np.where(valid, offsets[:,None] + columns[None,:], 0)
+    shift = np.where(valid, lengths[:,None], 0)
+
+    wavelength = np.where(valid, data[index], np.nan).astype(np.float32)
+    intensity  = np.where(valid, data[index + shift], np.nan).astype(np.float32)
+
+    return wavelength, intensity
+
+#--------------------------------------------------------------------------------------
+def padStack(arrays, width):
+    out = np.full((sum(a.shape[0] for a in arrays), width), np.nan, dtype=np.float32)
+    row = 0
+    for a in arrays:
+        out[row:row + a.shape[0], :a.shape[1]] = a
+        row += a.shape[0]
+
+    return out
+
+#--------------------------------------------------------------------------------------
+def saveCSV(fname, spectrum, wavelength):
+    with open(fname, 'w', encoding='UTF8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Wavelength","Intensity"])
+
+        for l,i in zip(wavelength, spectrum):
+            writer.writerow([l,i])
+
+#--------------------------------------------------------------------------------------
+def readCSV(fname):
+    data = np.loadtxt(fname, delimiter=',', skiprows=1, ndmin=2)
+
+    return data[:,0], data[:,1]
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[1] == 'import':
+        print('Imported {} spectra'.format(SpectrumArchive().importCSV(sys.argv[2:])))
+    else:
+        print('Usage: python -m helpers.Archive import <spectrum-*.csv> ..')
@@ -0,0 +1,164 @@
+#--------------------------------------------------------------------------------------
+# Batch reprocessing - new crop and calibration for saved raw images, no camera
+#
+#   python -m helpers.Batch --crop 850 1200 1900 1400 --pixels 402 603 docs/images/raw-*.jpg
+#
+# Parameters that are not given come from the logbook entry of each image. A
+# calibration profile (--profile, or the one recorded) replaces --pixels.
+#--------------------------------------------------------------------------------------
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PIL import Image
+
+from helpers.Spectrum import SpectrumEngine, normalizeBrightness
+from helpers.Plot import SpectrumRenderer
+from helpers.Logbook import Logbook
+from helpers.Archive import SpectrumArchive, saveCSV
+from helpers.Catalog import Catalog
+from helpers.Calibration import CalibrationProfile, CalibrationStore
+from helpers.Writer import saveImage, writeBytes
+
+#--------------------------------------------------------------------------------------
+# BatchWorker class
+#--------------------------------------------------------------------------------------
+class BatchWorker():
+    # One per process, engine and renderer are reused for all files of the process
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, directory='docs', pages=True):
+        self.directory = directory
+        self.pages     = pages
+        self.engine    = SpectrumEngine()
+        self.renderer  = SpectrumRenderer()
+        self.logbook   = Logbook(directory)
+
+    #----------------------------------------------------------------------------------
+    def process(self, fname, params):
+        start = time.monotonic()
+        stamp = os.path.basename(fname)[len('raw-'):-len('.jpg')]
+
+        meta = self.logbook.get(stamp) or {'time': stamp}
+        meta.pop('seq', None)
+        if params.get('pixels') is not None:
+            meta['calibration'] = None               # New line positions, back to two lines
+        meta.update((k, v) for k, v in params.items() if v is not None)
+        required = ('crop',) if meta.get('calibration') else ('crop', 'pixels', 'wavelengths')
+        for key in required:
+            if meta.get(key) is None:
+                raise ValueError('No {} given and none in the logbook'.format(key))
+
+        c = meta['crop']
+        with Image.open(fname) as img:
+            raw = np.asarray(img.convert('RGB'))
+        if raw[c[1]:c[3], c[0]:c[2]].size == 0:
+            raise ValueError('Crop {} outside the {}x{} image'.format(c, raw.shape[1], raw.shape[0]))
+        processed, meta['scaleFactor'] = normalizeBrightness(raw[c[1]:c[3], c[0]:c[2]])
+        if meta.get('calibration'):
+            spectrum = self.engine.reduce(processed)
+            profile = CalibrationProfile.fromDict(meta['calibration'])
+            wavelength = self.engine.profileAxis(len(spectrum), profile, c[0])
+        else:
+            wavelength, spectrum = self.engine.spectrum(processed, meta['wavelengths'][0], meta['wavelengths'][1],
+                                                        meta['pixels'][0], meta['pixels'][1])
+        if meta.get('grid'):
+            wavelength, spectrum = self.engine.resample(spectrum, wavelength, *meta['grid'])
+
+        self.renderer.update(wavelength, spectrum)
+        images = os.path.join(self.directory, 'images')
+        saveImage(os.path.join(images, 'processed-' + stamp + '.jpg'), processed)
+        writeBytes(os.path.join(images, 'spectrum-' + stamp + '.jpg'), self.renderer.render('jpeg'))
+        saveCSV(os.path.join(self.directory, 'data', 'spectrum-' + stamp + '.csv'), spectrum, wavelength)
+        if self.pages and 'name' in meta:
+            self.logbook.writeExperiment(meta)
+            self.logbook.update(meta)
+
+        return meta, wavelength, spectrum, time.monotonic() - start
+
+#--------------------------------------------------------------------------------------
+# Process pool
+#--------------------------------------------------------------------------------------
+worker = None
+
+def initWorker(directory, pages):
+    global worker
+    worker = BatchWorker(directory, pages)
+
+def processFile(fname, params):
+    return worker.process(fname, params)
+
+#--------------------------------------------------------------------------------------
+def reprocess(fnames, crop=None, pixels=None, wavelengths=None, directory='docs', workers=None,
+              pages=True, archive=True, profile=None, grid=None, report=print):
+    # Spectra are archived and cataloged here in the parent, the workers only write
+    # their own files
+    params  = {'crop': crop, 'pixels': pixels, 'wavelengths': wavelengths, 'grid': grid,
+               'calibration': profile.toDict() if profile is not None else None}
+    store   = SpectrumArchive(os.path.join(directory, 'data', 'archive')) if archive else None
+    catalog = Catalog(os.path.join(directory, 'catalog.sqlite'))
+    timings = []
+    failed  = []
+    start   = time.monotonic()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker,
+                             initargs=(directory, pages)) as pool:
+        jobs = {pool.submit(processFile, fname, params): fname for fname in fnames}
+        for n, job in enumerate(as_completed(jobs), 1):
+            fname = jobs[job]
+            try:
+                meta, wavelength, spectrum, seconds = job.result()
+            except Exception as e:
+                failed.append((fname, e))
+                report('[{}/{}] {} failed: {}'.format(n, len(jobs), fname, e))
+                continue
+            if store is not None:
+                store.append(meta, wavelength, spectrum)
+            catalog.add(meta, wavelength, spectrum)
+            timings.append(seconds)
+            report('[{}/{}] {} {:.2f} s'.format(n, len(jobs), fname, seconds))
+
+    catalog.close()
+    elapsed = time.monotonic() - start
+    if timings:
+        t = np.array(timings)
+        report('{} files in {:.1f} s ({:.1f} files/s), per file median {:.2f} s, '
+               'p95 {:.2f} s, max {:.2f} s, {} failed'.format(len(t), elapsed, len(t) / elapsed,
+               np.median(t), np.percentile(t, 95), t.max(), len(failed)))
+    else:
+        report('No files processed, {} failed'.format(len(failed)))
+
+    return timings, failed
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reprocess saved raw images with new parameters')
+    parser.add_argument('files', nargs='+', help='raw-<time>.jpg files')
+    parser.add_argument('--crop', type=int, nargs=4, metavar=('X1', 'Y1', 'X2', 'Y2'))
+    parser.add_argument('--pixels', type=float, nargs=2, metavar=('P1', 'P2'),
+                        help='calibration line positions in the cropped image')
+    parser.add_argument('--wavelengths', type=float, nargs=2, metavar=('WL1', 'WL2'),
+                        help='wavelengths of the calibration lines in nm')
+    parser.add_argument('--profile', help='calibration profile name, e.g. current')
+    parser.add_argument('--grid', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'),
+                        help='resample onto a uniform wavelength grid (nm)')
+    parser.add_argument('--workers', type=int, help='processes, default all cores')
+    parser.add_argument('--directory', default='docs')
+    parser.add_argument('--no-pages', dest='pages', action='store_false',
+                        help='do not rewrite experiment pages and logbook entries')
+    parser.add_argument('--no-archive', dest='archive', action='store_false')
+    args = parser.parse_args()
+
+    profile = None
+    if args.profile:
+        profile = CalibrationStore().load(args.profile)
+        if profile is None:
+            parser.error('No calibration profile ' + args.profile)
+
+    timings, failed = reprocess(args.files, args.crop, args.pixels, args.wavelengths, args.directory,
+                                args.workers, args.pages, args.archive, profile, args.grid)
+    sys.exit(1 if failed else 0)
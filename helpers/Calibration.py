@@ -0,0 +1,390 @@
+#--------------------------------------------------------------------------------------
+# Calibration - wavelength calibration from the emission lines of a reference lamp
+#--------------------------------------------------------------------------------------
+
+import os
+import json
+import time
+import numpy as np
+
+from numpy.polynomial import polynomial
+
+from helpers.Spectrum import findPeaks
+from helpers.Logbook import writeAtomic
+
+#--------------------------------------------------------------------------------------
+# Emission lines of a compact fluorescent lamp (nm) - mercury plus the terbium and
+# europium phosphors. The strong ones are resolved by the spectrometer and used for
+# matching; 542.4/546.5 and 577.7/580.2 blend into one peak each.
+#--------------------------------------------------------------------------------------
+CFL_LINES = [
+    (405.4, 'Hg', True),
+    (436.6, 'Hg', True),
+    (487.7, 'Tb', True),
+    (542.4, 'Tb', False),
+    (546.5, 'Hg', True),
+    (577.7, 'Hg', False),
+    (580.2, 'Hg', True),
+    (584.0, 'Tb', False),
+    (587.6, 'Tb', True),
+    (593.4, 'Eu', False),
+    (599.7, 'Eu', False),
+    (611.6, 'Eu', True),
+    (625.7, 'Tb', False),
+    (631.1, 'Eu', True),
+    (650.8, 'Eu', False),
+    (662.6, 'Eu', False),
+    (687.7, 'Eu', False),
+    (710.7, 'Eu', True),
+]
+
+CFL_STRONG = [wl for wl, element, strong in CFL_LINES if strong]
+
+#--------------------------------------------------------------------------------------
+# CalibrationProfile class
+#--------------------------------------------------------------------------------------
+class CalibrationProfile():
+    # Dispersion through N reference lines, the wavelength of each camera frame
+    # column. 'polynomial' is a least squares fit, wavelength = c0 + c1 * column
+    # + c2 * column^2 .., 'spline' a natural cubic spline through the lines that
+    # continues linearly beyond them. Columns are frame columns, so a profile stays
+    # valid when the crop changes or the spectrum comes from the Bayer planes.
+    # The wavelength of every column is computed once into a lookup table, the
+    # axis of a spectrum is then a slice of it.
+
+    size = 4096                  # Columns in the lookup table, enough for every sensor
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, coefficients=(), matches=(), rms=None, name='', created=None, kind='polynomial'):
+        self.kind    = kind
+        self.coefficients = [float(c) for c in coefficients]
+        self.matches = sorted(tuple(m) for m in matches)    # (column, wavelength) reference lines
+        self.rms     = rms
+        self.name    = name
+        self.created = created or time.strftime("%Y%m%d-%H%M%S")
+        self.lut     = None
+
+        if kind == 'spline':
+            if len(self.matches) < 3:
+                raise ValueError('A spline needs at least 3 reference lines')
+            self.knots, self.values = np.array(self.matches, dtype=np.float64).T
+            self.moments = splineMoments(self.knots, self.values)
+        elif kind != 'polynomial':
+            raise ValueError('Unknown calibration kind: %s' % kind)
+
+    #----------------------------------------------------------------------------------
+    @classmethod
+    def fit(cls, lines, kind='polynomial', degree=2, name=''):
+        # Profile through N (column, wavelength) reference lines, e.g. typed in by hand
+        x, y = np.array(sorted(lines), dtype=np.float64).reshape(-1, 2).T
+        if len(x) < 2:
+            raise ValueError('Need at least 2 reference lines')
+        if kind == 'spline':
+            return cls((), lines, 0.0, name, kind=kind)
+
+        coefficients = polynomial.polyfit(x, y, min(degree, len(x) - 1))
+        rms = float(np.sqrt(np.mean((polynomial.polyval(x, coefficients) - y)**2)))
+        return cls(coefficients, lines, rms, name)
+
+    #----------------------------------------------------------------------------------
+    def key(self):
+        return (self.kind, tuple(self.coefficients), tuple(self.matches))
+
+    #----------------------------------------------------------------------------------
+    def evaluate(self, columns):
+        columns = np.asarray(columns, dtype=np.float64)
+        if self.kind == 'polynomial':
+            return polynomial.polyval(columns, self.coefficients)
+        return splineEval(self.knots, self.values, self.moments, columns)
+
+    #----------------------------------------------------------------------------------
+    def table(self):
+        if self.lut is None:
+            lut = self.evaluate(np.arange(float(self.size)))
+            lut.flags.writeable = False
+            self.lut = lut
+        return self.lut
+
+    #----------------------------------------------------------------------------------
+    def wavelength(self, columns):
+        columns = np.asarray(columns)
+        if columns.dtype.kind in 'iu' and (columns.size == 0 or
+                                           (columns.min() >= 0 and columns.max() < self.size)):
+            return self.table()[columns]
+        return self.evaluate(columns)
+
+    #----------------------------------------------------------------------------------
+    def axis(self, width, offset=0, scale=1.0):
+        # Wavelengths of width spectrum samples from frame column offset on, scale
+        # samples per column. Whole column steps are a slice of the table.
+        step = 1.0 / scale
+        end = offset + (width - 1) * step
+        if step == int(step) and offset == int(offset) and 0 <= offset and end < self.size:
+            return self.table()[int(offset):int(end) + 1:int(step)]
+        return self.evaluate(offset + np.arange(float(width)) * step)
+
+    #----------------------------------------------------------------------------------
+    def column(self, wavelength):
+        # Inverse of the dispersion, by interpolation in the lookup table
+        wavelengths = self.table()
+        columns = np.arange(float(self.size))
+        if wavelengths[-1] < wavelengths[0]:
+            columns, wavelengths = columns[::-1], wavelengths[::-1]
+
+        return np.interp(wavelength, wavelengths, columns)
+
+    #----------------------------------------------------------------------------------
+    def toDict(self):
+        return {'name': self.name, 'created': self.created, 'kind': self.kind,
+                'coefficients': self.coefficients, 'matches': [list(m) for m in self.matches],
+                'rms': self.rms}
+
+    #----------------------------------------------------------------------------------
+    @classmethod
+    def fromDict(cls, data):
+        if isinstance(data, (list, tuple)):      # Bare polynomial coefficients
+            return cls(data)
+        return cls(data.get('coefficients', ()), data.get('matches', ()), data.get('rms'),
+                   data.get('name', ''), data.get('created'), data.get('kind', 'polynomial'))
+
+#--------------------------------------------------------------------------------------
+def splineMoments(x, y):
+    # Second derivatives of the natural cubic spline through the points
+    n = len(x)
+    h = np.diff(x)
+    a = np.zeros((n, n))
+    r = np.zeros(n)
+    a[0, 0] = a[-1, -1] = 1.0
+    i = np.arange(1, n - 1)
+    a[i, i - 1] = h[:-1]
+    a[i, i] = 2 * (h[:-1] + h[1:])
+    a[i, i + 1] = h[1:]
+    r[i] = 6 * ((y[2:] - y[1:-1]) / h[1:] - (y[1:-1] - y[:-2]) / h[:-1])
+
+    return np.linalg.solve(a, r)
+
+#--------------------------------------------------------------------------------------
+def splineEval(x, y, m, t):
+    k = np.clip(np.searchsorted(x, t) - 1, 0, len(x) - 2)
+    h = x[k + 1] - x[k]
+    d = np.clip(t, x[0], x[-1]) - x[k]
+    slope = (y[k + 1] - y[k]) / h - h * (2 * m[k] + m[k + 1]) / 6
+    value = y[k] + d * (slope + d * (m[k] / 2 + d * (m[k + 1] - m[k]) / (6 * h)))
+
+    # Straight on beyond the outer lines, with the slope at the ends
+    first = (y[1] - y[0]) / (x[1] - x[0]) - (x[1] - x[0]) * (2 * m[0] + m[1]) / 6
+    last = (y[-1] - y[-2]) / (x[-1] - x[-2]) + (x[-1] - x[-2]) * (m[-2] + 2 * m[-1]) / 6
+    value = np.where(t < x[0], y[0] + (t - x[0]) * first, value)
+    value = np.where(t > x[-1], y[-1] + (t - x[-1]) * last, value)
+
+    return value
+
+#--------------------------------------------------------------------------------------
+# CalibrationStore class
+#--------------------------------------------------------------------------------------
+class CalibrationStore():
+    # Profiles are small JSON files, current.json is the one used at start up
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, directory='calibrations'):
+        self.directory = directory
+
+    #----------------------------------------------------------------------------------
+    def path(self, name):
+        return os.path.join(self.directory, name + '.json')
+
+    #----------------------------------------------------------------------------------
+    def save(self, profile, current=True):
+        text = json.dumps(profile.toDict(), indent=1)
+        writeAtomic(self.path(profile.name or profile.created), text)
+        if current:
+            writeAtomic(self.path('current'), text)
+
+    #----------------------------------------------------------------------------------
+    def load(self, name='current'):
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rt', encoding='utf-8') as f:
+            return CalibrationProfile.fromDict(json.load(f))
+
+    #----------------------------------------------------------------------------------
+    def names(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(n[:-5] for n in os.listdir(self.directory) if n.endswith('.json'))
+
+#--------------------------------------------------------------------------------------
+# Auto calibration
+#--------------------------------------------------------------------------------------
+def centroidPeaks(spectrum, peaks, half=2):
+    # Sub-pixel peak positions, centre of mass of 2*half+1 samples above the local
+    # minimum. Unlike a parabola this also works for flat topped, saturated lines.
+    s = np.asarray(spectrum, dtype=np.float64)
+    window = np.clip(np.asarray(peaks)[:,None] + np.arange(-half, half + 1), 0, len(s) - 1)
+    values = s[window]
+    weights = values - values.min(axis=1, keepdims=True)
+    total = weights.sum(axis=1)
+
+    return np.where(total > 0, (weights * window).sum(axis=1) / np.where(total > 0, total, 1), peaks)
+
+#--------------------------------------------------------------------------------------
+def matchLines(columns, lines, tolerance=3.0, dispersion=(0.05, 5.0), wavelengths=(300.0, 1100.0),
+               candidates=10, extent=None, orientation=None):
+    # Linear maps that put the most peaks within tolerance nm of a reference line,
+    # best first as (c0, c1, lines matched). Every pair of peaks against every
+    # pair of lines is one hypothesis, all of them are scored at once. The map of
+    # the extent (first and last column, by default those of the peaks) has to
+    # stay within wavelengths. orientation 1 only tries wavelengths rising with the
+    # column, -1 falling ones, None both.
+    columns = np.asarray(columns, dtype=np.float64)
+    lines = np.sort(np.asarray(lines, dtype=np.float64))
+
+    i, j = np.triu_indices(len(columns), 1)
+    a, b = np.triu_indices(len(lines), 1)
+    ci, cj = columns[i][:,None], columns[j][:,None]
+    la, lb = lines[a][None,:], lines[b][None,:]
+
+    # Both orientations, the spectrum may run from red to blue
+    slope = np.concatenate([((lb - la) / (cj - ci)).ravel(), ((la - lb) / (cj - ci)).ravel()])
+    intercept = np.concatenate([(la - ci * (lb - la) / (cj - ci)).ravel(),
+                                (lb - ci * (la - lb) / (cj - ci)).ravel()])
+
+    low, high = extent if extent is not None else (columns.min(), columns.max())
+    edges = np.stack([intercept + slope * low, intercept + slope * high])
+    ok = ((np.abs(slope) >= dispersion[0]) & (np.abs(slope) <= dispersion[1]) &
+          (edges.min(axis=0) >= wavelengths[0]) & (edges.max(axis=0) <= wavelengths[1]))
+    if orientation:
+        ok &= np.sign(slope) == np.sign(orientation)
+    slope, intercept = slope[ok], intercept[ok]
+    if len(slope) == 0:
+        return []
+
+    nearest, distance = nearestLines(intercept[:,None] + slope[:,None] * columns[None,:], lines)
+    inliers = distance <= tolerance
+    error = np.where(inliers, distance, 0).sum(axis=1)
+
+    # Score by matched lines, several peaks next to one line only count once
+    hits = np.zeros((len(slope), len(lines)), dtype=bool)
+    rows = np.broadcast_to(np.arange(len(slope))[:,None], nearest.shape)
+    hits[rows[inliers], nearest[inliers]] = True
+    count = hits.sum(axis=1)
+
+    # Many hypotheses are the same map, keep the best of each peak to line assignment
+    order = np.lexsort((error, -count))
+    assignment = np.where(inliers, nearest, -1)[order]
+    unique, first = np.unique(assignment, axis=0, return_index=True)
+    best = order[np.sort(first)][:candidates]
+
+    return [(intercept[k], slope[k], int(count[k])) for k in best]
+
+#--------------------------------------------------------------------------------------
+def nearestLines(wavelengths, lines):
+    # Index of and distance to the closest of the sorted lines
+    pos = np.clip(np.searchsorted(lines, wavelengths), 1, len(lines) - 1)
+    left = np.abs(wavelengths - lines[pos - 1])
+    right = np.abs(wavelengths - lines[pos])
+    nearest = np.where(left <= right, pos - 1, pos)
+
+    return nearest, np.minimum(left, right)
+
+#--------------------------------------------------------------------------------------
+def pairLines(columns, predicted, lines, tolerance):
+    # (column, line) pairs, every line used at most once by its closest peak
+    lines = np.asarray(lines, dtype=np.float64)
+    nearest = np.abs(predicted[:,None] - lines[None,:]).argmin(axis=1)
+    distance = np.abs(predicted - lines[nearest])
+
+    pairs = {}
+    for k in np.argsort(distance):
+        if distance[k] <= tolerance and nearest[k] not in pairs:
+            pairs[nearest[k]] = (float(columns[k]), float(lines[nearest[k]]))
+
+    return sorted(pairs.values())
+
+#--------------------------------------------------------------------------------------
+def autoCalibrate(spectrum, columns=None, lines=CFL_STRONG, degree=2, tolerance=4.0,
+                  threshold=0.05, count=12, smooth=5, reference=None, kind='polynomial', name='',
+                  orientation=1, wavelengths=(350.0, 800.0), span=(150.0, 450.0), minimum=5):
+    # Calibration profile from the spectrum of a reference lamp. columns are the
+    # frame columns of the spectrum samples, by default their index. Peaks are
+    # found on a box smoothed copy, so noise on a blended line is not a peak.
+    # The lines of a CFL are nearly evenly spaced and almost mirror symmetric, so
+    # a map shifted by one line, squeezed onto the crowded red lines or running
+    # the wrong way can match as many lines as the right one. Only maps running
+    # in orientation (1 blue to red with the column, -1 red to blue, None either),
+    # with the whole spectrum within wavelengths (the visible range) and spanning
+    # span nm are tried. The best linear maps are refined, the one covering most
+    # of the line list wins: most lines paired with a peak, then most reference
+    # lines explained (all CFL lines by default), then the widest range between
+    # the outer lines. Fewer than minimum matched lines is no calibration, a CFL
+    # shows at least five of its strong lines over the visible range, other light
+    # sources can pair three or four peaks with lines by chance. With
+    # kind='spline' the matched lines are then splined.
+    s = np.asarray(spectrum, dtype=np.float64)
+    if columns is None:
+        columns = np.arange(float(len(s)))
+    columns = np.asarray(columns, dtype=np.float64)
+
+    smoothed = np.convolve(s, np.ones(smooth) / smooth, mode='same') if smooth > 1 else s
+    peaks = findPeaks(smoothed, threshold, count, distance=max(smooth, 3))
+    if len(peaks) < 2:
+        raise ValueError('Found {} emission lines, need at least 2'.format(len(peaks)))
+    found = np.interp(centroidPeaks(s, peaks), np.arange(len(s)), columns)
+
+    if reference is None:
+        reference = [wl for wl, element, strong in CFL_LINES]
+
+    extent = np.array([columns.min(), columns.max()])
+    width = extent[1] - extent[0]
+    dispersion = (span[0] / width, span[1] / width)
+
+    best = None
+    for c0, c1, matched in matchLines(found, lines, tolerance, dispersion, wavelengths,
+                                      extent=extent, orientation=orientation):
+        if matched < 2:
+            continue
+        coefficients, pairs, rms = refineFit(found, [c0, c1], lines, degree, tolerance)
+        if not plausible(coefficients, extent, wavelengths, span, orientation):
+            continue
+        matches = [wl for column, wl in pairs]
+        predicted = polynomial.polyval(found, coefficients)
+        score = (len(pairs), len(pairLines(found, predicted, reference, tolerance / 2)),
+                 max(matches) - min(matches), -rms)
+        if best is None or score > best[0]:
+            best = (score, coefficients, pairs, rms)
+
+    if best is None:
+        raise ValueError('Emission lines do not match the reference lines')
+    if len(best[2]) < minimum:
+        raise ValueError('Matched {} reference lines, need at least {}'.format(len(best[2]), minimum))
+
+    if kind == 'spline' and len(best[2]) >= 3:
+        return CalibrationProfile.fit(best[2], 'spline', name=name)
+    return CalibrationProfile(best[1], best[2], best[3], name)
+
+#--------------------------------------------------------------------------------------
+def plausible(coefficients, extent, wavelengths, span, orientation=None):
+    # Wavelengths over the columns of extent within the given range, spanning
+    # span nm, strictly rising or falling (in orientation if given)
+    values = polynomial.polyval(np.linspace(extent[0], extent[1], 16), coefficients)
+    steps = np.diff(values)
+    if orientation:
+        steps = steps * np.sign(orientation)
+    elif steps[0] < 0:
+        steps = -steps
+
+    return bool(values.min() >= wavelengths[0] and values.max() <= wavelengths[1] and
+                span[0] <= abs(values[-1] - values[0]) <= span[1] and np.all(steps > 0))
+
+#--------------------------------------------------------------------------------------
+def refineFit(columns, coefficients, lines, degree, tolerance):
+    # Polynomial fit to the paired lines, a better fit may pair up more lines
+    for _ in range(3):
+        pairs = pairLines(columns, polynomial.polyval(columns, coefficients), lines, tolerance)
+        x, y = np.array(pairs).T
+        # One point more than coefficients, so the fit can not just pass through them
+        coefficients = polynomial.polyfit(x, y, max(min(degree, len(pairs) - 2), 1))
+
+    rms = float(np.sqrt(np.mean((polynomial.polyval(x, coefficients) - y)**2)))
+    return coefficients, pairs, rms
@@ -0,0 +1,325 @@
+#--------------------------------------------------------------------------------------
+# Capture helpers - unencoded camera frames straight into NumPy buffers
+#--------------------------------------------------------------------------------------
+
+import io
+import struct
+import numpy as np
+
+#--------------------------------------------------------------------------------------
+# FrameBuffer class
+#--------------------------------------------------------------------------------------
+class FrameBuffer():
+    # The camera pads unencoded frames to multiples of 32 columns and 16 rows.
+    # The buffer is allocated once and the camera writes into it for every shot,
+    # 'array' is a view of the visible (unpadded) part of the frame.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, resolution, format='rgb'):
+        width, height = resolution
+        self.format     = format
+        self.resolution = (width, height)
+        self.fwidth     = (width + 31) // 32 * 32
+        self.fheight    = (height + 15) // 16 * 16
+
+        if format == 'rgb':
+            size = self.fwidth * self.fheight * 3
+        elif format == 'yuv':
+            size = self.fwidth * self.fheight * 3 // 2   # Y plane, quarter size U and V planes
+        else:
+            raise ValueError('Unsupported capture format: %s' % format)
+
+        self.buffer = np.empty(size, dtype=np.uint8)
+        self.view   = memoryview(self.buffer)
+        self.pos    = 0
+
+        if format == 'rgb':
+            self.array = self.buffer.reshape(self.fheight, self.fwidth, 3)[:height, :width]
+        else:
+            luma = self.buffer[:self.fwidth * self.fheight]
+            self.array = luma.reshape(self.fheight, self.fwidth, 1)[:height, :width]
+
+    #----------------------------------------------------------------------------------
+    def write(self, data):
+        n = len(data)
+        end = self.pos + n
+        if end > len(self.buffer):
+            raise IOError('Frame larger than buffer (%d > %d bytes)' % (end, len(self.buffer)))
+        self.view[self.pos:end] = data
+        self.pos = end
+        return n
+
+    #----------------------------------------------------------------------------------
+    def flush(self):
+        pass
+
+    #----------------------------------------------------------------------------------
+    def reset(self):
+        self.pos = 0
+
+    #----------------------------------------------------------------------------------
+    def matches(self, resolution, format):
+        return self.resolution == tuple(resolution) and self.format == format
+
+    #----------------------------------------------------------------------------------
+    def capture(self, camera, use_video_port=False):
+        self.reset()
+        camera.capture(self, format=self.format, use_video_port=use_video_port)
+        if self.pos != len(self.buffer):
+            raise IOError('Incomplete frame (%d of %d bytes)' % (self.pos, len(self.buffer)))
+
+        return self.array
+
+#--------------------------------------------------------------------------------------
+# Raw Bayer capture
+#--------------------------------------------------------------------------------------
+# Size of the raw block the firmware appends to a JPEG captured with bayer=True
+BAYER_SIZES = {
+    'ov5647': 6404096,
+    'imx219': 10270208,
+}
+
+# (row, column) offsets of the R, G, G and B sites for each header bayer_order
+BAYER_OFFSETS = {
+    0: ((0, 0), (1, 0), (0, 1), (1, 1)),   # RGGB
+    1: ((1, 0), (0, 0), (1, 1), (0, 1)),   # GBRG
+    2: ((1, 1), (0, 1), (1, 0), (0, 0)),   # BGGR
+    3: ((0, 1), (1, 1), (0, 0), (1, 0)),   # GRBG
+}
+
+BAYER_HEADER_OFFSET = 176
+BAYER_HEADER        = '<32sHHHH24sHHBB'
+BAYER_DATA_OFFSET   = 32768
+
+#--------------------------------------------------------------------------------------
+class BayerFrame():
+    # Parses the raw block of a bayer=True capture into a uint16 array that is
+    # reused between shots. Every 5 bytes of a row hold 4 pixels, the 5th byte
+    # carrying the two low bits of each.
+
+    raw   = None
+    order = 0
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, revision='ov5647'):
+        if revision not in BAYER_SIZES:
+            raise ValueError('No raw Bayer layout known for camera %s' % revision)
+        self.revision = revision
+        self.size = BAYER_SIZES[revision]
+        self.stream = io.BytesIO()
+
+    #----------------------------------------------------------------------------------
+    def capture(self, camera):
+        self.stream.seek(0)
+        self.stream.truncate()
+        camera.capture(self.stream, format='jpeg', bayer=True)
+
+        return self.parse(self.stream.getbuffer())
+
+    #----------------------------------------------------------------------------------
+    def jpeg(self):
+        # The JPEG in front of the raw block, saved as the raw image of the logbook
+        buf = self.stream.getbuffer()
+        return bytes(buf[:len(buf) - self.size])
+
+    #----------------------------------------------------------------------------------
+    def parse(self, data):
+        if len(data) < self.size:
+            raise IOError('Capture holds no raw Bayer data')
+        block = np.frombuffer(data, dtype=np.uint8, offset=len(data) - self.size)
+        if block[:4].tobytes() != b'BRCM':
+            raise IOError('Raw Bayer data not found')
+
+        header = struct.unpack_from(BAYER_HEADER, block, BAYER_HEADER_OFFSET)
+        width, height = header[1], header[2]
+        self.order = header[8]
+
+        stride = (width * 5 // 4 + 31) // 32 * 32
+        packed = block[BAYER_DATA_OFFSET:BAYER_DATA_OFFSET + stride * height].reshape(height, stride)
+
+        if self.raw is None or self.raw.shape != (height, width):
+            self.raw = np.empty((height, width), dtype=np.uint16)
+        unpack10(packed, width, self.raw)
+
+        return self.raw
+
+    #----------------------------------------------------------------------------------
+    def planes(self, rotation=0):
+        return bayerPlanes(self.raw, self.order, rotation)
+
+#--------------------------------------------------------------------------------------
+def unpack10(packed, width, out):
+    data = packed[:, :width * 5 // 4].reshape(packed.shape[0], width // 4, 5)
+    pix  = out.reshape(packed.shape[0], width // 4, 4)
+    low  = data[:,:,4]
+
+    for i in range(4):
+        np.left_shift(data[:,:,i], 2, out=pix[:,:,i], dtype=np.uint16)
+        pix[:,:,i] |= (low >> (2 * i)) & 3
+
+    return out
+
+#--------------------------------------------------------------------------------------
+def pack10(raw):
+    height, width = raw.shape
+    stride = (width * 5 // 4 + 31) // 32 * 32
+    packed = np.zeros((height, stride), dtype=np.uint8)
+    data = packed[:, :width * 5 // 4].reshape(height, width // 4, 5)
+    pix  = raw.reshape(height, width // 4, 4)
+
+    for i in range(4):
+        data[:,:,i] = pix[:,:,i] >> 2
+        data[:,:,4] |= ((pix[:,:,i] & 3) << (2 * i)).astype(np.uint8)
+
+    return packed
+
+#--------------------------------------------------------------------------------------
+def bayerPlanes(raw, order, rotation=0):
+    # Strided views of the R, G, G and B sites, rotated like the camera output.
+    # The raw data is always in sensor orientation, the rotation is clockwise.
+    if int(rotation) % 90:
+        raise ValueError('Bayer planes can only be rotated by multiples of 90 degrees, not %s' % rotation)
+    k = (360 - int(rotation)) // 90 % 4
+
+    return [np.rot90(raw[y::2, x::2], k) for y, x in BAYER_OFFSETS[order]]
+
+#--------------------------------------------------------------------------------------
+def bayerCrop(planes, crop, resolution):
+    # Maps a crop box of the camera output (as drawn in the overlay) onto the
+    # half resolution Bayer planes, which must already be rotated like the output.
+    # The camera scales the sensor image by the same factor on both axes and crops
+    # the centre to the aspect ratio of the output, so the output covers the
+    # largest centred box of that aspect ratio in the planes.
+    ph, pw = planes[0].shape
+    width, height = resolution[0], resolution[1]
+    scale = min(pw / width, ph / height)
+    x0 = (pw - width * scale) / 2
+    y0 = (ph - height * scale) / 2
+
+    box = [x0 + crop[0] * scale, y0 + crop[1] * scale,
+           x0 + crop[2] * scale, y0 + crop[3] * scale]
+    return [min(max(int(round(v)), 0), limit) for v, limit in zip(box, (pw, ph, pw, ph))]
+
+#--------------------------------------------------------------------------------------
+def bayerImage(planes, box):
+    # R, G and B of the crop box straight from the planes - no demosaic, the two
+    # green sites are averaged
+    r, g1, g2, b = [p[box[1]:box[3], box[0]:box[2]] for p in planes]
+    image = np.empty(r.shape + (3,), dtype=np.uint16)
+    image[:,:,0] = r
+    np.add(g1, g2, out=image[:,:,1])
+    image[:,:,1] >>= 1
+    image[:,:,2] = b
+
+    return image
+
+#--------------------------------------------------------------------------------------
+def syntheticBayer(revision='ov5647', order=1, lines=((0.45, 800), (0.60, 1000)),
+                   band=(0.4, 0.6), width=0.004, dark=64, jpeg=b'\xff\xd8\xff\xd9'):
+    # Builds a capture as the camera delivers it with bayer=True: a (dummy) JPEG
+    # followed by the raw block. The sensor sees a horizontal band with vertical
+    # spectral lines at the given fractions of the width and 10-bit heights.
+    sensors = {'ov5647': (2592, 1944), 'imx219': (3280, 2464)}
+    w, h = sensors[revision]
+
+    x = np.arange(w, dtype=np.float32) / w
+    profile = np.zeros(w, dtype=np.float32)
+    for pos, height in lines:
+        profile += height * np.exp(-0.5 * ((x - pos) / width)**2)
+
+    raw = np.full((h, w), dark, dtype=np.uint16)
+    y0, y1 = int(band[0] * h), int(band[1] * h)
+    raw[y0:y1] += np.minimum(profile, 1023 - dark).astype(np.uint16)
+
+    block = np.zeros(BAYER_SIZES[revision], dtype=np.uint8)
+    block[:4] = np.frombuffer(b'BRCM', dtype=np.uint8)
+    header = struct.pack(BAYER_HEADER, revision.encode('ascii'), w, h, 0, 0, bytes(24), 0, 33, order, 0)
+    block[BAYER_HEADER_OFFSET:BAYER_HEADER_OFFSET + len(header)] = np.frombuffer(header, dtype=np.uint8)
+    packed = pack10(raw).ravel()
+    block[BAYER_DATA_OFFSET:BAYER_DATA_OFFSET + len(packed)] = packed
+
+    return jpeg + block.tobytes(), raw
+
+#--------------------------------------------------------------------------------------
+# Frame stacking
+#--------------------------------------------------------------------------------------
+class FrameStacker():
+    # Running float32 mean and variance (Welford) of a stream of frames. Only the
+    # accumulators are kept, never the frames themselves.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, shape):
+        self.count = 0
+        self.mean  = np.zeros(shape, dtype=np.float32)
+        self.m2    = np.zeros(shape, dtype=np.float32)
+        self.delta = np.empty(shape, dtype=np.float32)
+        self.temp  = np.empty(shape, dtype=np.float32)
+
+    #----------------------------------------------------------------------------------
+    def add(self, frame):
+        self.count += 1
+        np.subtract(frame, self.mean, out=self.delta)
+        np.multiply(self.delta, 1.0 / self.count, out=self.temp)
+        self.mean += self.temp
+        np.subtract(frame, self.mean, out=self.temp)
+        self.temp *= self.delta
+        self.m2 += self.temp
+
+    #----------------------------------------------------------------------------------
+    def variance(self):
+        if self.count < 2:
+            return np.zeros_like(self.m2)
+        return self.m2 / (self.count - 1)
+
+    #----------------------------------------------------------------------------------
+    def std(self):
+        return np.sqrt(self.variance())
+
+    #----------------------------------------------------------------------------------
+    def columnWeights(self, weights=None):
+        # Factor of every color channel in a column average, as SpectrumEngine.reduce
+        # combines them - equal unless channel weights are given
+        rows, channels = self.mean.shape[0], self.mean.shape[2]
+        if weights is None:
+            return np.full(channels, 1.0 / (rows * channels), dtype=np.float32)
+        weights = np.asarray(weights, dtype=np.float32)
+        return weights / (rows * weights.sum())
+
+    #----------------------------------------------------------------------------------
+    def spectrumError(self, weights=None):
+        # Standard error of the column averages (rows and colors) of the mean frame
+        factors = self.columnWeights(weights)
+        return np.sqrt(self.variance().sum(axis=0) @ (factors * factors) / max(self.count, 1))
+
+    #----------------------------------------------------------------------------------
+    def noise(self, weights=None):
+        # Relative noise of the averaged spectrum
+        peak = (self.mean.sum(axis=0) @ self.columnWeights(weights)).max()
+        if peak <= 0:
+            return np.inf
+        return float(np.median(self.spectrumError(weights)) / peak)
+
+#--------------------------------------------------------------------------------------
+def stackFrames(camera, frame, crop, count, target=None, minimum=4, weights=None):
+    # Pulls frames continuously from the video port and folds the crop of each
+    # into a FrameStacker. Stops after count frames or, with a noise target,
+    # once the relative noise of the spectrum (colors combined with weights)
+    # is below it.
+    stacker = None
+    frame.reset()
+
+    for _ in camera.capture_continuous(frame, format=frame.format, use_video_port=True):
+        if frame.pos != len(frame.buffer):
+            raise IOError('Incomplete frame (%d of %d bytes)' % (frame.pos, len(frame.buffer)))
+        roi = frame.array[crop[1]:crop[3], crop[0]:crop[2]]
+        if stacker is None:
+            stacker = FrameStacker(roi.shape)
+        stacker.add(roi)
+        frame.reset()
+
+        if stacker.count >= count:
+            break
+        if target and stacker.count >= minimum and stacker.noise(weights) <= target:
+            break
+
+    return stacker
@@ -0,0 +1,223 @@
+#--------------------------------------------------------------------------------------
+# Catalog - SQLite index of experiments and their spectral features
+#
+# Fill it from the logbook and the spectrum archive (or CSV files) and query it with
+#   python -m helpers.Catalog backfill
+#   python -m helpers.Catalog near 546 [tolerance]
+#--------------------------------------------------------------------------------------
+
+import os
+import sys
+import json
+import sqlite3
+import threading
+import numpy as np
+
+from helpers.Spectrum import findPeaks
+from helpers.Logbook import Logbook
+from helpers.Archive import SpectrumArchive, readCSV
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS experiments (
+    time        TEXT PRIMARY KEY,
+    name        TEXT,
+    light       TEXT,
+    sample      TEXT,
+    notes       TEXT,
+    shutter     REAL,
+    mode        TEXT,
+    frames      INTEGER,
+    crop        TEXT,
+    pixel1      REAL,
+    pixel2      REAL,
+    wavelength1 REAL,
+    wavelength2 REAL,
+    calibration TEXT,
+    scaleFactor REAL,
+    integral    REAL,
+    maximum     REAL,
+    peak        REAL
+);
+CREATE TABLE IF NOT EXISTS peaks (
+    time        TEXT NOT NULL REFERENCES experiments(time) ON DELETE CASCADE,
+    wavelength  REAL NOT NULL,
+    height      REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS peaks_wavelength ON peaks(wavelength);
+CREATE INDEX IF NOT EXISTS peaks_time ON peaks(time);
+CREATE INDEX IF NOT EXISTS experiments_name ON experiments(name);
+CREATE INDEX IF NOT EXISTS experiments_light ON experiments(light);
+'''
+
+#--------------------------------------------------------------------------------------
+# Catalog class
+#--------------------------------------------------------------------------------------
+class Catalog():
+    # One row per experiment with its metadata, integrated intensity and strongest
+    # peak, and one row per peak. The peaks are indexed by wavelength, so finding
+    # spectra with a line near some wavelength is an index range scan. The file
+    # can always be rebuilt from the logbook and the archive.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, path='docs/catalog.sqlite', threshold=0.05, peaks=10):
+        self.path      = path
+        self.threshold = threshold      # Peaks above this fraction of the spectrum range
+        self.peaks     = peaks          # Strongest peaks kept per spectrum
+        self.lock      = threading.Lock()
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        self.db.executescript(SCHEMA)
+
+    #----------------------------------------------------------------------------------
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    #----------------------------------------------------------------------------------
+    # Updates
+    #----------------------------------------------------------------------------------
+    def add(self, meta, wavelength, spectrum):
+        row, peaks = self.features(meta, wavelength, spectrum)
+
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM peaks WHERE time = ?', (row['time'],))
+            self.db.execute('INSERT OR REPLACE INTO experiments ({}) VALUES ({})'.format(
+                            ', '.join(row), ', '.join('?' * len(row))), tuple(row.values()))
+            self.db.executemany('INSERT INTO peaks (time, wavelength, height) VALUES (?, ?, ?)', peaks)
+
+    #----------------------------------------------------------------------------------
+    def features(self, meta, wavelength, spectrum):
+        wavelength = np.asarray(wavelength, dtype=np.float64)
+        spectrum = np.asarray(spectrum, dtype=np.float64)
+        valid = ~np.isnan(spectrum)                      # Archive rows are NaN padded
+        wavelength, spectrum = wavelength[valid], spectrum[valid]
+
+        found = findPeaks(spectrum, self.threshold, self.peaks)
+        peaks = [(meta['time'], float(wavelength[i]), float(spectrum[i])) for i in found]
+
+        pixels = meta.get('pixels') or (None, None)
+        wavelengths = meta.get('wavelengths') or (None, None)
+        row = {'time':        meta['time'],
+               'name':        meta.get('name'),
+               'light':       meta.get('light'),
+               'sample':      meta.get('sample'),
+               'notes':       meta.get('notes'),
+               'shutter':     meta.get('shutter'),
+               'mode':        meta.get('mode'),
+               'frames':      meta.get('frames'),
+               'crop':        json.dumps(meta['crop']) if meta.get('crop') else None,
+               'pixel1':      pixels[0],
+               'pixel2':      pixels[1],
+               'wavelength1': wavelengths[0],
+               'wavelength2': wavelengths[1],
+               'calibration': json.dumps(meta['calibration']) if meta.get('calibration') else None,
+               'scaleFactor': meta.get('scaleFactor'),
+               'integral':    integrate(wavelength, spectrum),
+               'maximum':     float(spectrum.max()) if len(spectrum) else None,
+               'peak':        peaks[0][1] if peaks else None}
+
+        return row, peaks
+
+    #----------------------------------------------------------------------------------
+    def backfill(self, logbook=None, archive=None, data='docs/data', force=False):
+        # Experiments of the logbook that are not in the catalog yet. Spectra come
+        # from the archive, or from the CSV file if the archive does not have them.
+        logbook = logbook or Logbook()
+        archive = archive or SpectrumArchive(os.path.join(data, 'archive'))
+        known = set() if force else self.times()
+
+        entries, wavelengths, intensities = archive.load()
+        stored = {e['time']: i for i, e in enumerate(entries)}
+
+        count = 0
+        for record in logbook.records():
+            time = record['time']
+            if time in known:
+                continue
+            meta = logbook.get(time) or record
+            if time in stored:
+                wavelength, spectrum = wavelengths[stored[time]], intensities[stored[time]]
+            else:
+                fname = os.path.join(data, 'spectrum-' + time + '.csv')
+                if not os.path.exists(fname):
+                    continue
+                wavelength, spectrum = readCSV(fname)
+            self.add(meta, wavelength, spectrum)
+            count += 1
+
+        return count
+
+    #----------------------------------------------------------------------------------
+    # Queries
+    #----------------------------------------------------------------------------------
+    def times(self):
+        with self.lock:
+            return set(r[0] for r in self.db.execute('SELECT time FROM experiments'))
+
+    #----------------------------------------------------------------------------------
+    def get(self, time):
+        with self.lock:
+            row = self.db.execute('SELECT * FROM experiments WHERE time = ?', (time,)).fetchone()
+        return dict(row) if row else None
+
+    #----------------------------------------------------------------------------------
+    def peaksNear(self, wavelength, tolerance=2.0, minHeight=None):
+        # Experiments with a peak within tolerance nm, the closest peak of each first
+        query = '''SELECT e.*, p.wavelength AS peakWavelength, p.height AS peakHeight,
+                          abs(p.wavelength - ?) AS distance
+                   FROM peaks p JOIN experiments e ON e.time = p.time
+                   WHERE p.wavelength BETWEEN ? AND ?'''
+        args = [wavelength, wavelength - tolerance, wavelength + tolerance]
+        if minHeight is not None:
+            query += ' AND p.height >= ?'
+            args.append(minHeight)
+        query += ' ORDER BY distance'
+
+        with self.lock:
+            rows = self.db.execute(query, args).fetchall()
+
+        seen, found = set(), []
+        for row in rows:
+            if row['time'] not in seen:
+                seen.add(row['time'])
+                found.append(dict(row))
+
+        return found
+
+    #----------------------------------------------------------------------------------
+    def find(self, **where):
+        # Experiments by column value, text columns match like SQL LIKE, e.g.
+        # find(light='%CFL%', name='Thomas%')
+        columns = [c for c in where if c in ('time', 'name', 'light', 'sample', 'mode')]
+        query = 'SELECT * FROM experiments'
+        if columns:
+            query += ' WHERE ' + ' AND '.join('{} LIKE ?'.format(c) for c in columns)
+        query += ' ORDER BY time'
+
+        with self.lock:
+            return [dict(r) for r in self.db.execute(query, [where[c] for c in columns])]
+
+#--------------------------------------------------------------------------------------
+# Helpers
+#--------------------------------------------------------------------------------------
+def integrate(wavelength, spectrum):
+    # Trapezoidal rule, np.trapz is gone in NumPy 2 and np.trapezoid too new for older ones
+    if len(spectrum) < 2:
+        return None
+    return float(np.sum((spectrum[1:] + spectrum[:-1]) * np.diff(wavelength)) / 2)
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    catalog = Catalog()
+    if len(sys.argv) == 2 and sys.argv[1] == 'backfill':
+        print('Added {} experiments'.format(catalog.backfill()))
+    elif len(sys.argv) in (3, 4) and sys.argv[1] == 'near':
+        tolerance = float(sys.argv[3]) if len(sys.argv) == 4 else 2.0
+        for row in catalog.peaksNear(float(sys.argv[2]), tolerance):
+            print('{time}  {peakWavelength:7.2f} nm  {peakHeight:7.2f}  {name} - {light} - {sample}'.format(**row))
+    else:
+        print('Usage: python -m helpers.Catalog backfill | near <wavelength> [tolerance]')
@@ -0,0 +1,89 @@
+#--------------------------------------------------------------------------------------
+# Dark frames - one per capture setting, kept on disk and in a small LRU cache
+#--------------------------------------------------------------------------------------
+
+import os
+import numpy as np
+
+from collections import OrderedDict
+
+#--------------------------------------------------------------------------------------
+# DarkLibrary class
+#--------------------------------------------------------------------------------------
+class DarkLibrary():
+    # Dark frames are stored as .npy files in their native dtype (uint8 frames,
+    # uint16 raw Bayer) keyed by everything that changes them: capture mode,
+    # resolution, shutter, ISO and rotation. A missing dark is captured once
+    # on demand and reused from then on.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, directory='darks', capacity=4):
+        self.directory = directory
+        self.capacity  = capacity
+        self.cache     = OrderedDict()
+
+    #----------------------------------------------------------------------------------
+    @staticmethod
+    def key(mode, resolution, shutter, iso, rotation):
+        return (mode, int(resolution[0]), int(resolution[1]), int(shutter), int(iso), int(rotation))
+
+    #----------------------------------------------------------------------------------
+    def path(self, key):
+        return os.path.join(self.directory, 'dark-{}-{}x{}-{}us-iso{}-rot{}.npy'.format(*key))
+
+    #----------------------------------------------------------------------------------
+    def get(self, key, capture=None):
+        dark = self.cache.get(key)
+        if dark is not None:
+            self.cache.move_to_end(key)
+            return dark
+
+        path = self.path(key)
+        if os.path.exists(path):
+            dark = np.load(path)
+        elif capture is not None:
+            dark = capture()
+            self.save(key, dark)
+        else:
+            return None
+
+        self.remember(key, dark)
+        return dark
+
+    #----------------------------------------------------------------------------------
+    def put(self, key, dark):
+        self.save(key, dark)
+        self.remember(key, dark)
+
+    #----------------------------------------------------------------------------------
+    def save(self, key, dark):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        temp = path + '.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, dark)
+        os.replace(temp, path)
+
+    #----------------------------------------------------------------------------------
+    def remember(self, key, dark):
+        dark.flags.writeable = False
+        self.cache[key] = dark
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+
+    #----------------------------------------------------------------------------------
+    def clear(self):
+        self.cache.clear()
+        if os.path.isdir(self.directory):
+            for name in os.listdir(self.directory):
+                if name.startswith('dark-') and name.endswith('.npy'):
+                    os.remove(os.path.join(self.directory, name))
+
+#--------------------------------------------------------------------------------------
+def subtractDark(pixels, dark, out):
+    # out = max(pixels - dark, 0) in float32, out may be pixels itself
+    np.subtract(pixels, dark, out=out, dtype=np.float32)
+    np.maximum(out, 0, out=out)
+
+    return out
@@ -0,0 +1,367 @@
+#--------------------------------------------------------------------------------------
+# Devices - camera, LCD and NeoPixel, on the Pi or simulated
+#
+# Backend 'pi' opens the hardware, 'sim' stand ins that need no Pi. The default is
+# the SPECTROMETER_BACKEND environment variable, else 'pi'.
+#--------------------------------------------------------------------------------------
+
+import io
+import os
+import threading
+import time
+import numpy as np
+
+from collections import namedtuple
+from PIL import Image
+
+from helpers.Capture import syntheticBayer
+
+#--------------------------------------------------------------------------------------
+def defaultBackend():
+    return os.environ.get('SPECTROMETER_BACKEND', 'pi')
+
+#--------------------------------------------------------------------------------------
+def openCamera(backend=None):
+    backend = backend or defaultBackend()
+    if backend == 'pi':
+        from picamera import PiCamera       # Only on the Pi
+        return PiCamera()
+    if backend == 'sim':
+        return SimulatedCamera()
+    raise ValueError('Unknown device backend: %s' % backend)
+
+#--------------------------------------------------------------------------------------
+def openLCD(backend=None):
+    backend = backend or defaultBackend()
+    if backend == 'pi':
+        import ST7735
+        disp = ST7735.ST7735(port=0,cs=1,dc=9,backlight=12,rotation=270,spi_speed_hz=10000000)
+    elif backend == 'sim':
+        disp = MemoryLCD()
+    else:
+        raise ValueError('Unknown device backend: %s' % backend)
+
+    disp.begin()
+    return disp
+
+#--------------------------------------------------------------------------------------
+def openNeoPixel(backend=None):
+    backend = backend or defaultBackend()
+    if backend == 'pi':
+        import board
+        import busio
+        from adafruit_seesaw import seesaw, neopixel
+
+        NEOPIXEL_PIN = 9  # Pin NeoPixel is connected to (9, 10, 11, 14, 15, 24, or 25 )
+        NEOPIXEL_NUM = 1  # no more than 60!
+
+        i2c_bus = busio.I2C(board.SCL, board.SDA)
+        ss = seesaw.Seesaw(i2c_bus)
+        pixels = neopixel.NeoPixel(ss, NEOPIXEL_PIN, NEOPIXEL_NUM)
+    elif backend == 'sim':
+        pixels = NullNeoPixel()
+    else:
+        raise ValueError('Unknown device backend: %s' % backend)
+
+    pixels.brightness = 1.0 # Full brightness
+    pixels.fill((0,0,0))    # Light off
+    return pixels
+
+#--------------------------------------------------------------------------------------
+# Simulated camera
+#--------------------------------------------------------------------------------------
+Resolution = namedtuple('Resolution', 'width height')
+
+# Relative heights of the lines of a CFL as the spectrometer sees them (nm)
+CFL_SPECTRUM = {405.4: 0.3, 436.6: 0.8, 487.7: 0.5, 542.4: 0.6, 546.5: 1.0, 577.7: 0.25,
+                580.2: 0.2, 587.6: 0.25, 611.6: 0.9, 631.1: 0.25, 650.8: 0.08, 710.7: 0.15}
+
+#--------------------------------------------------------------------------------------
+class SimulatedEncoder():
+    # H264 stand in for one splitter port: SPS, PPS and an IDR slice for key frames,
+    # P slices otherwise, sized from the bitrate. Payloads are slices of one random
+    # block, so producing a frame costs no more than the real encoder callback.
+
+    nalStart = b'\x00\x00\x00\x01'
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, bitrate=1000000, framerate=5.0, intra_period=0, quantization=0):
+        self.bitrate      = bitrate
+        self.framerate    = framerate
+        self.intra_period = intra_period   # 0 - only the first and requested key frames
+        self.quantization = quantization
+        self.frame        = 0
+        self.keyFrames    = 0
+        self.keyRequested = True
+        self.noise = np.random.default_rng(0).integers(1, 256, 1 << 20, dtype=np.uint8).tobytes()
+
+    #----------------------------------------------------------------------------------
+    def frameSize(self, key):
+        size = self.bitrate / 8.0 / max(self.framerate, 0.1)
+        if self.quantization:
+            size *= 10.0 / (10.0 + self.quantization)
+        return int(min(size * (4 if key else 0.8), len(self.noise) - 1)) + 1
+
+    #----------------------------------------------------------------------------------
+    def nals(self):
+        # Units of the next frame, each a separate write like the camera does
+        key = self.keyRequested or (self.intra_period and self.frame % self.intra_period == 0)
+        self.keyRequested = False
+        self.frame += 1
+
+        if key:
+            self.keyFrames += 1
+            yield self.nalStart + b'\x67' + self.noise[:12]      # SPS
+            yield self.nalStart + b'\x68' + self.noise[12:16]    # PPS
+            yield self.nalStart + b'\x65' + self.noise[:self.frameSize(True)]
+        else:
+            offset = self.frame * 977 % (len(self.noise) // 2)
+            yield self.nalStart + b'\x41' + self.noise[offset:offset + self.frameSize(False)]
+
+#--------------------------------------------------------------------------------------
+class SimulatedCamera():
+    # Stand in for PiCamera with the calls the project makes. The scene is a light
+    # band with the spectrum of a CFL across the frame width (wavelengths given for
+    # the left and right edge); stills and video frames add a little sensor noise.
+    # Recordings run on their own threads at the frame rate, one per splitter port.
+
+    revision = 'ov5647'
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, resolution=(648, 486), framerate=5.0, spectrum=(380.0, 720.0), band=(0.4, 0.6),
+                 lines=CFL_SPECTRUM, noise=2.0, realtime=True):
+        self._resolution  = Resolution(*resolution)
+        self.framerate    = framerate
+        self.spectrum     = spectrum
+        self.band         = band
+        self.lines        = lines
+        self.noise        = noise
+        self.realtime     = realtime   # Pace captures and recordings at the frame rate
+        self.shutter_speed = 0
+        self.iso          = 0
+        self.rotation     = 0
+        self.awb_mode     = 'auto'
+        self.awb_gains    = (1, 1)
+        self.closed       = False
+        self.recordings   = {}         # splitter port -> (thread, stop event)
+        self.encoders     = {}         # splitter port -> SimulatedEncoder for h264
+        self.rng          = np.random.default_rng(1)
+        self.lock         = threading.Lock()
+        self.scenes       = {}
+        self.frames       = {}         # Encoded frames of the scene, only kept without noise
+        self.bayer        = None
+
+    #----------------------------------------------------------------------------------
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        self._resolution = Resolution(*value)
+
+    #----------------------------------------------------------------------------------
+    def scene(self):
+        # Noise free RGB image of the light band, made once per resolution
+        key = (self._resolution, self.spectrum, self.band)
+        image = self.scenes.get(key)
+        if image is not None:
+            return image
+
+        width, height = self._resolution
+        wavelength = np.linspace(self.spectrum[0], self.spectrum[1], width)
+        profile = 0.05 * np.ones(width)
+        sigma = 1.5 * abs(self.spectrum[1] - self.spectrum[0]) / width
+        for line, strength in self.lines.items():
+            profile += strength * np.exp(-0.5 * ((wavelength - line) / sigma)**2)
+        color = wavelengthColor(wavelength) * np.minimum(profile, 1.0)[:,None]
+
+        image = np.full((height, width, 3), 8.0, dtype=np.float32)
+        y0, y1 = int(self.band[0] * height), int(self.band[1] * height)
+        image[y0:y1] += 240.0 * color[None,:,:]
+        self.scenes = {key: image}
+        self.frames = {}
+
+        return image
+
+    #----------------------------------------------------------------------------------
+    def frame(self, format='rgb'):
+        # One frame as the camera writes it, rows and columns padded for rgb and yuv.
+        # Without noise every frame is the same and encoded only once.
+        rgb = self.scene()
+        if not self.noise:
+            data = self.frames.get(format)
+            if data is None:
+                data = self.frames[format] = self.encode(rgb, format)
+            return data
+
+        with self.lock:
+            rgb = rgb + self.rng.normal(0, self.noise, rgb.shape).astype(np.float32)
+
+        return self.encode(rgb, format)
+
+    #----------------------------------------------------------------------------------
+    def encode(self, rgb, format):
+        rgb = np.clip(rgb, 0, 255).astype(np.uint8)
+        if format in ('jpeg', 'png'):
+            buf = io.BytesIO()
+            Image.fromarray(rgb).save(buf, format=format)
+            return buf.getvalue()
+
+        width, height = self._resolution
+        fwidth, fheight = (width + 31) // 32 * 32, (height + 15) // 16 * 16
+        if format == 'rgb':
+            padded = np.zeros((fheight, fwidth, 3), dtype=np.uint8)
+            padded[:height, :width] = rgb
+            return padded.tobytes()
+        if format == 'yuv':
+            planes = np.full(fwidth * fheight * 3 // 2, 128, dtype=np.uint8)
+            luma = planes[:fwidth * fheight].reshape(fheight, fwidth)
+            luma[:] = 0
+            luma[:height, :width] = (rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).astype(np.uint8)
+            return planes.tobytes()
+        raise ValueError('Unsupported format: %s' % format)
+
+    #----------------------------------------------------------------------------------
+    def capture(self, output, format='jpeg', use_video_port=False, bayer=False, **options):
+        data = self.frame(format)
+        if bayer:
+            if self.bayer is None:                      # Raw block is slow to make, keep it
+                self.bayer = syntheticBayer(self.revision, jpeg=b'')[0]
+            data += self.bayer
+
+        if isinstance(output, str):
+            with open(output, 'wb') as f:
+                f.write(data)
+        else:
+            output.write(data)
+            if hasattr(output, 'flush'):
+                output.flush()
+
+    #----------------------------------------------------------------------------------
+    def capture_continuous(self, output, format='jpeg', use_video_port=False, **options):
+        while not self.closed:
+            start = time.monotonic()
+            self.capture(output, format, use_video_port, **options)
+            yield output
+            self.pace(start)
+
+    #----------------------------------------------------------------------------------
+    def pace(self, start):
+        if self.realtime and self.framerate:
+            delay = 1.0 / float(self.framerate) - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+
+    #----------------------------------------------------------------------------------
+    def start_recording(self, output, format='h264', splitter_port=1, bitrate=17000000,
+                        intra_period=0, quantization=0, **options):
+        if splitter_port in self.recordings:
+            raise RuntimeError('The camera is already using port %d' % splitter_port)
+        if format == 'h264':
+            self.encoders[splitter_port] = SimulatedEncoder(bitrate, self.framerate, intra_period, quantization)
+
+        stop = threading.Event()
+        thread = threading.Thread(target=self._record, args=(output, format, splitter_port, stop),
+                                  daemon=True)
+        self.recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    #----------------------------------------------------------------------------------
+    def stop_recording(self, splitter_port=1):
+        thread, stop = self.recordings.pop(splitter_port)
+        stop.set()
+        thread.join()
+        self.encoders.pop(splitter_port, None)
+
+    #----------------------------------------------------------------------------------
+    def request_key_frame(self, splitter_port=1):
+        encoder = self.encoders.get(splitter_port)
+        if encoder is not None:
+            encoder.keyRequested = True
+
+    #----------------------------------------------------------------------------------
+    def _record(self, output, format, splitter_port, stop):
+        while not stop.is_set():
+            start = time.monotonic()
+            if format == 'h264':
+                for nal in self.encoders[splitter_port].nals():
+                    output.write(nal)
+            else:
+                output.write(self.frame(format))
+            self.pace(start)
+        if hasattr(output, 'flush'):
+            output.flush()
+
+    #----------------------------------------------------------------------------------
+    def start_preview(self, **options):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    #----------------------------------------------------------------------------------
+    def close(self):
+        for port in list(self.recordings):
+            self.stop_recording(port)
+        self.closed = True
+
+#--------------------------------------------------------------------------------------
+def wavelengthColor(wavelength):
+    # Rough RGB (0..1) of spectral colors, enough for the color channels to differ
+    w = np.asarray(wavelength, dtype=np.float32)
+    r = np.clip((w - 560) / 60, 0, 1) + np.clip((440 - w) / 60, 0, 1) * 0.6
+    g = np.clip(1 - np.abs(w - 540) / 90, 0, 1)
+    b = np.clip(1 - np.abs(w - 450) / 70, 0, 1)
+    fade = np.clip((w - 380) / 40, 0.2, 1) * np.clip((750 - w) / 50, 0.2, 1)
+
+    return np.stack([r, g, b], axis=-1) * fade[...,None]
+
+#--------------------------------------------------------------------------------------
+# Simulated LCD and NeoPixel
+#--------------------------------------------------------------------------------------
+class MemoryLCD():
+    # ST7735 stand in, keeps the last image shown
+
+    width  = 160
+    height = 80
+
+    #----------------------------------------------------------------------------------
+    def __init__(self):
+        self.image  = None
+        self.frames = 0
+
+    #----------------------------------------------------------------------------------
+    def begin(self):
+        pass
+
+    #----------------------------------------------------------------------------------
+    def display(self, image):
+        self.image = image.copy()
+        self.frames += 1
+
+#--------------------------------------------------------------------------------------
+class NullNeoPixel():
+    # NeoPixel stand in, only remembers the color
+
+    brightness = 1.0
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, n=1):
+        self.colors = [(0, 0, 0)] * n
+
+    #----------------------------------------------------------------------------------
+    def fill(self, color):
+        self.colors = [tuple(color)] * len(self.colors)
+
+    #----------------------------------------------------------------------------------
+    def __setitem__(self, index, color):
+        self.colors[index] = tuple(color)
+
+    #----------------------------------------------------------------------------------
+    def __getitem__(self, index):
+        return self.colors[index]
+
+    #----------------------------------------------------------------------------------
+    def show(self):
+        pass
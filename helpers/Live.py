@@ -0,0 +1,127 @@
+#--------------------------------------------------------------------------------------
+# Live spectrum - frames from the video port reduced to spectra while streaming
+#--------------------------------------------------------------------------------------
+
+import logging
+import threading
+import time
+
+from helpers.Capture import FrameBuffer
+from helpers.Spectrum import SpectrumEngine
+
+logger = logging.getLogger(__name__)
+
+#--------------------------------------------------------------------------------------
+# LiveSpectrum class
+#--------------------------------------------------------------------------------------
+class LiveSpectrum():
+    # The camera records unencoded frames on its own splitter port into one of
+    # three reused buffers: filling (camera), ready (newest complete frame) and
+    # working (reduction). A frame that completes while the previous one is still
+    # waiting replaces it, so a slow reduction skips stale frames instead of
+    # queueing them. Spectra go to the viewers as binary Spectrum messages.
+
+    running = False
+    frames  = 0
+    skipped = 0
+    spectra = 0
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, camera, server, weights=None, format='rgb', splitter_port=2):
+        self.camera = camera
+        self.server = server
+        self.format = format
+        self.splitter_port = splitter_port
+        self.engine = SpectrumEngine(weights)       # Own engine, its cache is not thread safe
+        self.cond = threading.Condition(threading.Lock())
+        self.fresh = False
+        self.readyTime = 0
+        self.thread = None
+        self.crop = None
+        self.calibration = None
+
+    #----------------------------------------------------------------------------------
+    def configure(self, crop, wavelength1, wavelength2, pixel1, pixel2):
+        with self.cond:
+            self.crop = list(crop)
+            self.calibration = (wavelength1, wavelength2, pixel1, pixel2)
+
+    #----------------------------------------------------------------------------------
+    def start(self):
+        if self.running:
+            return
+        resolution = self.camera.resolution
+        self.filling, self.ready, self.working = [FrameBuffer(resolution, self.format) for i in range(3)]
+        self.fresh = False
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.camera.start_recording(self, format=self.format, splitter_port=self.splitter_port)
+        logger.info('Live spectrum started')
+
+    #----------------------------------------------------------------------------------
+    def stop(self):
+        if not self.running:
+            return
+        try:
+            self.camera.stop_recording(splitter_port=self.splitter_port)
+        finally:
+            with self.cond:
+                self.running = False
+                self.cond.notify()
+            self.thread.join()
+        logger.info('Live spectrum stopped: %d frames, %d skipped, %d spectra',
+                    self.frames, self.skipped, self.spectra)
+
+    #----------------------------------------------------------------------------------
+    def write(self, data):
+        """Called by camera thread with unencoded frame data."""
+        frame = self.filling
+        if frame.pos + len(data) > len(frame.buffer):
+            frame.reset()                           # Out of step, start over
+        frame.write(data)
+
+        if frame.pos == len(frame.buffer):
+            with self.cond:
+                if self.fresh:
+                    self.skipped += 1               # Previous frame was never reduced
+                self.filling, self.ready = self.ready, frame
+                self.readyTime = int(time.monotonic() * 1000000)
+                self.fresh = True
+                self.frames += 1
+                self.cond.notify()
+            self.filling.reset()
+
+        return len(data)
+
+    #----------------------------------------------------------------------------------
+    def flush(self):
+        pass
+
+    #----------------------------------------------------------------------------------
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.fresh:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                self.ready, self.working = self.working, self.ready
+                self.fresh = False
+                timestamp = self.readyTime
+                crop, calibration = self.crop, self.calibration
+
+            if crop is None:
+                continue
+            try:
+                spectrum = self.engine.reduce(self.working.array, roi=crop)
+                self.publish(spectrum, calibration, timestamp)
+                self.spectra += 1
+            except Exception as e:
+                logger.warning('Live spectrum failed: %s', e)
+
+    #----------------------------------------------------------------------------------
+    def publish(self, spectrum, calibration, timestamp):
+        # Calibration goes as coefficients, the viewer computes the axis
+        coefficients = self.engine.coefficients(*calibration)
+        self.server.send_spectrum(spectrum, calibration=coefficients, frame_timestamp_us=timestamp)
@@ -0,0 +1,255 @@
+#--------------------------------------------------------------------------------------
+# Logbook - append-only experiment manifest and paged index pages
+#
+# Rebuild all pages or import the entries of an old docs/index.html with
+#   python -m helpers.Logbook rebuild
+#   python -m helpers.Logbook import docs/index.html
+#--------------------------------------------------------------------------------------
+
+import os
+import re
+import sys
+import json
+import threading
+
+#--------------------------------------------------------------------------------------
+# Logbook class
+#--------------------------------------------------------------------------------------
+class Logbook():
+    # Every experiment is one JSON record, written atomically to logbook/<time>.json
+    # and appended as one line to logbook/manifest.jsonl. Index pages hold pageSize
+    # entries each, oldest page first (log-1.html, log-2.html, ..), the newest page
+    # is also index.html. Adding an entry only rewrites the newest page, so its
+    # cost does not grow with the number of experiments.
+
+    entry='''        <tr><td><img src="images/processed-{0}.jpg" align="right">
+            Scientist: <strong>{1}</strong><br>
+            Light source: <strong>{2}</strong><br>
+            Transmission sample: <strong>{3}</strong><br>
+            Date and time: <strong>{0}</strong><br>
+            <a href="experiment-{0}.html" target="_blank"><button>Details</button></a></td></tr>
+'''
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, directory='docs', pageSize=50):
+        self.directory = directory
+        self.pageSize  = pageSize
+        self.store     = os.path.join(directory, 'logbook')
+        self.manifest  = os.path.join(self.store, 'manifest.jsonl')
+        self.lock      = threading.Lock()
+
+    #----------------------------------------------------------------------------------
+    # Records
+    #----------------------------------------------------------------------------------
+    def add(self, meta):
+        with self.lock:
+            last = self.tail(1)
+            seq = last[0]['seq'] + 1 if last else 0
+            record = dict(meta, seq=seq)
+
+            writeAtomic(os.path.join(self.store, record['time'] + '.json'), json.dumps(record, indent=1))
+            self.append(record)
+
+            page = seq // self.pageSize
+            self.writePage(page, self.tail(seq % self.pageSize + 1), page)
+            if seq % self.pageSize == 0 and page > 0:
+                # Previous page is complete, it now needs a link to the new one
+                self.writePage(page - 1, self.tail(self.pageSize + 1)[:-1], page)
+
+        return record
+
+    #----------------------------------------------------------------------------------
+    def update(self, meta):
+        # New details of an existing entry, e.g. after reprocessing. The index pages
+        # only show name, light and sample, so the manifest is left alone.
+        record = self.get(meta['time'])
+        if record is None:
+            raise KeyError('No logbook entry for ' + meta['time'])
+        record.update(meta, seq=record['seq'])
+        writeAtomic(os.path.join(self.store, record['time'] + '.json'), json.dumps(record, indent=1))
+
+        return record
+
+    #----------------------------------------------------------------------------------
+    def append(self, record):
+        os.makedirs(self.store, exist_ok=True)
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+
+        with open(self.manifest, 'ab') as f:
+            if f.tell() > 0:
+                with open(self.manifest, 'rb') as r:
+                    r.seek(-1, os.SEEK_END)
+                    if r.read(1) != b'\n':     # Torn line from a crash
+                        line = '\n' + line
+            f.write(line.encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+
+    #----------------------------------------------------------------------------------
+    def get(self, time):
+        path = os.path.join(self.store, time + '.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+    #----------------------------------------------------------------------------------
+    def records(self):
+        if not os.path.exists(self.manifest):
+            return []
+        with open(self.manifest, 'rb') as f:
+            return parseLines(f.read().split(b'\n'))
+
+    #----------------------------------------------------------------------------------
+    def tail(self, n):
+        # Last n records, read backwards from the end of the manifest
+        if n <= 0 or not os.path.exists(self.manifest):
+            return []
+
+        with open(self.manifest, 'rb') as f:
+            pos = f.seek(0, os.SEEK_END)
+            data = b''
+            while pos > 0 and data.count(b'\n') <= n:
+                step = min(8192, pos)
+                pos -= step
+                f.seek(pos)
+                data = f.read(step) + data
+
+        lines = data.split(b'\n')
+        if pos > 0:
+            lines = lines[1:]                    # First line may be cut
+
+        return parseLines(lines)[-n:]
+
+    #----------------------------------------------------------------------------------
+    # Pages
+    #----------------------------------------------------------------------------------
+    def pageName(self, page):
+        return 'log-{}.html'.format(page + 1)
+
+    #----------------------------------------------------------------------------------
+    def writePage(self, page, records, last):
+        entries = ''.join(self.entry.format(r['time'], r['name'], r['light'], r['sample'])
+                          for r in reversed(records))
+
+        links = ['<a href="index.html">Latest</a>']
+        if page < last:
+            links.append('<a href="{}">Newer entries</a>'.format(self.pageName(page + 1)))
+        if page > 0:
+            links.append('<a href="{}">Older entries</a>'.format(self.pageName(page - 1)))
+        # No page count, older pages are not rewritten when a new page starts
+        pages = '<tr><th>Page {} - {}</th></tr>\n'.format(page + 1, ' | '.join(links))
+
+        with open(os.path.join(self.directory, 'index-template.html'), 'rt', encoding='utf-8') as f:
+            template = f.read()
+        html = template.replace('<!--%%entry%%-->\n', '<!--%%entry%%-->\n' + entries)
+        html = html.replace('<!--%%pages%%-->\n', pages)
+
+        writeAtomic(os.path.join(self.directory, self.pageName(page)), html)
+        if page == last:
+            writeAtomic(os.path.join(self.directory, 'index.html'), html)
+
+    #----------------------------------------------------------------------------------
+    def rebuild(self):
+        with self.lock:
+            records = self.records()
+            last = max(len(records) - 1, 0) // self.pageSize
+            for page in range(last + 1):
+                self.writePage(page, records[page * self.pageSize:(page + 1) * self.pageSize], last)
+
+    #----------------------------------------------------------------------------------
+    # Experiment pages
+    #----------------------------------------------------------------------------------
+    def writeExperiment(self, meta):
+        hfile = os.path.join(self.directory, "experiment-"+meta['time']+".html")
+
+        with open(os.path.join(self.directory, "template.html"), "rt") as fin:
+            with open(hfile, "wt") as fout:
+                for line in fin:
+                    line = line.replace('%%lightSource%%', str(meta['light']))
+                    line = line.replace('%%measurementTaken%%', str(meta['time']))
+                    line = line.replace('%%scientistName%%', str(meta['name']))
+                    line = line.replace('%%transmissionSample%%', str(meta['sample']))
+                    line = line.replace('%%shutter%%', str(meta['shutter']))
+                    line = line.replace('%%scaleFactor%%', repr(meta['scaleFactor']))
+                    line = line.replace('%%experimentNotes%%', str(meta['notes']))
+
+                    fout.write(line)
+
+    #----------------------------------------------------------------------------------
+    def importIndex(self, path):
+        # Entries of an index.html from before the logbook, details come from the
+        # experiment pages. The index lists the newest entry first.
+        with open(path, 'rt', encoding='utf-8') as f:
+            html = f.read()
+
+        pattern = re.compile(r'<img src="images/processed-(?P<time>[\d-]+)\.jpg" align="right">\s*'
+                             r'Scientist: <strong>(?P<name>.*?)</strong><br>\s*'
+                             r'Light source: <strong>(?P<light>.*?)</strong><br>\s*'
+                             r'Transmission sample: <strong>(?P<sample>.*?)</strong><br>', re.DOTALL)
+        known = set(r['time'] for r in self.records())
+
+        count = 0
+        for match in reversed(list(pattern.finditer(html))):
+            meta = match.groupdict()
+            if meta['time'] in known:
+                continue
+            meta.update(self.readExperiment(meta['time']))
+            self.add(meta)
+            count += 1
+
+        return count
+
+    #----------------------------------------------------------------------------------
+    def readExperiment(self, time):
+        meta = {'notes': '', 'shutter': None, 'scaleFactor': None}
+        path = os.path.join(self.directory, "experiment-"+time+".html")
+        if not os.path.exists(path):
+            return meta
+
+        with open(path, 'rt', encoding='utf-8') as f:
+            html = f.read()
+        shutter = re.search(r'Exposure: <strong>(.*?) &micro;sec', html)
+        if shutter:
+            meta['shutter'] = float(shutter.group(1))
+        notes = re.search(r'<h3>Experiment notes</h3>\s*(.*?)\s*</td></tr>', html, re.DOTALL)
+        if notes:
+            meta['notes'] = notes.group(1)
+
+        return meta
+
+#--------------------------------------------------------------------------------------
+# Helpers
+#--------------------------------------------------------------------------------------
+def writeAtomic(path, text):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    temp = path + '.tmp'
+    with open(temp, 'wt', encoding='utf-8') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp, path)
+
+#--------------------------------------------------------------------------------------
+def parseLines(lines):
+    records = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            pass                                 # Torn line from a crash
+
+    return records
+
+#--------------------------------------------------------------------------------------
+if __name__ == '__main__':
+    logbook = Logbook()
+    if len(sys.argv) == 3 and sys.argv[1] == 'import':
+        print('Imported {} entries'.format(logbook.importIndex(sys.argv[2])))
+    elif len(sys.argv) == 2 and sys.argv[1] == 'rebuild':
+        logbook.rebuild()
+        print('Rebuilt {} entries'.format(len(logbook.records())))
+    else:
+        print('Usage: python -m helpers.Logbook rebuild | import <index.html>')
@@ -0,0 +1,63 @@
+#--------------------------------------------------------------------------------------
+# Spectrum plots - one figure reused for every measurement
+#--------------------------------------------------------------------------------------
+
+import io
+import matplotlib
+import numpy as np
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image
+
+#--------------------------------------------------------------------------------------
+# SpectrumRenderer class
+#--------------------------------------------------------------------------------------
+class SpectrumRenderer():
+    # Figure and Agg canvas are created once, later spectra only change the line
+    # data and limits. It does not use pyplot, so it works from any thread as
+    # long as one renderer is not shared between threads.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, figsize=None, dpi=None, color='blue'):
+        figsize = figsize or matplotlib.rcParams['figure.figsize']
+        dpi = dpi or matplotlib.rcParams['figure.dpi']
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_xlabel('Wavelength (nm)')
+        self.line, = self.ax.plot([], [], color=color)
+        self.color = color
+        self.band = None
+
+    #----------------------------------------------------------------------------------
+    def update(self, wavelength, spectrum, std=None):
+        self.line.set_data(wavelength, spectrum)
+
+        if self.band is not None:
+            self.band.remove()
+            self.band = None
+        if std is not None:
+            self.band = self.ax.fill_between(wavelength, spectrum - std, spectrum + std,
+                                             color=self.color, alpha=0.2)
+
+        self.ax.relim()
+        self.ax.autoscale_view()
+
+    #----------------------------------------------------------------------------------
+    def render(self, format='png'):
+        buf = io.BytesIO()
+        self.figure.savefig(buf, format=format)
+
+        return buf.getvalue()
+
+    #----------------------------------------------------------------------------------
+    def image(self, size=None):
+        # PIL image of the plot, e.g. for the LCD
+        self.canvas.draw()
+        img = Image.fromarray(np.asarray(self.canvas.buffer_rgba())).convert('RGB')
+        if size is not None:
+            img = img.resize(size)
+
+        return img
@@ -3,20 +3,30 @@
 #--------------------------------------------------------------------------------------
 
 import io
-import csv
 import time
 import ipywidgets as widgets
-import matplotlib.pyplot as plt
 import numpy as np
 
-from picamera import PiCamera
 from PIL import Image, ImageDraw
 from time import sleep, strftime
 from IPython.display import display, clear_output, HTML, IFrame
+from IPython.display import Image as DisplayImage
 
 from streaming.server import StreamingServer
 from streaming import svg
 
+from helpers.Capture import FrameBuffer, BayerFrame, bayerPlanes, bayerCrop, bayerImage, stackFrames
+from helpers.Spectrum import SpectrumEngine, normalizeBrightness
+from helpers.Live import LiveSpectrum
+from helpers.DarkFrames import DarkLibrary, subtractDark
+from helpers.Writer import ArtifactWriter, toImage, saveImage, writeBytes
+from helpers.Plot import SpectrumRenderer
+from helpers.Logbook import Logbook
+from helpers.Archive import SpectrumArchive, saveCSV
+from helpers.Catalog import Catalog
+from helpers.Calibration import CalibrationProfile, CalibrationStore, autoCalibrate
+from helpers.Devices import openCamera, openLCD, openNeoPixel
+
 #--------------------------------------------------------------------------------------
 # Spectrometer class
 #--------------------------------------------------------------------------------------
@@ -44,9 +54,45 @@ class Spectrometer():
     processed = None
     spectrum = None
     wavelength = None
+    columnSpectrum = None     # One value per camera column, before resampling to uniformGrid
+    columnStd = None
     
+    # Capture mode - 'rgb' or 'yuv' capture unencoded into a reused buffer, 'jpeg' decodes a JPEG
+    # and 'bayer' reads the 10-bit raw sensor data
+    captureMode = 'rgb'
+    frame = None
+    bayer = None
+    pixelScale = 1.0
+
+    # Frame stacking - optional relative noise target to stop early
+    stack = None
+    spectrumStd = None
+    noiseTarget = None
+
+    # Live spectrum from the video stream
+    live = None
+
+    # Dark frames - subtracted instead of the baseline when available. Missing darks
+    # are captured on demand only if the light can be switched off (NeoPixel).
+    useDark = True
+    darks = DarkLibrary()
+
+    # Calibration profile fitted to the lines of a reference lamp (CFL). When set it
+    # replaces the two line calibration, Line 1 and 2 then show where it puts them.
+    calibration  = None
+    calibrations = CalibrationStore()
+    calibrationKind = 'polynomial'       # or 'spline' through the matched lines
+
+    # Uniform wavelength grid (start, stop, step) in nm for the spectra, e.g. (400, 700, 0.5).
+    # None keeps one value per camera column.
+    uniformGrid = None
+
+    # Show the spectrum plot on the LCD after processing instead of the cropped image
+    lcdPlot = False
+
     # Other
-    scaleFactor = 1
+    scaleFactor = 1.0
+    work = None
     splash = Image.open('docs/images/specBackground.png')
     mask   = Image.open('docs/images/mask.png')
 
@@ -71,17 +117,21 @@ class Spectrometer():
                                         layout=widgets.Layout(width='auto'))
     m_rot   = widgets.BoundedFloatText(value=270.0, min=0.0, max=360.0, step=0.5,
                                        description="Rotation:", disabled=False, layout=widgets.Layout(width='auto'))
+    m_frames = widgets.BoundedIntText(value=1, min=1, max=200, step=1,
+                                      description="Frames:", disabled=False, layout=widgets.Layout(width='auto'))
 
     m_neopix = widgets.ColorPicker(concise=False, description='NeoPixel', value='#000000', disabled=True, 
                                    layout=widgets.Layout(width='auto'))
 
     m_butstart = widgets.Button(button_style='primary', description='Update Feed', disabled=False,
                             layout=widgets.Layout(width='100%', margin='10px 0px 0px 0px'))
+    m_butlive = widgets.ToggleButton(value=False, button_style='info', description='Live Spectrum', disabled=False,
+                            layout=widgets.Layout(width='100%', margin='10px 0px 0px 0px'))
     m_butraw = widgets.Button(button_style='success', description='Take Measurement', disabled=False,
                             layout=widgets.Layout(width='100%', margin='10px 0px 0px 0px'))
     
     m_left   = widgets.VBox([m_head1, m_name, m_light, m_sample, m_notes, 
-                             m_head2, m_neopix, m_expo, m_rot, m_butstart, m_butraw, butclose],
+                             m_head2, m_neopix, m_expo, m_rot, m_frames, m_butstart, m_butlive, m_butraw, butclose],
                          layout=widgets.Layout(height=height, border='solid 1px #ddd'))
     m_tab    = widgets.HBox([m_left, out])
     
@@ -102,9 +152,11 @@ class Spectrometer():
 
     p_butpro = widgets.Button(button_style='primary', description='Process', disabled=True,
                             layout=widgets.Layout(width='100%', margin='25px 0px 0px 0px'))
+    p_butcal = widgets.Button(button_style='info', description='Auto Calibrate', disabled=True,
+                            layout=widgets.Layout(width='100%', margin='10px 0px 0px 0px'))
         
     p_left   = widgets.VBox([p_head, p_time, p_head1, p_crop[0], p_crop[1], p_crop[2], p_crop[3],
-                           p_head2, p_pix1, p_pix2, p_butpro], layout=widgets.Layout(height=height, border='solid 1px #ddd'))
+                           p_head2, p_pix1, p_pix2, p_butpro, p_butcal], layout=widgets.Layout(height=height, border='solid 1px #ddd'))
     p_tab    = widgets.HBox([p_left, out])
 
 
@@ -124,10 +176,21 @@ class Spectrometer():
             self.updateStream()
             self.dirty = False
 
+        self.stopLive()                  # Framerate can only change with all recordings stopped
         self.scamera.updateFeed(None)
 
+    #----------------------------------------------------------------------------------
+    def toggleLive(self, change):
+        if change['new']:
+            self.startLive()
+        else:
+            self.stopLive()
+
     #----------------------------------------------------------------------------------
     def updateOverlay(self,c):
+        if self.live is not None and self.live.running:
+            self.configureLive()
+            return
         self.scamera.updateOverlayProcess(self.p_crop, self.p_pix1.value, self.p_pix2.value)
 
     #----------------------------------------------------------------------------------
@@ -140,6 +203,7 @@ class Spectrometer():
         self.tabs.selected_index = 1
         self.status.value = "Please wait .."
         
+        self.stopLive()
         self.scamera.stopStream()
         self.p_time.value = strftime("%Y%m%d-%H%M%S") 
         self.setLCD(self.splash) 
@@ -153,12 +217,30 @@ class Spectrometer():
         self.p_butpro.disabled = True
         self.status.value = "Processing started .."
 
-        self.raw = self.takePicture()
+        c = [int(v.value) for v in self.p_crop]
+        frames = int(self.m_frames.value)
+        mode = self.captureMode if frames == 1 else self.stackMode()
         self.dirty = True
 
-        self.status.value = "Cropping .."
-        cropvals = [int(v.value) for v in self.p_crop]
-        self.processed = self.raw.crop(cropvals)
+        dark = None
+        if self.useDark:
+            self.status.value = "Looking up dark frame .."
+            dark = self.getDark(mode)
+
+        if frames > 1:
+            self.status.value = "Stacking frames .."
+            self.raw = self.takeStack(c, frames)
+            self.processed = self.stack.mean
+        else:
+            self.stack = None
+            self.raw = self.takePicture()
+
+            self.status.value = "Cropping .."
+            self.processed = self.cropFrame(c)
+
+        if dark is not None:
+            self.status.value = "Subtracting dark frame .."
+            self.processed = self.subtractDark(self.processed, self.cropFrame(c, dark))
 
         self.status.value = "Updating LCD .."
         self.setLCD(self.processed)
@@ -167,151 +249,334 @@ class Spectrometer():
         self.processed = self.adjustBrightness(self.processed)
 
         self.status.value = "Converting to spectrum .."
-        self.wavelength, self.spectrum = self.getSpectrum(self.processed, self.waveL1, self.waveL2, 
-                                                          int(self.p_pix1.value), int(self.p_pix2.value))
-
+        baseline = 0 if dark is not None else None
+        if self.calibration is not None:
+            self.columnSpectrum = self.engine.reduce(self.processed, baseline=baseline)
+            wavelength = self.engine.profileAxis(len(self.columnSpectrum), self.calibration, c[0], self.pixelScale)
+            self.showCalibration(c)
+        else:
+            wavelength, self.columnSpectrum = self.getSpectrum(self.processed, self.waveL1, self.waveL2, 
+                                                               int(self.p_pix1.value) * self.pixelScale,
+                                                               int(self.p_pix2.value) * self.pixelScale,
+                                                               baseline=baseline)
+        self.columnStd = None
+        if self.stack is not None:
+            self.columnStd = self.scaleFactor * self.stack.spectrumError(self.engine.weights)
+        self.applyAxis(wavelength)
+
+        # One render, the same JPEG goes to the notebook and the logbook
+        self.renderer.update(self.wavelength, self.spectrum, self.spectrumStd)
+        plot = self.renderer.render('jpeg')
         with self.out:
-            fig, ax = plt.subplots()
-            ax.set_xlabel('Wavelength (nm)')
-            ax.set_xlim(auto=True)
-            ax.set_ylim(auto=True)
-            ax.plot(self.wavelength, self.spectrum, color='blue')
-
             clear_output(wait=True)
-            display(ax.figure)
-            plt.savefig("docs/images/spectrum-"+self.p_time.value+".jpg")
-            plt.close()
+            display(DisplayImage(data=plot, format='jpeg'))
+        if self.lcdPlot:
+            self.setLCD(self.renderer.image())
 
+        # Files are written in the background, the buffers are reused by the next shot
         self.status.value = "Saving results .."
-        self.raw.save("docs/images/raw-"+self.p_time.value+".jpg")
-        self.processed.save("docs/images/processed-"+self.p_time.value+".jpg")
-        self.saveCSV("docs/data/spectrum-"+self.p_time.value+".csv", self.spectrum, self.wavelength)
-
-        self.status.value = "Creating web pages .."
-        self.createHTML()
+        meta = self.getMetadata()
+        stamp = meta['time']
+        if mode == 'bayer':
+            self.writer.submit('raw image', writeBytes, "docs/images/raw-"+stamp+".jpg", self.bayer.jpeg())
+        else:
+            self.writer.submit('raw image', saveImage, "docs/images/raw-"+stamp+".jpg", np.array(self.raw))
+        self.writer.submit('processed image', saveImage, "docs/images/processed-"+stamp+".jpg", 
+                           np.array(self.processed))
+        self.writer.submit('spectrum plot', writeBytes, "docs/images/spectrum-"+stamp+".jpg", plot)
+        self.writer.submit('spectrum data', self.saveCSV, "docs/data/spectrum-"+stamp+".csv", 
+                           self.spectrum, self.wavelength)
+        self.writer.submit('spectrum archive', self.archive.append, meta, self.wavelength, self.spectrum)
+        self.writer.submit('web pages', self.createHTML, meta)
+        self.writer.submit('catalog entry', self.catalog.add, meta, self.wavelength, self.spectrum)
         self.updateLight("#000000")
+        self.p_butcal.disabled = False
         
-        self.status.value = "Done .."
+        self.status.value = "Done, saving results in the background .."
 
     #--------------------------------------------------------------------------------------
-    def saveCSV(self,fname, spectrum, wavelength):
-        with open(fname, 'w', encoding='UTF8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["Wavelength","Intensity"])
+    def applyAxis(self, wavelength):
+        # Spectrum and error of the camera columns, on the uniform grid if one is set
+        self.wavelength, self.spectrum, self.spectrumStd = wavelength, self.columnSpectrum, self.columnStd
+        if self.uniformGrid is not None:
+            self.wavelength, self.spectrum = self.engine.resample(self.columnSpectrum, wavelength,
+                                                                  *self.uniformGrid)
+            if self.columnStd is not None:
+                self.spectrumStd = self.engine.resample(self.columnStd, wavelength, *self.uniformGrid)[1]
+
+    #--------------------------------------------------------------------------------------
+    def runCalibrate(self,b):
+        # Fits the last processed spectrum, taken with a CFL, to the known CFL lines
+        c = [int(v.value) for v in self.p_crop]
+        columns = c[0] + np.arange(float(len(self.columnSpectrum))) / self.pixelScale
+        try:
+            profile = autoCalibrate(self.columnSpectrum, columns, kind=self.calibrationKind,
+                                    orientation=self.orientation(), name='cfl-' + self.p_time.value)
+        except ValueError as e:
+            self.status.value = "Calibration failed - {} ..".format(e)
+            return
+
+        self.setCalibration(profile, c)
+        self.status.value = "Calibrated with {} lines, rms {:.2f} nm ..".format(len(profile.matches), profile.rms)
+
+    #--------------------------------------------------------------------------------------
+    def orientation(self):
+        # 1 when the wavelength rises with the column, as Line 1 and 2 are set
+        try:
+            step = (int(self.p_pix2.value) - int(self.p_pix1.value)) * (self.waveL2 - self.waveL1)
+        except ValueError:
+            return 1
+        return -1 if step < 0 else 1
+
+    #--------------------------------------------------------------------------------------
+    def calibrateLines(self, lines, kind=None):
+        # Calibration from N known lines, (pixel, wavelength) pairs with the pixel
+        # counted from the left of the crop like Line 1 and 2
+        c = [int(v.value) for v in self.p_crop]
+        profile = CalibrationProfile.fit([(c[0] + p, w) for p, w in lines], kind or self.calibrationKind,
+                                         name='lines-' + strftime("%Y%m%d-%H%M%S"))
+        self.setCalibration(profile, c)
+
+        return profile
+
+    #--------------------------------------------------------------------------------------
+    def setCalibration(self, profile, c):
+        self.calibration = profile
+        self.calibrations.save(profile)
+        self.showCalibration(c)
+
+        if self.columnSpectrum is not None:
+            self.applyAxis(self.engine.profileAxis(len(self.columnSpectrum), profile, c[0], self.pixelScale))
+            self.renderer.update(self.wavelength, self.spectrum, self.spectrumStd)
+            with self.out:
+                clear_output(wait=True)
+                display(DisplayImage(data=self.renderer.render('jpeg'), format='jpeg'))
 
-            for l,i in zip(wavelength, spectrum):
-                writer.writerow([l,i])
+    #--------------------------------------------------------------------------------------
+    def showCalibration(self, c):
+        # Line 1 and 2 at the calibration wavelengths of the profile, for the overlay and live mode
+        self.p_pix1.value = str(int(round(float(self.calibration.column(self.waveL1)) - c[0])))
+        self.p_pix2.value = str(int(round(float(self.calibration.column(self.waveL2)) - c[0])))
 
     #--------------------------------------------------------------------------------------
-    def createHTML(self):
-
-        shutter = 1000000 * float(self.m_expo.value)
-
-        hfile="docs/experiment-"+self.p_time.value+".html"
-
-        with open("docs/template.html", "rt") as fin:
-            with open(hfile, "wt") as fout:
-                for line in fin:
-                    line = line.replace('%%lightSource%%', str(self.m_light.value))
-                    line = line.replace('%%measurementTaken%%', str(self.p_time.value))
-                    line = line.replace('%%scientistName%%', str(self.m_name.value))
-                    line = line.replace('%%transmissionSample%%', str(self.m_sample.value))
-                    line = line.replace('%%shutter%%', str(shutter))
-                    line = line.replace('%%experimentNotes%%', str(self.m_notes.value))
-
-                    fout.write(line)
-
-        entry='''<!--%%entry%%-->
-        <tr><td><img src="images/processed-{0}.jpg" align="right">
-            Scientist: <strong>{1}</strong><br>
-            Light source: <strong>{2}</strong><br>
-            Transmission sample: <strong>{3}</strong><br>
-            Date and time: <strong>{0}</strong><br>
-            <a href="experiment-{0}.html" target="_blank"><button>Details</button></a></td></tr>
-            '''
-
-        out=""
-        with open("docs/index.html", "rt") as fin:
-            for line in fin:
-                out += line.replace('<!--%%entry%%-->', 
-                       entry.format(self.p_time.value, self.m_name.value, 
-                                    self.m_light.value, self.m_sample.value))
-
-        with open("docs/index.html", "wt") as fout:
-            fout.write(out)
+    def manualCalibration(self,c):
+        # Typing in a line position goes back to the two line calibration
+        self.calibration = None
+        self.updateOverlay(c)
+
+    #--------------------------------------------------------------------------------------
+    def getMetadata(self):
+        # Snapshot of the experiment, the widgets may change before it is saved.
+        # A stack records the format it was taken in and the frames it averaged,
+        # which is fewer than requested when the noise target was reached early.
+        if self.stack is not None:
+            mode, frames = self.stackMode(), self.stack.count
+        else:
+            mode, frames = self.captureMode, 1
+        return {'time':        self.p_time.value,
+                'name':        self.m_name.value,
+                'light':       self.m_light.value,
+                'sample':      self.m_sample.value,
+                'notes':       self.m_notes.value,
+                'shutter':     1000000 * float(self.m_expo.value),
+                'mode':        mode,
+                'frames':      frames,
+                'crop':        [int(v.value) for v in self.p_crop],
+                'pixels':      [int(self.p_pix1.value), int(self.p_pix2.value)],
+                'wavelengths': [self.waveL1, self.waveL2],
+                'calibration': self.calibration.toDict() if self.calibration is not None else None,
+                'grid':        self.uniformGrid,
+                'scaleFactor': self.scaleFactor}
+
+    #--------------------------------------------------------------------------------------
+    def saveCSV(self,fname, spectrum, wavelength):
+        saveCSV(fname, spectrum, wavelength)
+
+    #--------------------------------------------------------------------------------------
+    def createHTML(self, meta=None):
+        # Experiment page and a new logbook entry, see helpers/Logbook.py
+        if meta is None:
+            meta = self.getMetadata()
+
+        self.logbook.writeExperiment(meta)
+        self.logbook.add(meta)
             
     #----------------------------------------------------------------------------------
     # Spectrometer methods
     #----------------------------------------------------------------------------------
-    def getSpectrum(self, processed, wavelength1, wavelength2, pixel1, pixel2):
-        spectrum = np.asarray(processed)            # Convery to Numpy array for calculations
-        spectrum = np.average(spectrum, axis=(0,2)) # Average columns and color values
-        spectrum = spectrum-(0.9*min(spectrum))     # Subtract baseline
+    def getSpectrum(self, processed, wavelength1, wavelength2, pixel1, pixel2, roi=None, baseline=None):
+        # Averages rows and color values (weighted by engine.weights) and converts
+        # pixels to wavelengths, see helpers/Spectrum.py
+        return self.engine.spectrum(processed, wavelength1, wavelength2, pixel1, pixel2, 
+                                    roi=roi, baseline=baseline)
 
-        if (wavelength1 > wavelength2):             # Swap if wavelengths are in wrong order
-            temp = wavelength1
-            wavelength1 = wavelength2
-            wavelength2 = temp
+    #--------------------------------------------------------------------------------------
+    def adjustBrightness(self,image):
+        # Scales to 0..255 in float32 - in place for float32 frames (stacks), otherwise
+        # into a working buffer reused between shots. Only toImage() quantizes.
+        pixels = np.asarray(image)
+        if pixels.dtype == np.float32 and pixels.flags.writeable:
+            out = pixels
+        else:
+            if self.work is None or self.work.shape != pixels.shape:
+                self.work = np.empty(pixels.shape, dtype=np.float32)
+            out = self.work
 
-        wavelength = np.arange(float(len(spectrum)))
-        factor = (wavelength2 - wavelength1) / (pixel2 - pixel1)
-        wavelength = wavelength1 + (wavelength - pixel1) * factor
+        adjusted, self.scaleFactor = normalizeBrightness(pixels, out)
 
-        return wavelength, spectrum    
+        return adjusted
 
     #--------------------------------------------------------------------------------------
-    def adjustBrightness(self,image):
-        pixels = np.asarray(image)
-        maxcol = [pixels[:,:,0].max(),pixels[:,:,1].max(),pixels[:,:,2].max()]
-        self.scaleFactor = int(255 / max(maxcol))
-        adjusted = self.scaleFactor*pixels
-        
-        return Image.fromarray(np.uint8(adjusted))
+    def takePicture(self, mode=None):  
+        camera = self.scamera.camera
+        mode = mode or self.captureMode
+
+        if mode == 'bayer':
+            if self.bayer is None:
+                self.bayer = BayerFrame(camera.revision)
+            return self.bayer.capture(camera)
+
+        if mode == 'jpeg':
+            stream = io.BytesIO()
+            camera.capture(stream, format='jpeg')
+            stream.seek(0)
+            return np.asarray(Image.open(stream))
+
+        # Unencoded capture into a buffer that is reused between shots
+        if self.frame is None or not self.frame.matches(camera.resolution, mode):
+            self.frame = FrameBuffer(camera.resolution, mode)
+
+        return self.frame.capture(camera)
+
+    #--------------------------------------------------------------------------------------
+    def stackMode(self):
+        return self.captureMode if self.captureMode in ('rgb', 'yuv') else 'rgb'
+
+    #--------------------------------------------------------------------------------------
+    def takeStack(self, crop, count):
+        # Averages the crop of count frames from the video port, returns the last frame
+        camera = self.scamera.camera
+        fmt = self.stackMode()
+
+        if self.frame is None or not self.frame.matches(camera.resolution, fmt):
+            self.frame = FrameBuffer(camera.resolution, fmt)
+
+        self.pixelScale = 1.0
+        self.stack = stackFrames(camera, self.frame, crop, count, self.noiseTarget,
+                                 weights=self.engine.weights)
+        self.status.value = "Stacked {} frames ..".format(self.stack.count)
+
+        return self.frame.array
+
+    #--------------------------------------------------------------------------------------
+    def cropFrame(self, c, raw=None):
+        if raw is None:
+            raw = self.raw
+            self.pixelScale = 1.0
+        if raw.ndim == 3 or self.captureMode != 'bayer':
+            return raw[c[1]:c[3], c[0]:c[2]]
+
+        # Crop straight from the Bayer planes, calibration pixels scale with the crop
+        camera = self.scamera.camera
+        planes = bayerPlanes(raw, self.bayer.order, camera.rotation)
+        box = bayerCrop(planes, c, camera.resolution)
+        self.pixelScale = (box[2] - box[0]) / (c[2] - c[0])
+
+        return bayerImage(planes, box)
+
+    #--------------------------------------------------------------------------------------
+    def darkKey(self, mode):
+        camera = self.scamera.camera
+        return self.darks.key(mode, camera.resolution, camera.shutter_speed, camera.iso, camera.rotation)
 
     #--------------------------------------------------------------------------------------
-    def takePicture(self):  
-        stream = io.BytesIO()
-        self.scamera.camera.capture(stream, format='jpeg')
-        stream.seek(0)
-        raw = Image.open(stream)
+    def getDark(self, mode):
+        capture = None
+        if self.neopixel:
+            capture = lambda: self.captureDark(mode)
+        return self.darks.get(self.darkKey(mode), capture)
 
-        return raw
+    #--------------------------------------------------------------------------------------
+    def captureDark(self, mode=None, store=False):
+        # Light off for the dark frame, restored afterwards. Both times one exposure
+        # passes so no frame in flight sees the light change. Without NeoPixel control
+        # make sure the light source is off before calling this with store=True.
+        mode = mode or self.captureMode
+        if self.neopixel:
+            self.pixels.fill((0,0,0))
+            sleep(self.scamera.exposure)
+        try:
+            self.status.value = "Taking dark frame .."
+            dark = np.array(self.takePicture(mode))     # Copy, the capture buffer is reused
+        finally:
+            if self.neopixel:
+                self.pixels.fill(hex_to_rgb(self.m_neopix.value))
+                sleep(self.scamera.exposure)
+
+        if store:
+            self.darks.put(self.darkKey(mode), dark)
+        return dark
+
+    #--------------------------------------------------------------------------------------
+    def subtractDark(self, pixels, dark):
+        if pixels.dtype == np.float32 and pixels.flags.writeable:
+            out = pixels
+        else:
+            if self.work is None or self.work.shape != pixels.shape:
+                self.work = np.empty(pixels.shape, dtype=np.float32)
+            out = self.work
+
+        return subtractDark(pixels, dark, out)
 
     #----------------------------------------------------------------------------------
     # Methods
     #----------------------------------------------------------------------------------
     def initNeoPixel(self):
-        import time
-        import board
-        import busio
-        from rainbowio import colorwheel
-        from adafruit_seesaw import seesaw, neopixel
-
-        NEOPIXEL_PIN = 9  # Pin NeoPixel is connected to (9, 10, 11, 14, 15, 24, or 25 )
-        NEOPIXEL_NUM = 1  # no more than 60!
-
-        i2c_bus = busio.I2C(board.SCL, board.SDA)
-        ss = seesaw.Seesaw(i2c_bus)
-        self.pixels = neopixel.NeoPixel(ss, NEOPIXEL_PIN, NEOPIXEL_NUM)
-
-        self.pixels.brightness = 1.0 # Full brightness
-        self.pixels.fill((0,0,0))    # Light off
+        self.pixels = openNeoPixel(self.backend)
         
     #----------------------------------------------------------------------------------
     def initLCD(self):
-        import ST7735
-
-        self.disp = ST7735.ST7735(port=0,cs=1,dc=9,backlight=12,rotation=270,spi_speed_hz=10000000)
-        self.disp.begin()
+        self.disp = openLCD(self.backend)
         self.setLCD(self.splash)
 
     #----------------------------------------------------------------------------------
     def setLCD(self, img):
         if (self.lcd):
+            if isinstance(img, np.ndarray):
+                img = toImage(img)
             lcd=img.resize((self.disp.width, self.disp.height))
             lcd.paste(self.mask, (0,0), self.mask)
             self.disp.display(lcd)
 
+    #----------------------------------------------------------------------------------
+    def configureLive(self):
+        self.live.configure([int(v.value) for v in self.p_crop], self.waveL1, self.waveL2,
+                            int(self.p_pix1.value), int(self.p_pix2.value))
+
+    #----------------------------------------------------------------------------------
+    def startLive(self):
+        if self.live is None:
+            self.live = LiveSpectrum(self.scamera.camera, self.scamera.server, self.engine.weights)
+        try:
+            self.configureLive()
+        except ValueError:
+            self.status.value = "Set crop area and calibration lines first .."
+            self.m_butlive.value = False
+            return
+        self.live.start()
+        self.status.value = "Live spectrum running .."
+
+    #----------------------------------------------------------------------------------
+    def stopLive(self):
+        if self.live is not None and self.live.running:
+            self.live.stop()
+            self.m_butlive.value = False
+            self.status.value = "Live spectrum stopped .."
+
+    #----------------------------------------------------------------------------------
+    def setStatus(self, message):
+        self.status.value = message
+
     #----------------------------------------------------------------------------------
     def setCrop(self,crop):
         for i, c in enumerate(crop):
@@ -330,10 +595,19 @@ class Spectrometer():
         self.updateStream()
         
     #----------------------------------------------------------------------------------
-    def __init__(self, lcd, neopixel):
+    def __init__(self, lcd, neopixel, backend=None):
+        # backend 'pi' for the hardware, 'sim' for simulated devices, see helpers/Devices.py
         self.lcd = lcd
         self.neopixel = neopixel
-        self.scamera = StreamingCamera(self.m_expo, self.m_rot)
+        self.backend = backend
+        self.engine = SpectrumEngine()
+        self.writer = ArtifactWriter(report=self.setStatus)
+        self.renderer = SpectrumRenderer()
+        self.logbook = Logbook()
+        self.archive = SpectrumArchive()
+        self.catalog = Catalog()
+        self.calibration = self.calibrations.load()
+        self.scamera = StreamingCamera(self.m_expo, self.m_rot, backend)
         
         if (neopixel):
             self.m_neopix.disabled = False
@@ -344,14 +618,16 @@ class Spectrometer():
             self.initLCD()
 
         self.m_butstart.on_click(self.updateFeed)
+        self.m_butlive.observe(self.toggleLive, names='value')
         self.m_butraw.on_click(self.runMeasure)
         self.p_butpro.on_click(self.runProcess)
+        self.p_butcal.on_click(self.runCalibrate)
         self.butclose.on_click(self.shutdown)
         
         for i in range(4):
             self.p_crop[i].on_submit(self.updateOverlay)
-        self.p_pix1.on_submit(self.updateOverlay)
-        self.p_pix2.on_submit(self.updateOverlay)
+        self.p_pix1.on_submit(self.manualCalibration)
+        self.p_pix2.on_submit(self.manualCalibration)
                 
     #----------------------------------------------------------------------------------
     def shutdown(self, b):
@@ -359,6 +635,9 @@ class Spectrometer():
 
     #----------------------------------------------------------------------------------
     def close(self):
+        self.stopLive()
+        self.writer.close()
+        self.catalog.close()
         self.scamera.server.close()
         self.scamera.camera.close()  
         print('Spectrometer object deleted')
@@ -429,14 +708,14 @@ class StreamingCamera():
         print('StreamingCamera object close')
     
     #----------------------------------------------------------------------------------
-    def __init__(self, expo, rot):
+    def __init__(self, expo, rot, backend=None):
         streaming_bitrate = 1000000
         mdns_name = ''        
         
         self.expo = expo
         self.rot  = rot
         
-        self.camera = PiCamera()
+        self.camera = openCamera(backend)
         self.camera.resolution = (648, 486)        
         self.camera.framerate= 1. / self.exposure
         self.camera.rotation = 270
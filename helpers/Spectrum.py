@@ -0,0 +1,195 @@
+#--------------------------------------------------------------------------------------
+# Spectrum extraction
+#--------------------------------------------------------------------------------------
+
+import numpy as np
+
+from collections import OrderedDict
+
+#--------------------------------------------------------------------------------------
+# SpectrumEngine class
+#--------------------------------------------------------------------------------------
+class SpectrumEngine():
+    # Reduces the rows of a region of interest to a spectrum with one float32 sum
+    # and maps pixels to wavelengths with cached calibration axes.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, weights=None, cacheSize=16):
+        self.weights   = weights      # Per color channel weights, None averages them
+        self.baseline  = 0.9          # Fraction of the minimum subtracted as baseline
+        self.cacheSize = cacheSize
+        self.axes      = OrderedDict()
+        self.resamplers = OrderedDict()
+
+    #----------------------------------------------------------------------------------
+    def axis(self, width, wavelength1, wavelength2, pixel1, pixel2):
+        if (wavelength1 > wavelength2):             # Swap if wavelengths are in wrong order
+            wavelength1, wavelength2 = wavelength2, wavelength1
+
+        key = (width, pixel1, pixel2, wavelength1, wavelength2)
+        factor = (wavelength2 - wavelength1) / (pixel2 - pixel1)
+
+        return self.cached(key, lambda: wavelength1 + (np.arange(float(width)) - pixel1) * factor)
+
+    #----------------------------------------------------------------------------------
+    def profileAxis(self, width, profile, offset=0, scale=1.0):
+        # Wavelengths of a calibration profile (see helpers/Calibration.py) for a
+        # spectrum starting at frame column offset, scale samples per column
+        key = ('profile', width, profile.key(), offset, scale)
+
+        return self.cached(key, lambda: profile.axis(width, offset, scale))
+
+    #----------------------------------------------------------------------------------
+    def resample(self, spectrum, wavelength, start, stop, step):
+        # Spectrum (or rows of spectra) on a uniform wavelength grid, the resampler
+        # of an axis and grid is built once
+        key = (len(wavelength), hash(np.asarray(wavelength).tobytes()), start, stop, step)
+        resampler = self.cached(key, lambda: Resampler(wavelength, start, stop, step), self.resamplers)
+
+        return resampler.grid, resampler(spectrum)
+
+    #----------------------------------------------------------------------------------
+    def cached(self, key, build, cache=None):
+        cache = self.axes if cache is None else cache
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            return value
+
+        value = build()
+        if isinstance(value, np.ndarray):
+            value.flags.writeable = False           # Shared by all spectra of this calibration
+
+        cache[key] = value
+        if len(cache) > self.cacheSize:
+            cache.popitem(last=False)
+
+        return value
+
+    #----------------------------------------------------------------------------------
+    def coefficients(self, wavelength1, wavelength2, pixel1, pixel2):
+        # Same calibration as polynomial coefficients, wavelength = c0 + c1 * pixel
+        if (wavelength1 > wavelength2):
+            wavelength1, wavelength2 = wavelength2, wavelength1
+        factor = (wavelength2 - wavelength1) / (pixel2 - pixel1)
+
+        return [wavelength1 - pixel1 * factor, factor]
+
+    #----------------------------------------------------------------------------------
+    def reduce(self, frame, roi=None, weights=None, baseline=None):
+        pixels = np.asarray(frame)
+        if roi is not None:                         # roi = [x1, y1, x2, y2] like the crop
+            pixels = pixels[roi[1]:roi[3], roi[0]:roi[2]]
+
+        rows = pixels.shape[0]
+        columns = pixels.sum(axis=0, dtype=np.float32)
+
+        if columns.ndim == 2:                       # Combine color channels
+            if weights is None:
+                weights = self.weights
+            if weights is None:
+                spectrum = columns.sum(axis=1) / (rows * columns.shape[1])
+            else:
+                weights = np.asarray(weights, dtype=np.float32)
+                spectrum = columns @ (weights / (rows * weights.sum()))
+        else:
+            spectrum = columns / rows
+
+        if baseline is None:
+            baseline = self.baseline
+        if baseline:
+            spectrum -= baseline * spectrum.min()   # Subtract baseline
+
+        return spectrum
+
+    #----------------------------------------------------------------------------------
+    def spectrum(self, frame, wavelength1, wavelength2, pixel1, pixel2, roi=None, weights=None,
+                 baseline=None):
+        spectrum = self.reduce(frame, roi, weights, baseline)
+        wavelength = self.axis(len(spectrum), wavelength1, wavelength2, pixel1, pixel2)
+
+        return wavelength, spectrum
+
+#--------------------------------------------------------------------------------------
+# Resampler class
+#--------------------------------------------------------------------------------------
+class Resampler():
+    # Linear interpolation from a fixed wavelength axis onto a uniform grid, kept as
+    # a sparse matrix - two samples and their weights for every grid point. Applying
+    # it is a gather and a multiply-add, for one spectrum or rows of them. The grid
+    # only covers the wavelengths of the axis.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, wavelength, start, stop, step):
+        w = np.asarray(wavelength, dtype=np.float64)
+        order = np.arange(len(w))
+        if w[-1] < w[0]:                            # Spectrum running from red to blue
+            order = order[::-1]
+        ws = w[order]
+
+        grid = np.arange(start, stop + step / 2, step, dtype=np.float64)
+        grid = grid[(grid >= ws[0]) & (grid <= ws[-1])]
+        pos = np.clip(np.searchsorted(ws, grid, side='right') - 1, 0, len(ws) - 2)
+        frac = (grid - ws[pos]) / (ws[pos + 1] - ws[pos])
+
+        self.width  = len(w)
+        self.grid   = grid.astype(np.float32)
+        self.index  = np.stack([order[pos], order[pos + 1]])
+        self.weight = np.stack([1 - frac, frac]).astype(np.float32)
+        for a in (self.grid, self.index, self.weight):
+            a.flags.writeable = False
+
+    #----------------------------------------------------------------------------------
+    def matrix(self):
+        # Dense (grid, axis) matrix of the same interpolation, spectra @ matrix.T
+        m = np.zeros((len(self.grid), self.width), dtype=np.float32)
+        rows = np.arange(len(self.grid))
+        np.add.at(m, (rows, self.index[0]), self.weight[0])
+        np.add.at(m, (rows, self.index[1]), self.weight[1])
+        return m
+
+    #----------------------------------------------------------------------------------
+    def __call__(self, spectra):
+        s = np.asarray(spectra, dtype=np.float32)
+        return s[..., self.index[0]] * self.weight[0] + s[..., self.index[1]] * self.weight[1]
+
+#--------------------------------------------------------------------------------------
+def normalizeBrightness(pixels, out=None, fullScale=255.0):
+    # Scales the brightest color value to fullScale in float32 without rounding.
+    # Works in place if out is pixels, otherwise into the (reused) out buffer.
+    peak = float(pixels.max())
+    scale = fullScale / peak if peak > 0 else 1.0
+
+    if out is None:
+        out = np.empty(pixels.shape, dtype=np.float32)
+    np.multiply(pixels, np.float32(scale), out=out)
+
+    return out, scale
+
+#--------------------------------------------------------------------------------------
+def findPeaks(spectrum, threshold=0.05, count=None, distance=0):
+    # Indices of the local maxima higher than threshold (a fraction of the range
+    # of the spectrum) above its minimum, strongest first. With a distance, peaks
+    # closer than that to a stronger one are dropped.
+    s = np.asarray(spectrum, dtype=np.float32)
+    if len(s) < 3:
+        return np.empty(0, dtype=np.intp)
+
+    low = s.min()
+    level = low + threshold * (s.max() - low)
+    mid = s[1:-1]
+    peaks = np.flatnonzero((mid > s[:-2]) & (mid >= s[2:]) & (mid > level)) + 1
+
+    peaks = peaks[np.argsort(-s[peaks], kind='stable')]
+    if distance > 1:
+        taken = np.zeros(len(s), dtype=bool)
+        keep = []
+        for p in peaks:
+            if not taken[p]:
+                keep.append(p)
+                taken[max(p - distance + 1, 0):p + distance] = True
+        peaks = np.array(keep, dtype=np.intp)
+    if count is not None:
+        peaks = peaks[:count]
+
+    return peaks
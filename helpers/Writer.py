@@ -0,0 +1,118 @@
+#--------------------------------------------------------------------------------------
+# Artifact writer - saves measurement results in the background
+#--------------------------------------------------------------------------------------
+
+import logging
+import queue
+import threading
+import time
+import numpy as np
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+#--------------------------------------------------------------------------------------
+# ArtifactWriter class
+#--------------------------------------------------------------------------------------
+class ArtifactWriter():
+    # Jobs wait on a bounded queue and run on a small pool of threads. When the
+    # queue is full submit() blocks, so a slow SD card throttles the next
+    # measurement instead of piling up unsaved results in memory.
+
+    #----------------------------------------------------------------------------------
+    def __init__(self, workers=2, maxsize=16, report=None):
+        self.report  = report                 # Called with status messages, any thread
+        self.queue   = queue.Queue(maxsize)
+        self.lock    = threading.Lock()
+        self.pending = 0
+        self.failed  = 0                      # Failed jobs since the writer was last idle
+        self.errors  = []
+        self.threads = [threading.Thread(target=self._run, daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    #----------------------------------------------------------------------------------
+    def submit(self, description, func, *args, **kwargs):
+        with self.lock:
+            self.pending += 1
+        self.queue.put((description, func, args, kwargs))
+
+    #----------------------------------------------------------------------------------
+    def flush(self):
+        self.queue.join()
+
+    #----------------------------------------------------------------------------------
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    #----------------------------------------------------------------------------------
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                break
+
+            description, func, args, kwargs = job
+            start = time.monotonic()
+            try:
+                func(*args, **kwargs)
+                logger.info('Saved %s in %.2f s', description, time.monotonic() - start)
+                error = None
+            except Exception as e:
+                logger.exception('Saving %s failed', description)
+                error = 'Error saving {}: {}'.format(description, e)
+
+            with self.lock:
+                self.pending -= 1
+                pending = self.pending
+                if error:
+                    self.errors.append(error)
+                    self.failed += 1
+                failed = self.failed
+                if pending == 0:
+                    self.failed = 0
+
+            if error:
+                self._report(error)
+            elif pending == 0 and failed:
+                self._report('Results saved, {} failed - see writer.errors ..'.format(failed))
+            elif pending == 0:
+                self._report('All results saved ..')
+            self.queue.task_done()
+
+    #----------------------------------------------------------------------------------
+    def _report(self, message):
+        if self.report is not None:
+            try:
+                self.report(message)
+            except Exception:
+                logger.exception('Status report failed')
+
+#--------------------------------------------------------------------------------------
+# Helpers
+#--------------------------------------------------------------------------------------
+def toImage(pixels):
+    # Only used for display and saving, the processing works on the arrays
+    if pixels.ndim == 3 and pixels.shape[2] == 1:
+        pixels = pixels[:,:,0]
+    if pixels.dtype == np.uint16:
+        pixels = (pixels >> 2).astype(np.uint8)   # 10-bit raw to 8-bit
+    elif pixels.dtype != np.uint8:
+        pixels = np.clip(pixels + 0.5, 0, 255).astype(np.uint8)
+
+    return Image.fromarray(np.ascontiguousarray(pixels))
+
+#--------------------------------------------------------------------------------------
+def saveImage(fname, pixels):
+    toImage(pixels).save(fname)
+
+#--------------------------------------------------------------------------------------
+def writeBytes(fname, data):
+    with open(fname, 'wb') as f:
+        f.write(data)
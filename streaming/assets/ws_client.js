@@ -35,9 +35,71 @@ function createPlayer(width, height, streamControl) {
   canvas.height = height;
   container.appendChild(canvas);
 
+  var spectrum = document.createElement("canvas");
+  spectrum.id = "spectrum"
+  spectrum.style.position = "absolute";
+  spectrum.width = width;
+  spectrum.height = height;
+  container.appendChild(spectrum);
+
   return player
 }
 
+function wavelengthAt(spectrum, i) {
+  if (spectrum.wavelength.length > i)
+    return spectrum.wavelength[i];
+
+  // Calibration polynomial, lowest order first.
+  var c = spectrum.calibration;
+  if (c.length == 0)
+    return null;
+  var w = 0;
+  for (var k = c.length - 1; k >= 0; k--)
+    w = w * i + c[k];
+  return w;
+}
+
+function drawSpectrum(spectrum) {
+  var canvas = document.getElementById("spectrum");
+  if (canvas == null)
+    return;
+  var ctx = canvas.getContext("2d");
+  ctx.clearRect(0, 0, canvas.width, canvas.height);
+
+  var intensity = spectrum.intensity;
+  var n = intensity.length;
+  if (n < 2)
+    return;
+
+  var peak = 0;
+  for (var i = 0; i < n; i++)
+    peak = Math.max(peak, intensity[i]);
+  if (peak <= 0)
+    peak = 1;
+
+  // Spectrum over the lower part of the video.
+  var scale = 0.4 * canvas.height / peak;
+  var step = canvas.width / (n - 1);
+  ctx.beginPath();
+  ctx.moveTo(0, canvas.height - scale * intensity[0]);
+  for (var i = 1; i < n; i++)
+    ctx.lineTo(i * step, canvas.height - scale * intensity[i]);
+  ctx.strokeStyle = "yellow";
+  ctx.lineWidth = 2;
+  ctx.stroke();
+
+  var first = wavelengthAt(spectrum, 0);
+  var last = wavelengthAt(spectrum, n - 1);
+  if (first != null) {
+    ctx.fillStyle = "yellow";
+    ctx.font = "14px sans-serif";
+    ctx.textAlign = "left";
+    ctx.fillText(first.toFixed(0) + " nm", 5, canvas.height - 5);
+    ctx.textAlign = "right";
+    ctx.fillText(last.toFixed(0) + " nm", canvas.width - 5, canvas.height - 5);
+  }
+}
+
 window.onload = function() {
   protobuf.load("messages.proto", function(err, root) {
     if (err)
@@ -52,6 +114,7 @@ window.onload = function() {
     }
 
     var player = null;
+    var pendingSpectrum = null;
     var socket = new WebSocket("ws://" + window.location.host + "/stream");
     socket.binaryType = "arraybuffer";
 
@@ -89,6 +152,16 @@ window.onload = function() {
           }
           img.src = "data:image/svg+xml;charset=utf-8," + clientBound.overlay.svg;
           break;
+        case 'spectrum':
+          // Draw once per animation frame, newer spectra replace waiting ones.
+          if (pendingSpectrum == null) {
+            window.requestAnimationFrame(function() {
+              drawSpectrum(pendingSpectrum);
+              pendingSpectrum = null;
+            });
+          }
+          pendingSpectrum = clientBound.spectrum;
+          break;
         case 'stop':
           console.log("Stopped.");
           break;
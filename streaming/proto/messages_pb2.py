@@ -19,7 +19,7 @@ DESCRIPTOR = _descriptor.FileDescriptor(
   name='messages.proto',
   package='',
   syntax='proto3',
-  serialized_pb=_b('\n\x0emessages.proto\"B\n\x0bServerBound\x12(\n\x0estream_control\x18\x01 \x01(\x0b\x32\x0e.StreamControlH\x00\x42\t\n\x07message\" \n\rStreamControl\x12\x0f\n\x07\x65nabled\x18\x01 \x01(\x08\"\x94\x01\n\x0b\x43lientBound\x12\x17\n\x05start\x18\x01 \x01(\x0b\x32\x06.StartH\x00\x12\x15\n\x04stop\x18\x02 \x01(\x0b\x32\x05.StopH\x00\x12\x17\n\x05video\x18\x03 \x01(\x0b\x32\x06.VideoH\x00\x12\x1b\n\x07overlay\x18\x04 \x01(\x0b\x32\x08.OverlayH\x00\x12\x14\n\x0ctimestamp_us\x18\n \x01(\x04\x42\t\n\x07message\"&\n\x05Start\x12\r\n\x05width\x18\x01 \x01(\r\x12\x0e\n\x06height\x18\x02 \x01(\r\"\x06\n\x04Stop\"\x15\n\x05Video\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"\x16\n\x07Overlay\x12\x0b\n\x03svg\x18\x01 \x01(\tb\x06proto3')
+  serialized_pb=_b('\n\x0emessages.proto\"B\n\x0bServerBound\x12(\n\x0estream_control\x18\x01 \x01(\x0b\x32\x0e.StreamControlH\x00\x42\t\n\x07message\" \n\rStreamControl\x12\x0f\n\x07\x65nabled\x18\x01 \x01(\x08\"\xb3\x01\n\x0b\x43lientBound\x12\x17\n\x05start\x18\x01 \x01(\x0b\x32\x06.StartH\x00\x12\x15\n\x04stop\x18\x02 \x01(\x0b\x32\x05.StopH\x00\x12\x17\n\x05video\x18\x03 \x01(\x0b\x32\x06.VideoH\x00\x12\x1b\n\x07overlay\x18\x04 \x01(\x0b\x32\x08.OverlayH\x00\x12\x1d\n\x08spectrum\x18\x05 \x01(\x0b\x32\t.SpectrumH\x00\x12\x14\n\x0ctimestamp_us\x18\n \x01(\x04\x42\t\n\x07message\"&\n\x05Start\x12\r\n\x05width\x18\x01 \x01(\r\x12\x0e\n\x06height\x18\x02 \x01(\r\"\x06\n\x04Stop\"\x15\n\x05Video\x12\x0c\n\x04\x64\x61ta\x18\x01 \x01(\x0c\"\x16\n\x07Overlay\x12\x0b\n\x03svg\x18\x01 \x01(\t\"b\n\x08Spectrum\x12\x11\n\tintensity\x18\x01 \x03(\x02\x12\x12\n\nwavelength\x18\x02 \x03(\x02\x12\x13\n\x0b\x63\x61libration\x18\x03 \x03(\x01\x12\x1a\n\x12\x66rame_timestamp_us\x18\x04 \x01(\x04\x62\x06proto3')
 )
 
 
@@ -126,7 +126,14 @@ _CLIENTBOUND = _descriptor.Descriptor(
       is_extension=False, extension_scope=None,
       options=None, file=DESCRIPTOR),
     _descriptor.FieldDescriptor(
-      name='timestamp_us', full_name='ClientBound.timestamp_us', index=4,
+      name='spectrum', full_name='ClientBound.spectrum', index=4,
+      number=5, type=11, cpp_type=10, label=1,
+      has_default_value=False, default_value=None,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='timestamp_us', full_name='ClientBound.timestamp_us', index=5,
       number=10, type=4, cpp_type=4, label=1,
       has_default_value=False, default_value=0,
       message_type=None, enum_type=None, containing_type=None,
@@ -148,7 +155,7 @@ _CLIENTBOUND = _descriptor.Descriptor(
       index=0, containing_type=None, fields=[]),
   ],
   serialized_start=121,
-  serialized_end=269,
+  serialized_end=300,
 )
 
 
@@ -185,8 +192,8 @@ _START = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=271,
-  serialized_end=309,
+  serialized_start=302,
+  serialized_end=340,
 )
 
 
@@ -209,8 +216,8 @@ _STOP = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=311,
-  serialized_end=317,
+  serialized_start=342,
+  serialized_end=348,
 )
 
 
@@ -240,8 +247,8 @@ _VIDEO = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=319,
-  serialized_end=340,
+  serialized_start=350,
+  serialized_end=371,
 )
 
 
@@ -271,8 +278,60 @@ _OVERLAY = _descriptor.Descriptor(
   extension_ranges=[],
   oneofs=[
   ],
-  serialized_start=342,
-  serialized_end=364,
+  serialized_start=373,
+  serialized_end=395,
+)
+
+
+_SPECTRUM = _descriptor.Descriptor(
+  name='Spectrum',
+  full_name='Spectrum',
+  filename=None,
+  file=DESCRIPTOR,
+  containing_type=None,
+  fields=[
+    _descriptor.FieldDescriptor(
+      name='intensity', full_name='Spectrum.intensity', index=0,
+      number=1, type=2, cpp_type=6, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='wavelength', full_name='Spectrum.wavelength', index=1,
+      number=2, type=2, cpp_type=6, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='calibration', full_name='Spectrum.calibration', index=2,
+      number=3, type=1, cpp_type=5, label=3,
+      has_default_value=False, default_value=[],
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+    _descriptor.FieldDescriptor(
+      name='frame_timestamp_us', full_name='Spectrum.frame_timestamp_us', index=3,
+      number=4, type=4, cpp_type=4, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None, file=DESCRIPTOR),
+  ],
+  extensions=[
+  ],
+  nested_types=[],
+  enum_types=[
+  ],
+  options=None,
+  is_extendable=False,
+  syntax='proto3',
+  extension_ranges=[],
+  oneofs=[
+  ],
+  serialized_start=397,
+  serialized_end=495,
 )
 
 _SERVERBOUND.fields_by_name['stream_control'].message_type = _STREAMCONTROL
@@ -283,6 +342,7 @@ _CLIENTBOUND.fields_by_name['start'].message_type = _START
 _CLIENTBOUND.fields_by_name['stop'].message_type = _STOP
 _CLIENTBOUND.fields_by_name['video'].message_type = _VIDEO
 _CLIENTBOUND.fields_by_name['overlay'].message_type = _OVERLAY
+_CLIENTBOUND.fields_by_name['spectrum'].message_type = _SPECTRUM
 _CLIENTBOUND.oneofs_by_name['message'].fields.append(
   _CLIENTBOUND.fields_by_name['start'])
 _CLIENTBOUND.fields_by_name['start'].containing_oneof = _CLIENTBOUND.oneofs_by_name['message']
@@ -295,6 +355,9 @@ _CLIENTBOUND.fields_by_name['video'].containing_oneof = _CLIENTBOUND.oneofs_by_n
 _CLIENTBOUND.oneofs_by_name['message'].fields.append(
   _CLIENTBOUND.fields_by_name['overlay'])
 _CLIENTBOUND.fields_by_name['overlay'].containing_oneof = _CLIENTBOUND.oneofs_by_name['message']
+_CLIENTBOUND.oneofs_by_name['message'].fields.append(
+  _CLIENTBOUND.fields_by_name['spectrum'])
+_CLIENTBOUND.fields_by_name['spectrum'].containing_oneof = _CLIENTBOUND.oneofs_by_name['message']
 DESCRIPTOR.message_types_by_name['ServerBound'] = _SERVERBOUND
 DESCRIPTOR.message_types_by_name['StreamControl'] = _STREAMCONTROL
 DESCRIPTOR.message_types_by_name['ClientBound'] = _CLIENTBOUND
@@ -302,6 +365,7 @@ DESCRIPTOR.message_types_by_name['Start'] = _START
 DESCRIPTOR.message_types_by_name['Stop'] = _STOP
 DESCRIPTOR.message_types_by_name['Video'] = _VIDEO
 DESCRIPTOR.message_types_by_name['Overlay'] = _OVERLAY
+DESCRIPTOR.message_types_by_name['Spectrum'] = _SPECTRUM
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
 ServerBound = _reflection.GeneratedProtocolMessageType('ServerBound', (_message.Message,), dict(
@@ -353,5 +417,12 @@ Overlay = _reflection.GeneratedProtocolMessageType('Overlay', (_message.Message,
   ))
 _sym_db.RegisterMessage(Overlay)
 
+Spectrum = _reflection.GeneratedProtocolMessageType('Spectrum', (_message.Message,), dict(
+  DESCRIPTOR = _SPECTRUM,
+  __module__ = 'messages_pb2'
+  # @@protoc_insertion_point(class_scope:Spectrum)
+  ))
+_sym_db.RegisterMessage(Spectrum)
+
 
 # @@protoc_insertion_point(module_scope)
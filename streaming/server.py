@@ -1,26 +1,41 @@
 import base64
+import collections
 import contextlib
+import email.utils
+import gzip
 import hashlib
 import io
 import os
 import logging
 import queue
-import select
+import selectors
 import socket
 import struct
 import subprocess
 import sys
 import threading
 import time
+import urllib.parse
 
 from enum import Enum
 from http.server import BaseHTTPRequestHandler
-from itertools import cycle
 
+from . import websocket
 from .proto import messages_pb2 as pb2
 
+try:
+    import brotli  # Optional, assets are precompressed with gzip only without it.
+except ImportError:
+    brotli = None
+
 logger = logging.getLogger(__name__)
 
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+CONTENT_TYPES = {'.html': 'text/html; charset=utf-8',
+                 '.js': 'application/javascript; charset=utf-8',
+                 '.wasm': 'application/wasm'}
+
 class NAL:
     CODED_SLICE_NON_IDR = 1  # Coded slice of a non-IDR picture
     CODED_SLICE_IDR     = 5  # Coded slice of an IDR picture
@@ -51,6 +66,53 @@ def OverlayMessage(svg):
     return pb2.ClientBound(timestamp_us=int(time.monotonic() * 1000000),
                            overlay=pb2.Overlay(svg=svg))
 
+def SpectrumMessage(intensity, wavelength=None, calibration=None, frame_timestamp_us=0):
+    return pb2.ClientBound(timestamp_us=int(time.monotonic() * 1000000),
+                           spectrum=pb2.Spectrum(intensity=_floats(intensity),
+                                                 wavelength=_floats(wavelength),
+                                                 calibration=_floats(calibration),
+                                                 frame_timestamp_us=frame_timestamp_us))
+
+class SharedMessage:
+    """ClientBound message for all clients, serialized once.
+
+    The TCP length prefix and the WebSocket frame header are also made once, on
+    first use, and every client sends the same (header, payload) buffers.
+    Video messages keep their NAL unit for the Annex B clients.
+    """
+
+    def __init__(self, message, nal=None):
+        self.nal = nal
+        self._message = message
+        self._payload = None
+        self._tcp = None
+        self._ws = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = self._message.SerializeToString()
+        return self._payload
+
+    @property
+    def tcp(self):
+        if self._tcp is None:
+            self._tcp = (struct.pack('!I', len(self.payload)), self.payload)
+        return self._tcp
+
+    @property
+    def ws(self):
+        if self._ws is None:
+            self._ws = websocket.frame(self.payload)
+        return self._ws
+
+def _floats(values):
+    if values is None:
+        return []
+    if hasattr(values, 'tolist'):  # NumPy arrays
+        return values.tolist()
+    return list(values)
+
 def _parse_server_message(data):
     message = pb2.ServerBound()
     message.ParseFromString(data)
@@ -62,32 +124,124 @@ def _shutdown(sock):
     except OSError:
         pass
 
-def _read_asset(path):
-    if path == '/':
-        path = 'index.html'
-    elif path[0] == '/':
-        path = path[1:]
-
-    base_path = os.path.abspath(os.path.join(os.path.dirname(__file__), 'assets'))
-    asset_path = os.path.abspath(os.path.join(base_path, path))
-
-    if os.path.commonpath((base_path, asset_path)) != base_path:
-        return None, None
-
-    if path.endswith('.html'):
-        content_type = 'text/html; charset=utf-8'
-    elif path.endswith('.js'):
-        content_type = 'application/javascript; charset=utf-8'
-    elif path.endswith('.wasm'):
-        content_type = 'application/wasm'
-    else:
-        content_type = 'application/octet-stream'
-
-    try:
-        with open(asset_path, 'rb') as f:
-            return f.read(), content_type
-    except Exception:
-        return None, None
+def _accepted_encodings(header):
+    """Content codings of an Accept-Encoding header, except those with q=0."""
+    codings = set()
+    for part in (header or '').split(','):
+        coding, _, params = part.partition(';')
+        coding = coding.strip().lower()
+        params = params.strip().lower()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        if coding:
+            codings.add(coding)
+    return codings
+
+
+class Asset:
+    """A file of the asset tree with its precompressed variants.
+
+    Every variant has its own ETag (the content hash and the coding) and its
+    response headers made once, a response is the header, the Connection
+    header of the request's connection and the content as they are. Browsers
+    revalidate (no-cache) and get 304 Not Modified while the file is the same.
+    """
+
+    CODINGS = ('br', 'gzip')  # In order of preference.
+    MIN_SIZE = 512            # Bytes, smaller files are sent as they are.
+    MIN_SAVING = 0.1          # A variant at least this much smaller is kept.
+    BROTLI_QUALITY = 9        # 11 is much slower for little gain.
+
+    def __init__(self, content, content_type, mtime):
+        digest = hashlib.sha1(content).hexdigest()[:20]
+        self.mtime = int(mtime)
+        self.size = len(content)
+        last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+
+        variants = {None: content}
+        if len(content) >= self.MIN_SIZE:
+            variants['gzip'] = gzip.compress(content, 9, mtime=0)
+            if brotli:
+                variants['br'] = brotli.compress(content, quality=self.BROTLI_QUALITY)
+
+        self._ok = {}
+        self._not_modified = {}
+        self.etags = set()
+        for coding, body in variants.items():
+            if coding and len(body) > (1 - self.MIN_SAVING) * len(content):
+                continue
+            etag = '"%s-%s"' % (digest, coding) if coding else '"%s"' % digest
+            self.etags.add(etag)
+            validators = ('ETag: %s\r\n'
+                          'Last-Modified: %s\r\n'
+                          'Cache-Control: no-cache\r\n'
+                          'Vary: Accept-Encoding\r\n') % (etag, last_modified)
+            header = ('HTTP/1.1 200 OK\r\n'
+                      'Content-Length: %d\r\n'
+                      'Content-Type: %s\r\n'
+                      '%s'
+                      '%s') % (
+                          len(body), content_type,
+                          'Content-Encoding: %s\r\n' % coding if coding else '', validators)
+            self._ok[coding] = (header.encode('ascii'), body)
+            self._not_modified[coding] = ('HTTP/1.1 304 Not Modified\r\n%s' % validators).encode('ascii')
+
+    def response(self, headers, connection):
+        """Buffers of the response to a GET with these request headers.
+
+        connection is the end of the header, see _http_connection().
+        """
+        accepted = _accepted_encodings(headers['Accept-Encoding'])
+        coding = next((c for c in self.CODINGS if c in accepted and c in self._ok), None)
+        if self._not_modified_since(headers['If-None-Match'], headers['If-Modified-Since']):
+            return self._not_modified[coding], connection
+        header, body = self._ok[coding]
+        return header, connection, body
+
+    def _not_modified_since(self, if_none_match, if_modified_since):
+        if if_none_match:  # If-Modified-Since does not count then.
+            tags = {tag.strip() for tag in if_none_match.split(',')}
+            return '*' in tags or any((tag[2:] if tag.startswith('W/') else tag) in self.etags
+                                      for tag in tags)
+        if if_modified_since:
+            try:
+                return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= self.mtime
+            except (TypeError, ValueError):
+                return False
+        return False
+
+
+class AssetCache:
+    """The asset tree, read and compressed once, served from memory."""
+
+    def __init__(self, root=ASSETS_DIR):
+        self._assets = {}
+        for dirpath, dirnames, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                    mtime = os.stat(path).st_mtime
+                except OSError as e:
+                    logger.warning('Asset %s not loaded: %s', path, e)
+                    continue
+                content_type = CONTENT_TYPES.get(os.path.splitext(filename)[1],
+                                                 'application/octet-stream')
+                url = '/' + os.path.relpath(path, root).replace(os.sep, '/')
+                self._assets[url] = Asset(content, content_type, mtime)
+        if '/index.html' in self._assets:
+            self._assets['/'] = self._assets['/index.html']
+        logger.info('Loaded %d assets, %d bytes', len(self._assets),
+                    sum(asset.size for url, asset in self._assets.items() if url != '/'))
+
+    def get(self, path):
+        """Asset for the path of a request, None if there is none."""
+        return self._assets.get(urllib.parse.unquote(urllib.parse.urlsplit(path).path))
 
 
 class HTTPRequest(BaseHTTPRequestHandler):
@@ -98,26 +252,6 @@ class HTTPRequest(BaseHTTPRequestHandler):
         self.parse_request()
 
 
-def _read_http_request(sock):
-    request = bytearray()
-    while b'\r\n\r\n' not in request:
-        buf = sock.recv(2048)
-        if not buf:
-            break
-        request.extend(buf)
-    return request
-
-
-def _http_ok(content, content_type):
-    header = (
-        'HTTP/1.1 200 OK\r\n'
-        'Content-Length: %d\r\n'
-        'Content-Type: %s\r\n'
-        'Connection: Keep-Alive\r\n\r\n'
-    ) % (len(content), content_type)
-    return header.encode('ascii') + content
-
-
 def _http_switching_protocols(token):
     accept_token = token.encode('ascii') + b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
     accept_token = hashlib.sha1(accept_token).digest()
@@ -130,8 +264,24 @@ def _http_switching_protocols(token):
     return header.encode('ascii')
 
 
-def _http_not_found():
-    return 'HTTP/1.1 404 Not Found\r\n\r\n'.encode('ascii')
+def _http_not_found(connection):
+    return 'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n'.encode('ascii') + connection
+
+
+def _http_connection(keep_alive, timeout):
+    """Last lines of a response header, whether the connection stays open."""
+    if keep_alive:
+        return ('Connection: keep-alive\r\n'
+                'Keep-Alive: timeout=%d\r\n\r\n' % timeout).encode('ascii')
+    return 'Connection: close\r\n\r\n'.encode('ascii')
+
+
+def _http_keep_alive(request):
+    """HTTP/1.1 connections stay open unless closed, HTTP/1.0 ones if kept alive."""
+    connection = (request.headers['Connection'] or '').lower()
+    if request.request_version == 'HTTP/1.1':
+        return 'close' not in connection
+    return 'keep-alive' in connection
 
 
 @contextlib.contextmanager
@@ -140,6 +290,7 @@ def Socket(port):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     sock.bind(('', port))
     sock.listen()
+    sock.setblocking(False)
     try:
         yield sock
     finally:
@@ -147,35 +298,134 @@ def Socket(port):
         sock.close()
 
 
-class DroppingQueue:
+class ConnectionClosed(Exception):
+    pass
+
+
+class TransmitQueue:
+    """Fixed capacity ring of the messages waiting to be sent to one client.
+
+    Video is limited by count, bytes and the age of the oldest queued NAL unit.
+    A NAL unit that does not fit drops all queued video and video resumes at the
+    next SPS, so the decoder never sees a broken group of pictures and the client
+    catches up with the live stream. A unit larger than the budget still gets in
+    when no other video is queued, or when it belongs to the key frame video
+    resumes with (SPS, PPS, IDR), else a long exposure whose key frame does not
+    fit would never be sent. Other messages always get in, evicting
+    video if the ring is full. A message with a latest key (overlay, spectrum)
+    replaces a queued one with that key.
+    """
+
+    def __init__(self, capacity=64, max_bytes=128 * 1024, max_delay=1.0):
+        if capacity <= 0:
+            raise ValueError('Capacity must be positive.')
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._slots = [None] * capacity  # (item, video size or None, latest key or queued time)
+        self._head = 0
+        self._count = 0
+        self._bytes = 0
+        self._needs_sps = True
+        self._resuming = False  # Units of the key frame video resumes with.
+        self._lock = threading.Lock()
 
-    def __init__(self, maxsize):
-        if maxsize <= 0:
-            raise ValueError('Maxsize must be positive.')
-        self.maxsize = maxsize
-        self._items = []
-        self._cond = threading.Condition(threading.Lock())
+    def set_budget(self, max_bytes, max_delay):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_delay = max_delay
 
-    def put(self, item, replace_last=False):
-        with self._cond:
-            was_empty = len(self._items) == 0
-            if len(self._items) < self.maxsize:
-                self._items.append(item)
-                if was_empty:
-                    self._cond.notify()
-                return False  # Not dropped.
+    def put(self, item, latest=None):
+        """Queues a message that is not video, returns False if it was dropped."""
+        with self._lock:
+            if latest is not None:
+                for i in range(self._count):
+                    j = (self._head + i) % self.capacity
+                    if self._slots[j][1] is None and self._slots[j][2] == latest:
+                        self._slots[j] = (item, None, latest)
+                        return True
+            if self._count == self.capacity:
+                self._drop_video()
+                if self._count == self.capacity:
+                    return False
+            self._append((item, None, latest))
+            return True
 
-            if replace_last:
-                self._items[len(self._items) - 1] = item
-                return False  # Not dropped.
+    def put_video(self, item, size, nal_type):
+        """Queues a NAL unit, returns False if video is dropped until the next SPS."""
+        with self._lock:
+            if self._needs_sps:
+                if nal_type != NAL.SPS:
+                    return False
+                self._needs_sps = False
+                self._resuming = True
+            elif nal_type == NAL.CODED_SLICE_NON_IDR:
+                self._resuming = False
+            now = time.monotonic()
+            if self._count == self.capacity or (
+                    self._bytes and not self._resuming
+                    and (self._bytes + size > self.max_bytes
+                         or now - self._oldest_video() > self.max_delay)):
+                self._drop_video()
+                return False
+            self._append((item, size, now))
+            self._bytes += size
+            return True
 
-            return True  # Dropped.
+    def drop_video(self):
+        with self._lock:
+            self._drop_video()
 
     def get(self):
-        with self._cond:
-            while not self._items:
-                self._cond.wait()
-            return self._items.pop(0)
+        """Never blocks, raises queue.Empty if there is nothing to send."""
+        with self._lock:
+            if not self._count:
+                raise queue.Empty
+            item, size, _ = self._slots[self._head]
+            self._slots[self._head] = None
+            self._head = (self._head + 1) % self.capacity
+            self._count -= 1
+            if size is not None:
+                self._bytes -= size
+            return item
+
+    @property
+    def video_bytes(self):
+        with self._lock:
+            return self._bytes
+
+    def __len__(self):
+        with self._lock:
+            return self._count
+
+    def _append(self, slot):
+        self._slots[(self._head + self._count) % self.capacity] = slot
+        self._count += 1
+
+    def _oldest_video(self):
+        for i in range(self._count):
+            item, size, queued = self._slots[(self._head + i) % self.capacity]
+            if size is not None:
+                return queued
+
+    def _drop_video(self):
+        slots = (self._slots[(self._head + i) % self.capacity] for i in range(self._count))
+        kept = [slot for slot in slots if slot[1] is None]
+        self._slots = kept + [None] * (self.capacity - len(kept))
+        self._head = 0
+        self._count = len(kept)
+        self._bytes = 0
+        self._needs_sps = True
+
+
+def video_budget(bitrate, framerate, seconds=1.0, frames=4):
+    """Bytes and seconds of video queued per client, (max_bytes, max_delay).
+
+    At least one second of the stream, and at least a few frames at a low
+    framerate (long exposures), whose frames are large.
+    """
+    seconds = max(seconds, frames / max(float(framerate), 0.01))
+    return int(bitrate / 8 * seconds), seconds
 
 
 class AtomicSet:
@@ -197,6 +447,10 @@ class AtomicSet:
             except KeyError:
                 return False
 
+    def __contains__(self, value):
+        with self._lock:
+            return value in self._set
+
     def __len__(self):
         with self._lock:
             return len(self._set)
@@ -205,6 +459,135 @@ class AtomicSet:
         with self._lock:
             return iter(self._set.copy())
 
+
+def set_encoder_rate(camera, bitrate, quantization, splitter_port=1):
+    """Changes bitrate and quantization of the running H.264 encoder.
+
+    picamera has no call for it, the parameters are set on the output port of
+    its MMAL encoder, which takes a new bitrate while recording. Quantization is
+    the minimum quantizer, 0 leaves it to the encoder. Other cameras (simulated
+    ones) have encoders with bitrate and quantization attributes.
+    """
+    encoders = getattr(camera, '_encoders', None)
+    if encoders is None:
+        encoder = camera.encoders[splitter_port]
+        encoder.bitrate = bitrate
+        encoder.quantization = quantization
+        return
+
+    from picamera import mmal
+    params = encoders[splitter_port].output_port.params
+    params[mmal.MMAL_PARAMETER_VIDEO_BIT_RATE] = bitrate
+    params[mmal.MMAL_PARAMETER_VIDEO_ENCODE_MIN_QUANT] = quantization
+
+
+class BitrateController:
+    """Adapts the encoder to what the viewers receive.
+
+    Once per interval every enabled client reports how much video it has queued,
+    how many bytes it has sent and how often it fell behind (dropped video until
+    the next key frame). A client is congested if it fell behind, has much video
+    queued, or has some queued and sent less than the encoder produced. If enough
+    clients are congested, the bitrate goes down to what they received, by a
+    factor at least. At the minimum bitrate the
+    quantization goes up instead. After a while without congestion quantization
+    comes down first, then the bitrate goes up in steps until the maximum.
+    """
+
+    INTERVAL = 1.0           # Seconds between decisions.
+    SETTLE = 2.0             # Seconds after a change before the next one.
+    HOLD = 5.0               # Seconds without congestion before going up.
+    BACKLOG = 0.25           # Share of its video budget queued, a client is congested.
+    KEEP_UP = 0.8            # Share of the encoded bytes sent, with video queued.
+    CONGESTED_SHARE = 0.25   # Share of the clients congested, the bitrate goes down.
+    DECREASE = 0.7           # Factor of a decrease, at least.
+    HEADROOM = 0.9           # Share of the measured throughput used as bitrate.
+    STEPS = 10               # Increases from minimum to maximum bitrate.
+    QUANTIZATION = (25, 5)   # First and further steps of the minimum quantizer.
+
+    def __init__(self, bitrate, min_bitrate, max_quantization=40):
+        if not 0 < min_bitrate <= bitrate:
+            raise ValueError('Minimum bitrate must be positive and at most the bitrate.')
+        self.max_bitrate = bitrate
+        self.min_bitrate = min_bitrate
+        self.max_quantization = max_quantization
+        self.reset()
+
+    def reset(self):
+        """Back to the maximum bitrate, when recording starts."""
+        now = time.monotonic()
+        self.bitrate = self.max_bitrate
+        self.quantization = 0
+        self._time = now
+        self._change_time = now
+        self._congestion_time = now
+        self._encoded = None
+        self._stats = {}
+
+    def update(self, clients, encoded):
+        """Only called by camera thread, encoded counts the bytes of all NAL units.
+
+        Returns (bitrate, quantization) if they change.
+        """
+        now = time.monotonic()
+        elapsed = now - self._time
+        if elapsed < self.INTERVAL:
+            return None
+        self._time = now
+        produced = encoded - self._encoded if self._encoded is not None else 0
+        self._encoded = encoded
+
+        stats, congested, throughputs = {}, 0, []
+        for client in clients:
+            backlog, sent, behind = client.backlog()
+            if client not in self._stats:
+                stats[client] = (sent, behind)  # Measured from the next interval on.
+                continue
+            last_sent, last_behind = self._stats[client]
+            stats[client] = (sent, behind)
+            if (behind > last_behind or backlog >= self.BACKLOG
+                    or (backlog and sent - last_sent < self.KEEP_UP * produced)):
+                congested += 1
+                throughputs.append(8 * (sent - last_sent) / elapsed)
+        self._stats = stats
+        if not stats:
+            return None
+
+        bitrate, quantization = self.bitrate, self.quantization
+        if congested and congested >= self.CONGESTED_SHARE * len(stats):
+            self._congestion_time = now
+            if now - self._change_time < self.SETTLE:
+                return None
+            throughput = sorted(throughputs)[len(throughputs) // 2]
+            if bitrate > self.min_bitrate:
+                bitrate = min(bitrate * self.DECREASE, self.HEADROOM * throughput)
+                bitrate = max(int(bitrate), self.min_bitrate)
+            elif quantization < self.max_quantization:
+                first, step = self.QUANTIZATION
+                quantization = min(quantization + step if quantization else first,
+                                   self.max_quantization)
+            reason = '%d of %d viewers behind, median %d kbit/s' % (congested, len(stats),
+                                                                    throughput / 1000)
+        elif now - self._congestion_time >= self.HOLD and now - self._change_time >= self.SETTLE:
+            first, step = self.QUANTIZATION
+            if quantization:
+                quantization = quantization - step if quantization > first else 0
+            elif bitrate < self.max_bitrate:
+                bitrate = min(bitrate + (self.max_bitrate - self.min_bitrate) // self.STEPS,
+                              self.max_bitrate)
+            reason = 'no viewer behind for %.0f s' % (now - self._congestion_time)
+        else:
+            return None
+
+        if (bitrate, quantization) == (self.bitrate, self.quantization):
+            return None
+        logger.info('Bitrate %d -> %d kbit/s, quantization %d -> %d: %s',
+                    self.bitrate / 1000, bitrate / 1000, self.quantization, quantization, reason)
+        self.bitrate, self.quantization = bitrate, quantization
+        self._change_time = now
+        return bitrate, quantization
+
+
 class PresenceServer:
 
     SERVICE_TYPE = '_aiy_vision_video._tcp'
@@ -227,6 +610,16 @@ class PresenceServer:
 
 
 class StreamingServer:
+    """All sockets are served by one thread with a selector, clients have no threads.
+
+    The camera thread and user threads only queue messages for the clients and
+    wake the server thread up through a socket pair, the server thread does all
+    the (non-blocking) socket I/O. With adaptive_bitrate the encoder follows
+    what the viewers receive, between min_bitrate and bitrate (BitrateController).
+    """
+
+    KEY_FRAME_INTERVAL = 0.5  # Seconds between key frame requests, at least.
+    SEND_BUFFER = 16 * 1024  # Kernel buffer per client, the backlog of a slow one stays in its queue.
 
     def __enter__(self):
         return self
@@ -235,27 +628,84 @@ class StreamingServer:
         self.close()
 
     def __init__(self, camera, bitrate=1000000, mdns_name=None,
-                 tcp_port=4665, web_port=4664, annexb_port=4666):
+                 tcp_port=4665, web_port=4664, annexb_port=4666,
+                 adaptive_bitrate=True, min_bitrate=None, max_quantization=40):
         self._bitrate = bitrate
         self._camera = camera
+        self._assets = AssetCache()
+        self._controller = None
+        self._encoded = 0
+        if adaptive_bitrate:
+            self._controller = BitrateController(bitrate, min_bitrate or bitrate // 4,
+                                                 max_quantization)
         self._clients = AtomicSet()
         self._enabled_clients = AtomicSet()
         self._done = threading.Event()
         self._commands = queue.Queue()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self._wake_pending = False
+        self._key_frame_time = 0
+        self._budget = video_budget(bitrate, camera.framerate)
         self._thread = threading.Thread(target=self._run,
                                         args=(mdns_name, tcp_port, web_port, annexb_port))
         self._thread.start()
 
     def close(self):
         self._done.set()
+        self._wakeup()
         self._thread.join()
 
     def send_overlay(self, svg):
+        message = SharedMessage(OverlayMessage(svg))
+        for client in self._enabled_clients:
+            client.send_overlay(message)
+
+    def send_spectrum(self, intensity, wavelength=None, calibration=None, frame_timestamp_us=0):
+        if not self._enabled_clients:
+            return
+        message = SharedMessage(SpectrumMessage(intensity, wavelength, calibration, frame_timestamp_us))
         for client in self._enabled_clients:
-            client.send_overlay(svg)
+            client.send_spectrum(message)
+
+    def _wakeup(self):
+        """Can be called by any thread, at most one wakeup byte is in flight."""
+        if self._wake_pending:
+            return
+        self._wake_pending = True
+        try:
+            self._wake_w.send(b'\0')
+        except OSError:
+            pass  # Full, the server thread is awake anyway.
+
+    def _request_key_frame(self):
+        """Only called by camera thread."""
+        now = time.monotonic()
+        if now - self._key_frame_time >= self.KEY_FRAME_INTERVAL:
+            self._key_frame_time = now
+            logger.info('Requesting key frame')
+            self._camera.request_key_frame()
+
+    def _set_encoder_rate(self, bitrate, quantization):
+        """Only called by camera thread."""
+        try:
+            set_encoder_rate(self._camera, bitrate, quantization)
+        except Exception as e:
+            logger.warning('Encoder rate not changed: %s', e)
+
+    def _set_video_budget(self):
+        # The framerate follows the exposure, it changes between recordings.
+        self._budget = video_budget(self._bitrate, self._camera.framerate)
+        for client in self._clients:
+            client.set_video_budget(*self._budget)
 
     def _start_recording(self):
         logger.info('Camera start recording')
+        self._set_video_budget()
+        if self._controller:
+            self._controller.reset()
         self._camera.start_recording(self, format='h264', profile='baseline',
             inline_headers=True, bitrate=self._bitrate, intra_period=0)
 
@@ -273,6 +723,7 @@ class StreamingServer:
         elif command == ClientCommand.STOP:
             self._enabled_clients.remove(client)
             if self._clients.remove(client):
+                self._selector.unregister(client)
                 client.stop()
             logger.info('Number of active clients: %d', len(self._clients))
 
@@ -283,6 +734,66 @@ class StreamingServer:
         if was_streaming and not is_streaming:
             self._stop_recording()
 
+    def _accept(self, ready, kind):
+        try:
+            sock, addr = ready.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.SEND_BUFFER)
+        name = '%s:%d' % addr[:2]
+        if kind == 'tcp':
+            client = ProtoClient(name, sock, self._commands, self._wakeup, self._camera.resolution)
+        elif kind == 'web':
+            client = WsProtoClient(name, sock, self._commands, self._wakeup, self._camera.resolution,
+                                   self._assets)
+        else:
+            client = AnnexbClient(name, sock, self._commands, self._wakeup)
+        logger.info('New %s connection from %s', client.TYPE, name)
+
+        client.set_video_budget(*self._budget)
+        self._clients.add(client)
+        self._selector.register(client, selectors.EVENT_READ, client)
+        logger.info('Number of active clients: %d', len(self._clients))
+
+    def _serve(self, client, events):
+        try:
+            if events & selectors.EVENT_READ:
+                client.receive()
+            if events & selectors.EVENT_WRITE:
+                self._flush(client)
+        except ConnectionClosed as e:
+            client._logger.info('Connection closed: %s', e)
+            self._process_command(client, ClientCommand.STOP)
+        except Exception as e:
+            client._logger.warning('Connection failed: %s', e)
+            self._process_command(client, ClientCommand.STOP)
+
+    def _idle_timeout(self):
+        """Seconds until the next idle connection is closed, None if there is none."""
+        deadlines = [d for d in (client.deadline() for client in self._clients) if d is not None]
+        if not deadlines:
+            return None
+        return max(0, min(deadlines) - time.monotonic())
+
+    def _close_idle(self):
+        now = time.monotonic()
+        for client in self._clients:
+            deadline = client.deadline()
+            if deadline is not None and deadline <= now:
+                client._logger.info('Idle, closing the connection')
+                self._process_command(client, ClientCommand.STOP)
+
+    def _flush(self, client):
+        # Writes what the socket takes, waits for it to become writable for the rest.
+        events = selectors.EVENT_READ
+        if not client.flush():
+            events |= selectors.EVENT_WRITE
+        if events != client.events:
+            client.events = events
+            self._selector.modify(client, events, client)
+
     def _run(self, mdns_name, tcp_port, web_port, annexb_port):
         try:
             with contextlib.ExitStack() as stack:
@@ -294,8 +805,35 @@ class StreamingServer:
                 if mdns_name:
                     stack.enter_context(PresenceServer(mdns_name, tcp_port))
 
-                socks = (tcp_socket, web_socket, annexb_socket)
+                self._selector.register(tcp_socket, selectors.EVENT_READ, 'tcp')
+                self._selector.register(web_socket, selectors.EVENT_READ, 'web')
+                self._selector.register(annexb_socket, selectors.EVENT_READ, 'annexb')
+                self._selector.register(self._wake_r, selectors.EVENT_READ, 'wakeup')
+
                 while not self._done.is_set():
+                    woken = False
+                    for key, events in self._selector.select(self._idle_timeout()):
+                        if key.data == 'wakeup':
+                            woken = True
+                        elif isinstance(key.data, str):
+                            self._accept(key.fileobj, key.data)
+                        elif key.data in self._clients:
+                            self._serve(key.data, events)
+
+                    # Messages queued by other threads. The wakeup bytes are drained
+                    # before the flag is cleared, so a wakeup after that sends a new
+                    # byte, and the flag is cleared before looking at the queues.
+                    if woken:
+                        try:
+                            while self._wake_r.recv(4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                        self._wake_pending = False
+                        for client in self._clients:
+                            if client.events == selectors.EVENT_READ and client.pending():
+                                self._serve(client, selectors.EVENT_WRITE)
+
                     # Process available client commands.
                     try:
                         while True:
@@ -304,21 +842,7 @@ class StreamingServer:
                     except queue.Empty:
                         pass  # Done processing commands.
 
-                    # Process recently connected clients.
-                    rlist, _, _ = select.select(socks, [], [], 0.2)  # 200ms
-                    for ready in rlist:
-                        sock, addr = ready.accept()
-                        name = '%s:%d' % addr
-                        if ready is tcp_socket:
-                            client = ProtoClient(name, sock, self._commands, self._camera.resolution)
-                        elif ready is web_socket:
-                            client = WsProtoClient(name, sock, self._commands, self._camera.resolution)
-                        elif ready is annexb_socket:
-                            client = AnnexbClient(name, sock, self._commands)
-                        logger.info('New %s connection from %s', client.TYPE, name)
-
-                        self._clients.add(client).start()
-                        logger.info('Number of active clients: %d', len(self._clients))
+                    self._close_idle()
         finally:
             logger.info('Server is shutting down')
             if self._enabled_clients:
@@ -326,6 +850,9 @@ class StreamingServer:
 
             for client in self._clients:
                 client.stop()
+            self._selector.close()
+            self._wake_r.close()
+            self._wake_w.close()
             logger.info('Done')
 
     def write(self, data):
@@ -333,10 +860,18 @@ class StreamingServer:
         assert data[0:4] == b'\x00\x00\x00\x01'
         frame_type = data[4] & 0b00011111
         if frame_type in ALLOWED_NALS:
-            states = {client.send_video(frame_type, data) for client in self._enabled_clients}
-            if ClientState.ENABLED_NEEDS_SPS in states:
-                logger.info('Requesting key frame')
-                self._camera.request_key_frame()
+            message = SharedMessage(VideoMessage(data), nal=data)
+            wanted = False
+            for client in self._enabled_clients:
+                if client.send_video(frame_type, message) == ClientState.ENABLED_NEEDS_SPS:
+                    wanted = client.wants_key_frame() or wanted
+            if wanted:
+                self._request_key_frame()
+            if self._controller:
+                self._encoded += len(data)
+                rate = self._controller.update(self._enabled_clients, self._encoded)
+                if rate:
+                    self._set_encoder_rate(*rate)
 
 class ClientLogger(logging.LoggerAdapter):
     def process(self, msg, kwargs):
@@ -353,106 +888,187 @@ class ClientCommand(Enum):
     DISABLE = 3
 
 class Client:
-    def __init__(self, name, sock, command_queue):
+    MAX_BUFFERS = 64        # Per sendmsg() call.
+    MAX_BATCH = 16 * 1024   # Bytes taken from the queue for one sendmsg() call.
+    MIN_BACKOFF = 0.5       # Seconds after falling behind before asking for a key frame,
+    MAX_BACKOFF = 8.0       # doubled each time it happens again within 10 seconds.
+
+    def __init__(self, name, sock, command_queue, wakeup):
         self._lock = threading.Lock()  # Protects _state.
         self._state = ClientState.DISABLED
         self._logger = ClientLogger(logger, {'name': name})
         self._socket = sock
         self._commands = command_queue
-        self._tx_q = DroppingQueue(15)
-        self._rx_thread = threading.Thread(target=self._rx_run)
-        self._tx_thread = threading.Thread(target=self._tx_run)
-
-    def start(self):
-        self._rx_thread.start()
-        self._tx_thread.start()
+        self._wakeup = wakeup
+        self._tx_q = TransmitQueue()
+        self._tx_bufs = collections.deque()  # Buffers being sent, the first one may be partly sent.
+        self._rx_buf = bytearray()
+        self._closing = False  # Connection closes once the queue is sent.
+        self._active_time = time.monotonic()  # Last data received or sent.
+        self._backoff = 0
+        self._behind_time = 0
+        self._key_frame_time = 0  # No key frame requests before.
+        self._sent_bytes = 0
+        self._behind_count = 0
+        self.events = selectors.EVENT_READ
+
+    def fileno(self):
+        return self._socket.fileno()
 
     def stop(self):
         self._logger.info('Stopping...')
         _shutdown(self._socket)
         self._socket.close()
-        self._tx_q.put(None)
-        self._tx_thread.join()
-        self._rx_thread.join()
         self._logger.info('Stopped.')
 
-    def send_video(self, frame_type, data):
-        """Only called by camera thread."""
+    def send_video(self, frame_type, message):
+        """Only called by camera thread, message is a SharedMessage."""
         with self._lock:
-            if self._state == ClientState.DISABLED:
-                pass
-            elif self._state == ClientState.ENABLED_NEEDS_SPS:
-                if frame_type == NAL.SPS:
-                    dropped = self._queue_video(data)
-                    if not dropped:
-                        self._state = ClientState.ENABLED
-            elif self._state == ClientState.ENABLED:
-                dropped = self._queue_video(data)
-                if dropped:
+            if self._state != ClientState.DISABLED:
+                if self._queue_video(frame_type, message):
+                    self._state = ClientState.ENABLED
+                else:
+                    if self._state == ClientState.ENABLED:
+                        self._fell_behind()
                     self._state = ClientState.ENABLED_NEEDS_SPS
             return self._state
 
-    def send_overlay(self, svg):
-        """Can be called by any user thread."""
+    def wants_key_frame(self):
+        """Only called by camera thread, slow clients wait a while before asking again."""
+        return self._state == ClientState.ENABLED_NEEDS_SPS and time.monotonic() >= self._key_frame_time
+
+    def send_overlay(self, message):
+        """Can be called by any user thread, message is a SharedMessage."""
         with self._lock:
             if self._state != ClientState.DISABLED:
-                self._queue_overlay(svg)
+                self._queue_overlay(message)
+
+    def send_spectrum(self, message):
+        """Can be called by any user thread, message is a SharedMessage."""
+        with self._lock:
+            if self._state != ClientState.DISABLED:
+                self._queue_spectrum(message)
+
+    def backlog(self):
+        """Share of the video budget queued, bytes sent and times fallen behind."""
+        return self._tx_q.video_bytes / self._tx_q.max_bytes, self._sent_bytes, self._behind_count
+
+    def set_video_budget(self, max_bytes, max_delay):
+        self._tx_q.set_budget(max_bytes, max_delay)
+
+    def pending(self):
+        return self._closing or bool(self._tx_bufs) or len(self._tx_q) > 0
+
+    def receive(self):
+        """Only called by server thread when the socket is readable."""
+        try:
+            buf = self._socket.recv(65536)
+        except BlockingIOError:
+            return
+        if not buf:
+            raise ConnectionClosed('closed by peer')
+        self._active_time = time.monotonic()
+        if self._closing:
+            return  # Nothing more is read from a connection that closes.
+        self._rx_buf.extend(buf)
+        self._process_received()
+
+    def deadline(self):
+        """Time the connection is closed unless it is used before, None if never."""
+        return None
+
+    def _process_received(self):
+        while not self._closing:
+            message = self._receive_message()
+            if message is None:
+                break
+            self._handle_message(message)
+
+    def flush(self):
+        """Only called by server thread, returns True once everything queued is sent.
+
+        The buffers of several messages go out with one sendmsg() call, headers
+        and payloads as they are, without joining them first. More is taken from
+        the queue only once a batch is sent, what waits stays droppable there.
+        """
+        bufs = self._tx_bufs
+        while True:
+            size = 0
+            while not bufs or (size and len(bufs) < self.MAX_BUFFERS and size < self.MAX_BATCH):
+                try:
+                    message = self._tx_q.get()
+                except queue.Empty:
+                    break
+                for buf in self._serialize_message(message):
+                    bufs.append(memoryview(buf))
+                    size += len(buf)
+            if not bufs:
+                if self._closing:
+                    raise ConnectionClosed('done')
+                return True
+
+            try:
+                sent = self._socket.sendmsg(bufs)
+            except BlockingIOError:
+                return False
+            self._sent_bytes += sent
+            self._active_time = time.monotonic()
+            while bufs and sent >= len(bufs[0]):
+                sent -= len(bufs.popleft())
+            if sent:
+                bufs[0] = bufs[0][sent:]
 
     def _send_command(self, command):
         self._commands.put((self, command))
+        self._wakeup()
 
-    def _queue_message(self, message, replace_last=False):
-        dropped = self._tx_q.put(message, replace_last)
+    def _queue_message(self, message, latest=None):
+        dropped = not self._tx_q.put(message, latest)
         if dropped:
             self._logger.warning('Running behind, dropping messages')
+        else:
+            self._wakeup()
         return dropped
 
-    def _tx_run(self):
-        try:
-            while True:
-                message = self._tx_q.get()
-                if message is None:
-                    break
-                self._send_message(message)
-            self._logger.info('Tx thread finished')
-        except Exception as e:
-            self._logger.warning('Tx thread failed: %s', e)
-
-        # Tx thread stops the client in any situation.
-        self._send_command(ClientCommand.STOP)
+    def _queue_nal(self, frame_type, item, size):
+        """Returns False if video is dropped until the next SPS."""
+        queued = self._tx_q.put_video(item, size, frame_type)
+        if queued:
+            self._wakeup()
+        return queued
+
+    def _fell_behind(self):
+        now = time.monotonic()
+        if now - self._behind_time < 10:
+            self._backoff = min(2 * self._backoff, self.MAX_BACKOFF)
+        else:
+            self._backoff = self.MIN_BACKOFF
+        self._behind_time = now
+        self._behind_count += 1
+        self._key_frame_time = now + self._backoff
+        self._logger.warning('Running behind, dropping video until the next key frame (%.1f s)',
+                             self._backoff)
+
+    def _close_after_sending(self):
+        self._closing = True
+        self._wakeup()
+
+    def _queue_video(self, frame_type, message):
+        """Returns False if video is dropped until the next SPS."""
+        raise NotImplementedError
 
-    def _rx_run(self):
-        try:
-            while True:
-                message = self._receive_message()
-                if message is None:
-                    break
-                self._handle_message(message)
-            self._logger.info('Rx thread finished')
-        except Exception as e:
-            self._logger.warning('Rx thread failed: %s', e)
-            # Rx thread stops the client only if error happened.
-            self._send_command(ClientCommand.STOP)
-
-    def _receive_bytes(self, num_bytes):
-        received = bytearray()
-        while len(received) < num_bytes:
-            buf = self._socket.recv(num_bytes - len(received))
-            if not buf:
-                return buf
-            received.extend(buf)
-        return received
-
-    def _queue_video(self, data):
+    def _queue_overlay(self, message):
         raise NotImplementedError
 
-    def _queue_overlay(self, svg):
+    def _queue_spectrum(self, message):
         raise NotImplementedError
 
-    def _send_message(self, message):
+    def _serialize_message(self, message):
+        """Buffers to send for a queued message."""
         raise NotImplementedError
 
     def _receive_message(self):
+        """Next complete message of _rx_buf, None if more bytes are needed."""
         raise NotImplementedError
 
     def _handle_message(self, message):
@@ -461,15 +1077,18 @@ class Client:
 class ProtoClient(Client):
     TYPE = 'tcp'
 
-    def __init__(self, name, sock, command_queue, resolution):
-        super().__init__(name, sock, command_queue)
+    def __init__(self, name, sock, command_queue, wakeup, resolution):
+        super().__init__(name, sock, command_queue, wakeup)
         self._resolution = resolution
 
-    def _queue_video(self, data):
-        return self._queue_message(VideoMessage(data))
+    def _queue_video(self, frame_type, message):
+        return self._queue_nal(frame_type, message, len(message.nal))
 
-    def _queue_overlay(self, svg):
-        return self._queue_message(OverlayMessage(svg))
+    def _queue_overlay(self, message):
+        return self._queue_message(message, latest='overlay')
+
+    def _queue_spectrum(self, message):
+        return self._queue_message(message, latest='spectrum')
 
     def _handle_message(self, message):
         which = message.WhichOneof('message')
@@ -494,165 +1113,131 @@ class ProtoClient(Client):
                 else:
                     self._logger.info('Disabling client')
                     self._state = ClientState.DISABLED
-                    self._queue_message(StopMessage(), replace_last=True)
+                    self._tx_q.drop_video()
+                    self._queue_message(StopMessage())
                     self._send_command(ClientCommand.DISABLE)
 
-    def _send_message(self, message):
+    def _serialize_message(self, message):
+        if isinstance(message, SharedMessage):
+            return message.tcp
         buf = message.SerializeToString()
-        self._socket.sendall(struct.pack('!I', len(buf)))
-        self._socket.sendall(buf)
+        return struct.pack('!I', len(buf)), buf
 
     def _receive_message(self):
-        buf = self._receive_bytes(4)
-        if not buf:
+        if len(self._rx_buf) < 4:
             return None
-        num_bytes = struct.unpack('!I', buf)[0]
-        buf = self._receive_bytes(num_bytes)
-        if not buf:
+        num_bytes = struct.unpack_from('!I', self._rx_buf)[0]
+        if len(self._rx_buf) < 4 + num_bytes:
             return None
+        buf = bytes(self._rx_buf[4:4 + num_bytes])
+        del self._rx_buf[:4 + num_bytes]
         return _parse_server_message(buf)
 
 
 class WsProtoClient(ProtoClient):
+    """A browser, HTTP requests for the assets until it upgrades to a WebSocket.
+
+    The connection stays open for more requests (keep-alive), sent one after
+    the other or pipelined, until the browser closes it or it is idle for
+    KEEP_ALIVE_TIMEOUT seconds. Requests that arrive while MAX_PIPELINE
+    responses are queued wait until these are sent.
+    """
     TYPE = 'web'
 
-    class WsPacket:
-        def __init__(self):
-            self.fin = True
-            self.opcode = 2
-            self.masked = False
-            self.mask = None
-            self.length = 0
-            self.payload = bytearray()
-
-        def append(self, data):
-            if self.masked:
-                data = bytes([c ^ k for c, k in zip(data, cycle(self.mask))])
-            self.payload.extend(data)
-
-        def serialize(self):
-            self.length = len(self.payload)
-            buf = bytearray()
-            b0 = 0
-            b1 = 0
-            if self.fin:
-                b0 |= 0x80
-            b0 |= self.opcode
-            buf.append(b0)
-            if self.length <= 125:
-                b1 |= self.length
-                buf.append(b1)
-            elif self.length >= 126 and self.length <= 65535:
-                b1 |= 126
-                buf.append(b1)
-                buf.extend(struct.pack('!H', self.length))
-            else:
-                b1 |= 127
-                buf.append(b1)
-                buf.extend(struct.pack('!Q', self.length))
-            if self.payload:
-                buf.extend(self.payload)
-            return bytes(buf)
-
-    def __init__(self, name, sock, command_queue, resolution):
-        super().__init__(name, sock, command_queue, resolution)
+    MAX_REQUEST_SIZE = 65536
+    MAX_PIPELINE = 16
+    KEEP_ALIVE_TIMEOUT = 15
+
+    def __init__(self, name, sock, command_queue, wakeup, resolution, assets):
+        super().__init__(name, sock, command_queue, wakeup, resolution)
+        self._assets = assets
         self._upgraded = False
+        self._decoder = websocket.Decoder()
 
-    def _receive_message(self):
-        try:
-            if not self._upgraded:
-                if self._process_web_request():
-                    return None
-                self._upgraded = True
-
-            packets = []
-            while True:
-                packet = self._receive_packet()
-                if packet.opcode == 0:
-                    # Continuation
-                    if not packets:
-                        self._logger.error('Invalid continuation received')
-                        return None
-                    packets.append(packet)
-                elif packet.opcode == 1:
-                    # Text, not supported.
-                    self._logger.error('Received text packet')
-                    return None
-                elif packet.opcode == 2:
-                    # Binary.
-                    packets.append(packet)
-                    if packet.fin:
-                        joined = bytearray()
-                        for p in packets:
-                            joined.extend(p.payload)
-                        return _parse_server_message(joined)
-                elif packet.opcode == 8:
-                    # Close.
-                    self._logger.info('WebSocket close requested')
-                    return None
-                elif packet.opcode == 9:
-                    # Ping, send pong.
-                    self._logger.info('Received ping')
-                    response = self.WsPacket()
-                    response.opcode = 10
-                    response.append(packet.payload)
-                    self._queue_message(response)
-                elif packet.opcode == 10:
-                    # Pong. Igore as we don't send pings.
-                    self._logger.info('Dropping pong')
-                else:
-                    self._logger.info('Dropping opcode %d', packet.opcode)
-        except Exception:
-            self._logger.exception('Error while processing websocket request')
+    def deadline(self):
+        if self._upgraded or self.pending():
             return None
+        return self._active_time + self.KEEP_ALIVE_TIMEOUT
 
-    def _receive_packet(self):
-        packet = self.WsPacket()
-        buf = self._receive_bytes(2)
-        packet.fin = buf[0] & 0x80 > 0
-        packet.opcode = buf[0] & 0x0F
-        packet.masked = buf[1] & 0x80 > 0
-        packet.length = buf[1] & 0x7F
-        if packet.length == 126:
-            packet.length = struct.unpack('!H', self._receive_bytes(2))[0]
-        elif packet.length == 127:
-            packet.length = struct.unpack('!Q', self._receive_bytes(8))[0]
-        if packet.masked:
-            packet.mask = self._receive_bytes(4)
-        packet.append(self._receive_bytes(packet.length))
-        return packet
-
-    def _send_message(self, message):
-        if isinstance(message, (bytes, bytearray)):
-            buf = message
-        else:
-            if isinstance(message, self.WsPacket):
-                packet = message
+    def flush(self):
+        done = super().flush()
+        if done and self._rx_buf and not self._upgraded and not self._closing:
+            self._process_received()  # Pipelined requests that waited.
+            done = super().flush()
+        return done
+
+    def _receive_message(self):
+        while not self._upgraded:
+            if len(self._tx_q) >= self.MAX_PIPELINE:
+                return None
+            end = self._rx_buf.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self._rx_buf) > self.MAX_REQUEST_SIZE:
+                    raise Exception('Request too large')
+                return None
+            request = bytes(self._rx_buf[:end + 4])
+            del self._rx_buf[:end + 4]
+            if not self._process_web_request(request):
+                self._close_after_sending()
+                return None
+
+        if self._rx_buf:
+            self._decoder.feed(self._rx_buf)
+            self._rx_buf.clear()
+
+        while True:
+            message = self._decoder.next()
+            if message is None:
+                return None
+            opcode, payload = message
+            if opcode == websocket.OP_BINARY:
+                return _parse_server_message(payload)
+            elif opcode == websocket.OP_TEXT:
+                # Text, not supported.
+                self._logger.error('Received text packet')
+                raise ConnectionClosed('text packet')
+            elif opcode == websocket.OP_CLOSE:
+                self._logger.info('WebSocket close requested')
+                raise ConnectionClosed('WebSocket close')
+            elif opcode == websocket.OP_PING:
+                self._logger.info('Received ping')
+                self._queue_message(websocket.frame(payload, websocket.OP_PONG))
+            elif opcode == websocket.OP_PONG:
+                # Pong. Igore as we don't send pings.
+                self._logger.info('Dropping pong')
             else:
-                packet = self.WsPacket()
-                packet.append(message.SerializeToString())
-            buf = packet.serialize()
-        self._socket.sendall(buf)
+                self._logger.info('Dropping opcode %d', opcode)
+
+    def _serialize_message(self, message):
+        if isinstance(message, SharedMessage):
+            return message.ws
+        if isinstance(message, tuple):
+            return message  # Frame buffers.
+        if isinstance(message, (bytes, bytearray)):
+            return (message,)  # HTTP response.
+        return websocket.frame(message.SerializeToString())
 
-    def _process_web_request(self):
-        request = _read_http_request(self._socket)
+    def _process_web_request(self, request):
+        """Queues the response, returns False if the connection closes after it."""
         request = HTTPRequest(request)
         connection = request.headers['Connection']
         upgrade = request.headers['Upgrade']
-        if 'Upgrade' in connection and upgrade == 'websocket':
+        if connection and upgrade and 'Upgrade' in connection and upgrade == 'websocket':
             sec_websocket_key = request.headers['Sec-WebSocket-Key']
             self._queue_message(_http_switching_protocols(sec_websocket_key))
             self._logger.info('Upgraded to WebSocket')
-            return False
+            self._upgraded = True
+            return True
 
         if request.command == 'GET':
-            content, content_type = _read_asset(request.path)
-            if content is None:
-                self._queue_message(_http_not_found())
+            keep_alive = _http_keep_alive(request)
+            connection = _http_connection(keep_alive, self.KEEP_ALIVE_TIMEOUT)
+            asset = self._assets.get(request.path)
+            if asset is None:
+                self._queue_message(_http_not_found(connection))
             else:
-                self._queue_message(_http_ok(content, content_type))
-            self._queue_message(None)
-            return True
+                self._queue_message(asset.response(request.headers, connection))
+            return keep_alive
 
         raise Exception('Unsupported request')
 
@@ -660,22 +1245,22 @@ class WsProtoClient(ProtoClient):
 class AnnexbClient(Client):
     TYPE = 'annexb'
 
-    def __init__(self, name, sock, command_queue):
-        super().__init__(name, sock, command_queue)
+    def __init__(self, name, sock, command_queue, wakeup):
+        super().__init__(name, sock, command_queue, wakeup)
         self._state = ClientState.ENABLED_NEEDS_SPS
         self._send_command(ClientCommand.ENABLE)
 
-    def _queue_video(self, data):
-        return self._queue_message(data)
+    def _queue_video(self, frame_type, message):
+        return self._queue_nal(frame_type, message.nal, len(message.nal))
 
-    def _queue_overlay(self, svg):
+    def _queue_overlay(self, message):
         pass  # Ignore overlays.
 
-    def _send_message(self, message):
-        self._socket.sendall(message)
+    def _queue_spectrum(self, message):
+        pass  # Ignore spectra.
+
+    def _serialize_message(self, message):
+        return (message,)
 
     def _receive_message(self):
-        buf = self._socket.recv(1024)
-        if not buf:
-            return None
         raise RuntimeError('Invalid state.')
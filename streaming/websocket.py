@@ -0,0 +1,140 @@
+"""WebSocket framing (RFC 6455) for the streaming server.
+
+Frames are sent as two buffers, the header and the untouched payload, so a
+socket can write them with sendmsg() without copying the payload. Incoming
+payloads are unmasked in bulk and fragments are joined once, when the last
+one has arrived.
+"""
+
+import struct
+
+OP_CONTINUATION = 0
+OP_TEXT         = 1
+OP_BINARY       = 2
+OP_CLOSE        = 8
+OP_PING         = 9
+OP_PONG         = 10
+
+MAX_MESSAGE_SIZE = 1 << 20
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def header(length, opcode=OP_BINARY, fin=True):
+    b0 = (0x80 if fin else 0) | opcode
+    if length <= 125:
+        return struct.pack('!BB', b0, length)
+    if length <= 65535:
+        return struct.pack('!BBH', b0, 126, length)
+    return struct.pack('!BBQ', b0, 127, length)
+
+
+def frame(payload, opcode=OP_BINARY):
+    """Buffers of an unmasked frame, for socket.sendmsg()."""
+    return (header(len(payload), opcode), payload)
+
+
+def unmask(data, mask):
+    """XOR of data with the repeated 4 byte mask, as one big integer operation."""
+    n = len(data)
+    if n == 0:
+        return b''
+    key = (bytes(mask) * (n // 4 + 1))[:n]
+    return (int.from_bytes(data, 'big') ^ int.from_bytes(key, 'big')).to_bytes(n, 'big')
+
+
+class Decoder:
+    """Incremental parser of the frames received from a client.
+
+    feed() appends received bytes, next() returns the next complete message as
+    (opcode, payload) or None. Control frames (close, ping, pong) are returned
+    as they arrive, also between the fragments of a data message.
+    """
+
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self._max_message_size = max_message_size
+        self._buf = bytearray()
+        self._pos = 0
+        self._fragments = []
+        self._fragments_size = 0
+        self._opcode = None
+
+    def feed(self, data):
+        if self._pos and self._pos >= len(self._buf) // 2:
+            del self._buf[:self._pos]  # Drop what is parsed, not on every frame.
+            self._pos = 0
+        self._buf.extend(data)
+
+    def next(self):
+        while True:
+            parsed = self._next_frame()
+            if parsed is None:
+                return None
+            fin, opcode, payload = parsed
+
+            if opcode >= OP_CLOSE:
+                if not fin or len(payload) > 125:
+                    raise ProtocolError('Invalid control frame')
+                return opcode, payload
+
+            if opcode == OP_CONTINUATION:
+                if self._opcode is None:
+                    raise ProtocolError('Invalid continuation received')
+            elif self._opcode is not None:
+                raise ProtocolError('New message before the last one is complete')
+            else:
+                self._opcode = opcode
+
+            self._fragments.append(payload)
+            self._fragments_size += len(payload)
+            if self._fragments_size > self._max_message_size:
+                raise ProtocolError('Message larger than %d bytes' % self._max_message_size)
+            if fin:
+                opcode = self._opcode
+                if len(self._fragments) == 1:
+                    payload = self._fragments[0]
+                else:
+                    payload = b''.join(self._fragments)
+                self._fragments = []
+                self._fragments_size = 0
+                self._opcode = None
+                return opcode, payload
+
+    def _next_frame(self):
+        buf, pos = self._buf, self._pos
+        available = len(buf) - pos
+        if available < 2:
+            return None
+
+        fin = buf[pos] & 0x80 > 0
+        opcode = buf[pos] & 0x0F
+        masked = buf[pos + 1] & 0x80 > 0
+        length = buf[pos + 1] & 0x7F
+        start = pos + 2
+        if length == 126:
+            if available < 4:
+                return None
+            length = struct.unpack_from('!H', buf, pos + 2)[0]
+            start = pos + 4
+        elif length == 127:
+            if available < 10:
+                return None
+            length = struct.unpack_from('!Q', buf, pos + 2)[0]
+            start = pos + 10
+        if length > self._max_message_size:
+            raise ProtocolError('Frame larger than %d bytes' % self._max_message_size)
+
+        if masked:
+            start += 4
+        if len(buf) < start + length:
+            return None
+
+        with memoryview(buf) as view:
+            if masked:
+                payload = unmask(view[start:start + length], view[start - 4:start])
+            else:
+                payload = bytes(view[start:start + length])
+        self._pos = start + length
+        return fin, opcode, payload
@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import pytest
+
+from helpers.Calibration import autoCalibrate
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'docs', 'data')
+
+# Peaks of the CFL recordings in docs/data and the lines they are
+CFL = {
+    '20211114-120001': [(23, 436.6), (70, 487.7), (120, 546.5), (157, 587.6), (174, 611.6)],
+    '20211114-132424': [(22, 436.6), (71, 487.7), (119, 546.5), (160, 587.6), (179, 611.6)],
+}
+
+
+def spectrum(time):
+    return np.loadtxt(os.path.join(DATA, 'spectrum-' + time + '.csv'), delimiter=',', skiprows=1)[:, 1]
+
+
+def assignments(profile):
+    return [(int(round(column)), wavelength) for column, wavelength in profile.matches]
+
+
+@pytest.mark.parametrize('time', sorted(CFL))
+def test_cfl_recordings_calibrate(time):
+    s = spectrum(time)
+    profile = autoCalibrate(s)
+    assert assignments(profile) == CFL[time]
+
+    low, high = profile.evaluate([0, len(s) - 1])
+    assert 400 < low < 420 and 660 < high < 690
+    assert 1.0 < (high - low) / (len(s) - 1) < 1.3
+
+
+@pytest.mark.parametrize('time', sorted(CFL))
+def test_cfl_recordings_calibrate_with_spline(time):
+    profile = autoCalibrate(spectrum(time), kind='spline')
+    assert profile.kind == 'spline'
+    assert assignments(profile) == CFL[time]
+
+
+def test_reversed_spectrum_calibrates_with_reversed_orientation():
+    s = spectrum('20211114-132424')[::-1]
+    profile = autoCalibrate(s, orientation=-1)
+    last = len(s) - 1
+    assert assignments(profile) == sorted((last - column, wavelength)
+                                          for column, wavelength in CFL['20211114-132424'])
+
+
+def test_bayer_columns_calibrate():
+    # Spectrum from the Bayer planes, two frame columns per sample
+    s = spectrum('20211114-132424')
+    profile = autoCalibrate(s, columns=100 + 2 * np.arange(float(len(s))))
+    expected = autoCalibrate(s).matches
+    assert [wavelength for column, wavelength in profile.matches] == [w for c, w in expected]
+    np.testing.assert_allclose([column for column, wavelength in profile.matches],
+                               [100 + 2 * c for c, w in expected])
+
+
+@pytest.mark.parametrize('time', ['20211114-120929',     # Phone light
+                                  '20211114-122120',     # Incandescent bulb
+                                  '20211118-150048'])    # Green laser through olive oil
+def test_other_light_sources_do_not_calibrate(time):
+    with pytest.raises(ValueError):
+        autoCalibrate(spectrum(time))
@@ -0,0 +1,134 @@
+import numpy as np
+import pytest
+
+from helpers.Capture import (BayerFrame, FrameStacker, bayerCrop, bayerPlanes, pack10,
+                             syntheticBayer, unpack10)
+from helpers.Spectrum import SpectrumEngine
+
+# Sites of the 2x2 tile, row by row, for each header bayer_order
+PATTERNS = {0: 'RGGB', 1: 'GBRG', 2: 'BGGR', 3: 'GRBG'}
+SITES = {'R': 1, 'G': 2, 'B': 3}
+
+
+def tiled(order, height=8, width=12):
+    tile = np.array([SITES[c] for c in PATTERNS[order]], dtype=np.uint16).reshape(2, 2)
+    return np.tile(tile, (height // 2, width // 2))
+
+
+@pytest.mark.parametrize('order', [0, 1, 2, 3])
+def test_synthetic_capture_round_trips(order):
+    data, raw = syntheticBayer('ov5647', order=order, jpeg=b'\xff\xd8\xff\xd9')
+    frame = BayerFrame('ov5647')
+    parsed = frame.parse(data)
+    assert frame.order == order
+    assert parsed.shape == (1944, 2592)
+    np.testing.assert_array_equal(parsed, raw)
+
+
+def test_parse_rejects_capture_without_raw_block():
+    with pytest.raises(IOError):
+        BayerFrame('ov5647').parse(b'\xff\xd8\xff\xd9')
+
+
+def test_pack10_of_unpack10_is_identity():
+    rng = np.random.default_rng(1)
+    raw = rng.integers(0, 1024, size=(6, 64), dtype=np.uint16)
+    packed = pack10(raw)
+    assert packed.shape == (6, 96)                    # 80 bytes of data, padded to 32
+
+    out = np.empty_like(raw)
+    unpack10(packed, 64, out)
+    np.testing.assert_array_equal(out, raw)
+    np.testing.assert_array_equal(pack10(out), packed)
+
+
+@pytest.mark.parametrize('order', [0, 1, 2, 3])
+def test_planes_follow_bayer_order(order):
+    planes = bayerPlanes(tiled(order), order)
+    assert [int(p.min()) for p in planes] == [1, 2, 2, 3]
+    assert [int(p.max()) for p in planes] == [1, 2, 2, 3]
+    assert planes[0].shape == (4, 6)
+
+
+def test_planes_rotate_clockwise():
+    raw = tiled(0)
+    raw[0, 0] = 100                                   # Top left R site of the sensor
+    r = bayerPlanes(raw, 0, rotation=90)[0]
+    assert r.shape == (6, 4)
+    assert r[0, -1] == 100                            # ... is top right after 90 degrees
+    assert bayerPlanes(raw, 0, rotation=270)[0][-1, 0] == 100
+    assert bayerPlanes(raw, 0, rotation=180)[0][-1, -1] == 100
+
+
+def test_planes_reject_odd_rotation():
+    with pytest.raises(ValueError):
+        bayerPlanes(tiled(0), 0, rotation=45)
+
+
+def test_crop_same_aspect_ratio_scales_both_axes_alike():
+    planes = [np.zeros((972, 1296))] * 4                 # ov5647, half resolution
+    assert bayerCrop(planes, (100, 50, 600, 450), (648, 486)) == [200, 100, 1200, 900]
+
+
+def test_crop_rotated_output_covers_centre_of_planes():
+    # Landscape output of a sensor rotated by 90/270: the planes are portrait
+    planes = [np.zeros((400, 300))] * 4
+    assert bayerCrop(planes, (0, 0, 600, 400), (600, 400)) == [0, 100, 300, 300]
+    assert bayerCrop(planes, (60, 40, 540, 360), (600, 400)) == [30, 120, 270, 280]
+
+
+def test_crop_wider_output_is_cropped_from_sensor():
+    planes = [np.zeros((300, 400))] * 4                  # 4:3 sensor, 2:1 output
+    assert bayerCrop(planes, (0, 0, 800, 400), (800, 400)) == [0, 50, 400, 250]
+
+
+def test_crop_of_rotated_frame_picks_the_same_sites():
+    # A bright spot of the output lands in the crop box of the rotated planes
+    data, _ = syntheticBayer('ov5647', order=0, lines=(), jpeg=b'')
+    frame = BayerFrame('ov5647')
+    raw = frame.parse(data)
+    raw[1000, 600] = 1000                             # An R site, row 500, column 300 of its plane
+    planes = frame.planes(rotation=90)                # 1296 x 972, the spot at row 300, column 471
+    box = bayerCrop(planes, (304, 1, 324, 21), (648, 486))   # Output shows it at (314, 11)
+    spot = planes[0][box[1]:box[3], box[0]:box[2]]
+    assert spot.max() == 1000
+
+
+def stacked(frames):
+    stacker = FrameStacker(frames[0].shape)
+    for frame in frames:
+        stacker.add(frame)
+    return stacker
+
+
+def test_spectrum_error_without_weights_averages_channels():
+    rng = np.random.default_rng(2)
+    frames = rng.normal(100, 5, size=(20, 4, 6, 3)).astype(np.float32)
+    stacker = stacked(frames)
+    expected = np.sqrt(frames.var(axis=0, ddof=1).sum(axis=(0, 2)) / 20) / 12
+    np.testing.assert_allclose(stacker.spectrumError(), expected, rtol=1e-4)
+
+
+def test_spectrum_error_uses_channel_weights():
+    # Only blue is noisy, a spectrum without blue has no error
+    rng = np.random.default_rng(3)
+    frames = np.full((20, 4, 6, 3), 100, dtype=np.float32)
+    frames[..., 2] += rng.normal(0, 5, size=(20, 4, 6))
+    stacker = stacked(frames)
+    assert stacker.spectrumError().min() > 0
+    np.testing.assert_allclose(stacker.spectrumError([1, 1, 0]), 0, atol=1e-6)
+
+    # Blue only: the error of the mean of the 4 blue rows
+    expected = np.sqrt(frames[..., 2].var(axis=0, ddof=1).sum(axis=0) / 20) / 4
+    np.testing.assert_allclose(stacker.spectrumError([0, 0, 2]), expected, rtol=1e-4)
+
+
+def test_noise_is_relative_to_the_weighted_spectrum():
+    frames = np.zeros((8, 2, 5, 3), dtype=np.float32)
+    frames[..., 0] = 200
+    frames[..., 1] = 50
+    frames[:, :, :, 1] += np.arange(8, dtype=np.float32)[:, None, None]
+    stacker = stacked(frames)
+    weights = [1, 3, 0]
+    peak = SpectrumEngine(weights).reduce(stacker.mean, baseline=0).max()
+    assert stacker.noise(weights) == pytest.approx(np.median(stacker.spectrumError(weights)) / peak)
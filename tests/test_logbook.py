@@ -0,0 +1,37 @@
+import os
+import re
+import shutil
+
+from helpers.Logbook import Logbook
+
+DOCS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'docs')
+
+
+def logbook(tmp_path, pageSize=2):
+    shutil.copy(os.path.join(DOCS, 'index-template.html'), str(tmp_path))
+    return Logbook(str(tmp_path), pageSize=pageSize)
+
+
+def meta(i):
+    return {'time': '20211114-1200{:02d}'.format(i), 'name': 'n', 'light': 'l', 'sample': 's'}
+
+
+def footer(tmp_path, name):
+    with open(os.path.join(str(tmp_path), name), encoding='utf-8') as f:
+        return re.search(r'<tr><th>(.*?)</th></tr>', f.read()).group(1)
+
+
+def test_pages_stay_correct_as_pages_are_added(tmp_path):
+    book = logbook(tmp_path)
+    for i in range(7):
+        book.add(meta(i))
+    written = {name: footer(tmp_path, name) for name in ('log-1.html', 'log-2.html', 'log-3.html')}
+
+    # A rebuild writes every page from scratch, added pages must match it
+    book.rebuild()
+    for name, text in written.items():
+        assert footer(tmp_path, name) == text
+    assert footer(tmp_path, 'log-1.html').startswith('Page 1 - ')
+    assert 'Newer entries' in footer(tmp_path, 'log-3.html')
+    assert 'Newer entries' not in footer(tmp_path, 'log-4.html')
+    assert footer(tmp_path, 'index.html') == footer(tmp_path, 'log-4.html')
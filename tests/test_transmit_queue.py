@@ -0,0 +1,78 @@
+import queue
+
+import pytest
+
+from streaming.server import NAL, TransmitQueue, video_budget
+
+SPS, PPS, IDR, P = NAL.SPS, NAL.PPS, NAL.CODED_SLICE_IDR, NAL.CODED_SLICE_NON_IDR
+
+
+def drain(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get())
+        except queue.Empty:
+            return items
+
+
+def test_video_starts_at_sps():
+    q = TransmitQueue(max_bytes=1000)
+    assert not q.put_video('p', 10, P)
+    assert q.put_video('sps', 10, SPS)
+    assert q.put_video('p', 10, P)
+    assert drain(q) == ['sps', 'p']
+
+
+def test_oversize_key_frame_is_queued():
+    # A long exposure: the IDR is larger than the whole budget.
+    q = TransmitQueue(max_bytes=1000)
+    assert q.put_video('sps', 10, SPS)
+    assert q.put_video('pps', 4, PPS)
+    assert q.put_video('idr', 5000, IDR)
+    assert q.video_bytes == 5014
+    assert drain(q) == ['sps', 'pps', 'idr']
+
+
+def test_oversize_unit_is_queued_when_no_video_is_queued():
+    q = TransmitQueue(max_bytes=1000)
+    for item, size, nal_type in [('sps', 10, SPS), ('pps', 4, PPS), ('idr', 500, IDR)]:
+        assert q.put_video(item, size, nal_type)
+    drain(q)
+    assert q.put_video('p', 5000, P)
+    assert drain(q) == ['p']
+
+
+def test_unit_over_budget_drops_video_until_sps():
+    q = TransmitQueue(max_bytes=1000)
+    for item, size, nal_type in [('sps', 10, SPS), ('pps', 4, PPS), ('idr', 500, IDR),
+                                 ('p1', 400, P)]:
+        assert q.put_video(item, size, nal_type)
+    assert not q.put_video('p2', 400, P)
+    assert q.video_bytes == 0
+    assert not q.put_video('p3', 10, P)
+    assert q.put_video('sps', 10, SPS)
+    assert drain(q) == ['sps']
+
+
+def test_control_messages_evict_video():
+    q = TransmitQueue(capacity=2, max_bytes=1000)
+    assert q.put_video('sps', 10, SPS)
+    assert q.put_video('pps', 4, PPS)
+    assert q.put('stop')
+    assert drain(q) == ['stop']
+
+
+def test_latest_message_replaces_queued_one():
+    q = TransmitQueue()
+    assert q.put('overlay 1', 'overlay')
+    assert q.put('spectrum', 'spectrum')
+    assert q.put('overlay 2', 'overlay')
+    assert drain(q) == ['overlay 2', 'spectrum']
+
+
+@pytest.mark.parametrize('framerate, seconds', [(30, 1.0), (5, 1.0), (1, 4.0), (0.5, 8.0)])
+def test_video_budget_follows_framerate(framerate, seconds):
+    max_bytes, max_delay = video_budget(1000000, framerate)
+    assert max_delay == seconds
+    assert max_bytes == int(125000 * seconds)